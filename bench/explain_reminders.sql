@@ -0,0 +1,156 @@
+-- План запроса, которым правила напоминаний ставят задачи в outbox.
+-- Все напоминания - утро и вечер дней челленджа и воронка продаж - ставит
+-- sweep_due_reminders одним проходом по next_action_at участников.
+-- Запрос собирается из REMINDER_RULES (build_reminder_sweep_sql), здесь -
+-- его текст с параметрами по умолчанию; после изменения правил обновите
+-- этот файл, а план добавьте новым разделом "ПОСЛЕ: ..." в конец
+-- bench/explain_reminders_baseline.txt (прежние разделы - история):
+--   psql "$DATABASE_URL" -f bench/explain_reminders.sql
+--
+-- Запрос меняет данные, поэтому выполняется в транзакции, которая в конце откатывается.
+
+BEGIN;
+
+\echo '=== sweep_due_reminders (пачка 200 из 1% участников челленджа и 1% завершивших, у которых подошло время) ==='
+UPDATE challenge_progress
+SET next_action_at = NOW() - INTERVAL '1 minute'
+WHERE user_id % 100 = 0 AND is_active;
+
+UPDATE challenge_progress
+SET next_action_at = NOW() - INTERVAL '1 minute', next_action = 'offer_12h'
+WHERE user_id % 97 = 0 AND NOT is_active AND completed_at IS NOT NULL;
+
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF, TIMING OFF)
+WITH due AS (
+    SELECT cp.user_id, cp.next_action, cp.is_active,
+           COALESCE((SELECT u.timezone FROM users u WHERE u.user_id = cp.user_id), 'Europe/Moscow') AS tz,
+           COALESCE((SELECT u.bot_blocked FROM users u WHERE u.user_id = cp.user_id), FALSE) AS blocked,
+           cp.next_action_at > NOW() - make_interval(secs => CASE WHEN cp.next_action IN ('offer_12h', 'offer_24h') THEN 21600.0 ELSE 10800.0 END) AS fresh,
+           CASE WHEN NOT cp.next_action_at > NOW() - make_interval(secs => CASE WHEN cp.next_action IN ('offer_12h', 'offer_24h') THEN 21600.0 ELSE 10800.0 END) OR COALESCE((SELECT u.bot_blocked FROM users u WHERE u.user_id = cp.user_id), FALSE) THEN NULL WHEN cp.next_action = 'offer_12h' AND cp.reminder_12h_sent = FALSE AND cp.first_offer_sent = TRUE AND cp.purchased = FALSE AND NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = cp.user_id AND u.subscription_until >= NOW()) THEN 'offer_12h' WHEN cp.next_action = 'offer_24h' AND cp.reminder_24h_sent = FALSE AND cp.reminder_12h_sent = TRUE AND cp.purchased = FALSE AND NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = cp.user_id AND u.subscription_until >= NOW()) THEN 'offer_24h' END AS progress_kind,
+           CASE WHEN cp.next_action = 'offer_12h' THEN jsonb_build_object('progress_diff', time_spent_minutes((SELECT time_spent FROM challenge_day_results WHERE user_id = cp.user_id AND day = 3)) - time_spent_minutes((SELECT time_spent FROM challenge_day_results WHERE user_id = cp.user_id AND day = 1))) ELSE '{}'::jsonb END AS payload
+    FROM challenge_progress cp
+    WHERE cp.next_action_at <= NOW()
+    ORDER BY cp.next_action_at
+    LIMIT 200
+    FOR UPDATE OF cp SKIP LOCKED
+),
+advanced AS (
+    UPDATE challenge_progress cp
+    SET (next_action_at, next_action) = (
+        SELECT slot.at, slot.action
+    FROM next_reminder_slot(due.tz, NOW(), '09:00', '20:00',
+                            make_interval(secs => cp.user_id % 1800)) slot
+        WHERE cp.is_active AND EXISTS (
+            SELECT 1
+            FROM (SELECT d.user_id, d.day, d.completed, d.unlocked_at,
+                        d.reminder_sent OR (due.fresh AND NOT due.blocked AND due.next_action = 'morning' AND d.reminder_sent = FALSE AND d.day = 2 AND d.unlocked_at < l.today) OR (due.fresh AND NOT due.blocked AND due.next_action = 'morning' AND d.reminder_sent = FALSE AND d.day = 3 AND d.unlocked_at < l.today) AS reminder_sent,
+                        d.evening_reminder_sent OR (due.fresh AND NOT due.blocked AND due.next_action = 'evening' AND d.evening_reminder_sent = FALSE AND d.day = 1 AND d.unlocked_at >= l.today AND d.unlocked_at < l.today + INTERVAL '1 day') OR (due.fresh AND NOT due.blocked AND due.next_action = 'evening' AND d.evening_reminder_sent = FALSE AND d.day = 2 AND d.reminder_sent = TRUE AND d.unlocked_at < l.today) OR (due.fresh AND NOT due.blocked AND due.next_action = 'evening' AND d.evening_reminder_sent = FALSE AND d.day = 3 AND d.reminder_sent = TRUE AND d.unlocked_at < l.today) AS evening_reminder_sent
+                  FROM challenge_day_results d, (SELECT date_trunc('day', NOW() AT TIME ZONE due.tz) AT TIME ZONE due.tz AS today) AS l
+                  WHERE d.user_id = cp.user_id) AS d,
+                 (SELECT date_trunc('day', NOW() AT TIME ZONE due.tz) AT TIME ZONE due.tz + days.n * INTERVAL '1 day' AS today
+                  FROM (VALUES (0), (1)) AS days (n)) AS l
+            WHERE d.user_id = cp.user_id AND d.completed = FALSE
+            AND ((d.reminder_sent = FALSE AND d.day = 2 AND d.unlocked_at < l.today) OR (d.reminder_sent = FALSE AND d.day = 3 AND d.unlocked_at < l.today) OR (d.evening_reminder_sent = FALSE AND d.day = 1 AND d.unlocked_at >= l.today AND d.unlocked_at < l.today + INTERVAL '1 day') OR (d.evening_reminder_sent = FALSE AND d.day = 2 AND d.reminder_sent = TRUE AND d.unlocked_at < l.today) OR (d.evening_reminder_sent = FALSE AND d.day = 3 AND d.reminder_sent = TRUE AND d.unlocked_at < l.today))
+        )
+        UNION ALL
+        SELECT cp.completed_at + INTERVAL '24 hours', 'offer_24h'
+        WHERE NOT cp.is_active AND due.next_action = 'offer_12h'
+    ),
+    reminder_12h_sent = cp.reminder_12h_sent OR COALESCE(due.progress_kind IN ('offer_12h'), FALSE),
+    reminder_24h_sent = cp.reminder_24h_sent OR COALESCE(due.progress_kind IN ('offer_24h'), FALSE),
+    promo_code_sent = cp.promo_code_sent OR COALESCE(due.progress_kind IN ('offer_24h'), FALSE)
+    FROM due
+    WHERE cp.user_id = due.user_id
+),
+local_day AS (
+    SELECT user_id, next_action, date_trunc('day', NOW() AT TIME ZONE tz) AT TIME ZONE tz AS today
+    FROM due
+    WHERE fresh AND is_active AND NOT blocked
+),
+"day2_reminder" AS (
+    UPDATE challenge_day_results d
+    SET reminder_sent = TRUE
+    FROM local_day l
+    WHERE l.next_action = 'morning'
+    AND d.user_id = l.user_id
+    AND d.completed = FALSE
+    AND d.reminder_sent = FALSE
+    AND d.day = 2 AND d.unlocked_at < l.today
+    RETURNING d.user_id, 'day2_reminder' AS kind, '{}'::jsonb AS payload
+),
+"day3_reminder" AS (
+    UPDATE challenge_day_results d
+    SET reminder_sent = TRUE
+    FROM local_day l
+    WHERE l.next_action = 'morning'
+    AND d.user_id = l.user_id
+    AND d.completed = FALSE
+    AND d.reminder_sent = FALSE
+    AND d.day = 3 AND d.unlocked_at < l.today
+    RETURNING d.user_id, 'day3_reminder' AS kind, '{}'::jsonb AS payload
+),
+"day1_evening" AS (
+    UPDATE challenge_day_results d
+    SET evening_reminder_sent = TRUE
+    FROM local_day l
+    WHERE l.next_action = 'evening'
+    AND d.user_id = l.user_id
+    AND d.completed = FALSE
+    AND d.evening_reminder_sent = FALSE
+    AND d.day = 1 AND d.unlocked_at >= l.today AND d.unlocked_at < l.today + INTERVAL '1 day'
+    RETURNING d.user_id, 'day1_evening' AS kind, '{}'::jsonb AS payload
+),
+"day2_evening" AS (
+    UPDATE challenge_day_results d
+    SET evening_reminder_sent = TRUE
+    FROM local_day l
+    WHERE l.next_action = 'evening'
+    AND d.user_id = l.user_id
+    AND d.completed = FALSE
+    AND d.evening_reminder_sent = FALSE
+    AND d.day = 2 AND d.reminder_sent = TRUE AND d.unlocked_at < l.today
+    RETURNING d.user_id, 'day2_evening' AS kind, '{}'::jsonb AS payload
+),
+"day3_evening" AS (
+    UPDATE challenge_day_results d
+    SET evening_reminder_sent = TRUE
+    FROM local_day l
+    WHERE l.next_action = 'evening'
+    AND d.user_id = l.user_id
+    AND d.completed = FALSE
+    AND d.evening_reminder_sent = FALSE
+    AND d.day = 3 AND d.reminder_sent = TRUE AND d.unlocked_at < l.today
+    RETURNING d.user_id, 'day3_evening' AS kind, '{}'::jsonb AS payload
+),
+run AS (
+    SELECT COALESCE(NULL::bigint, nextval('reminder_sweep_runs')) AS sweep_run
+),
+queued AS (
+    INSERT INTO outbox (kind, user_id, payload, sweep_run)
+    SELECT kind, user_id, payload, (SELECT sweep_run FROM run)
+    FROM (
+    SELECT kind, user_id, payload FROM "day2_reminder"
+    UNION ALL
+    SELECT kind, user_id, payload FROM "day3_reminder"
+    UNION ALL
+    SELECT kind, user_id, payload FROM "day1_evening"
+    UNION ALL
+    SELECT kind, user_id, payload FROM "day2_evening"
+    UNION ALL
+    SELECT kind, user_id, payload FROM "day3_evening"
+    UNION ALL
+    SELECT progress_kind, user_id, payload FROM due WHERE progress_kind IS NOT NULL) AS jobs
+    RETURNING user_id, kind
+),
+waves AS (
+    INSERT INTO outbox_waves (kind, sweep_run, total)
+    SELECT kind, (SELECT sweep_run FROM run), COUNT(*) FROM queued GROUP BY kind
+    ON CONFLICT (kind, sweep_run) DO UPDATE SET total = outbox_waves.total + EXCLUDED.total
+)
+SELECT (SELECT sweep_run FROM run) AS sweep_run,
+       (SELECT COUNT(*) FROM due) AS due,
+       (SELECT COUNT(*) FROM due WHERE fresh AND blocked) AS suppressed,
+       COALESCE((SELECT jsonb_agg(jsonb_build_object('user_id', user_id, 'kind', kind)) FROM queued),
+                '[]'::jsonb) AS queued;
+
+ROLLBACK;
@@ -0,0 +1,79 @@
+-- Синтетическая база на 1 000 000 участников для проверки планов запросов.
+-- Запускать только на пустой тестовой базе с примененными миграциями:
+--   psql "$DATABASE_URL" -f bench/seed_1m.sql
+--
+-- Распределение примерно как в проде: участники накапливаются за год,
+-- большинство давно прошли или бросили челлендж и уже получили свои
+-- напоминания, "живых" кандидатов на рассылку - единицы процентов.
+
+INSERT INTO users (user_id, username, started_at, created_at, subscription_until)
+SELECT i, 'user' || i, NOW() - (i % 365) * INTERVAL '1 day', NOW() - (i % 365) * INTERVAL '1 day',
+       CASE WHEN i % 40 = 0 THEN NOW() + INTERVAL '30 days' END
+FROM generate_series(1, 1000000) AS i;
+
+-- Состояние участников сначала собирается во временной таблице в "плоском"
+-- виде (по колонке на день), затем раскладывается по challenge_progress
+-- и challenge_day_results.
+CREATE TEMP TABLE seed_progress AS
+SELECT user_id, started_at, old, stage,
+       stage >= 3 AND user_id % 20 = 0 AS purchased,
+       CASE WHEN stage >= 1 THEN started_at + INTERVAL '2 hours' END AS day1_completed_at,
+       CASE WHEN stage >= 2 THEN started_at + INTERVAL '26 hours' END AS day2_completed_at,
+       CASE WHEN stage >= 3 THEN started_at + INTERVAL '50 hours' END AS day3_completed_at,
+       -- давние участники уже получили все положенные напоминания
+       stage >= 1 AND old AS day2_reminder_sent,
+       stage >= 2 AND old AS day3_reminder_sent,
+       stage >= 3 AND old AS offers_sent
+FROM (
+    SELECT user_id, started_at, started_at < NOW() - INTERVAL '3 days' AS old,
+           CASE WHEN user_id % 20 < 6 THEN 0     -- бросили в первый день
+                WHEN user_id % 20 < 10 THEN 1    -- прошли только День 1
+                WHEN user_id % 20 < 13 THEN 2    -- прошли День 2
+                ELSE 3                           -- прошли челлендж
+           END AS stage
+    FROM users
+) AS s;
+
+-- Свежая когорта (последние сутки), которую и должны находить джобы
+UPDATE seed_progress
+SET started_at = NOW() - (user_id % 1440) * INTERVAL '1 minute',
+    day1_completed_at = CASE WHEN stage >= 1 THEN NOW() - INTERVAL '20 hours' END,
+    day2_completed_at = CASE WHEN stage >= 2 THEN NOW() - INTERVAL '20 hours' END,
+    day3_completed_at = CASE WHEN stage >= 3 THEN NOW() - (user_id / 1460 % 48) * INTERVAL '1 hour' END,
+    day2_reminder_sent = stage >= 1 AND user_id % 2 = 0,
+    day3_reminder_sent = stage >= 2 AND user_id % 2 = 0,
+    offers_sent = FALSE
+WHERE user_id % 365 = 1;
+
+INSERT INTO challenge_progress
+    (user_id, age, age_category, current_day, is_active, started_at, completed_at,
+     first_offer_sent, reminder_12h_sent, reminder_24h_sent, purchased)
+SELECT user_id, 5, '4-6',
+       LEAST(stage + 1, 3), stage < 3, started_at, day3_completed_at,
+       stage >= 3,
+       offers_sent OR (stage >= 3 AND user_id % 365 = 1 AND user_id / 1460 % 48 >= 24),
+       offers_sent, purchased
+FROM seed_progress;
+
+INSERT INTO challenge_day_results
+    (user_id, day, unlocked_at, completed, completed_at, time_spent,
+     reminder_sent, evening_reminder_sent)
+SELECT user_id, 1, started_at, stage >= 1, day1_completed_at,
+       CASE WHEN stage >= 1 THEN '5-10' END, FALSE, old
+FROM seed_progress
+UNION ALL
+SELECT user_id, 2, day1_completed_at, stage >= 2, day2_completed_at,
+       CASE WHEN stage >= 2 THEN '10-15' END, day2_reminder_sent, stage >= 1 AND old
+FROM seed_progress
+WHERE stage >= 1
+UNION ALL
+SELECT user_id, 3, day2_completed_at, stage >= 3, day3_completed_at,
+       CASE WHEN stage >= 3 THEN 'more15' END, day3_reminder_sent, stage >= 2 AND old
+FROM seed_progress
+WHERE stage >= 2;
+
+DROP TABLE seed_progress;
+
+VACUUM ANALYZE users;
+VACUUM ANALYZE challenge_progress;
+VACUUM ANALYZE challenge_day_results;
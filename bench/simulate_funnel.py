@@ -0,0 +1,369 @@
+"""Симуляция напоминаний и воронки на синтетических участниках
+
+Запускать только на отдельной тестовой базе - скрипт сам применит
+миграции, создаст схему sim и участников с user_id от SIM_USER_ID_BASE:
+
+    python bench/simulate_funnel.py --database-url postgresql://localhost/sim --users 100000
+
+Что подменяется:
+- часы. SimulationClock стартует с ближайшего утра (MORNING_TIME в
+  DEFAULT_TIMEZONE) и идет в --speed раз быстрее настоящих (0 - без
+  пауз). Тот же момент видит SQL: на подключениях симуляции search_path =
+  public, sim, pg_catalog, и NOW() в запросах бота - это sim.now(),
+  которая читает sim.clock;
+- Telegram. StubSession отвечает через --latency-ms, ничего не отправляя.
+  Лимиты telegram_rate_limiter настоящие, --rate меняет общий лимит.
+
+Участники получают случайную стадию: День 1 (открыт сегодня), День 2 и
+День 3 (открыты вчера, утреннее напоминание еще не отправлено) и
+завершившие челлендж за 12 часов до старта плюс случайное время в пределах
+--hours (воронка). Часть участников заблокировала бота.
+
+Планировщик с правилами напоминаний идет по часам симуляции --hours
+часов, воркеры outbox отправляют в реальном времени. В конце - отчет по
+видам напоминаний: сообщений в секунду, запросов к БД на сообщение,
+задержка от постановки в очередь до отправки и опоздание постановки
+относительно положенного времени (по часам симуляции).
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from datetime import timedelta
+
+SIM_USER_ID_BASE = 9_000_000_000_000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Симуляция волны напоминаний на синтетических участниках")
+    parser.add_argument('--database-url', default=os.getenv('SIM_DATABASE_URL'), required=not os.getenv('SIM_DATABASE_URL'),
+                        help="тестовая база (не production!), по умолчанию SIM_DATABASE_URL")
+    parser.add_argument('--users', type=int, default=100000, help="сколько участников создать")
+    parser.add_argument('--hours', type=float, default=1, help="сколько часов симуляции пройти")
+    parser.add_argument('--speed', type=float, default=60, help="во сколько раз часы симуляции быстрее настоящих, 0 - без пауз")
+    parser.add_argument('--latency-ms', type=float, default=20, help="время ответа заглушки Telegram")
+    parser.add_argument('--rate', type=float, help="общий лимит сообщений в секунду (TELEGRAM_GLOBAL_RATE)")
+    parser.add_argument('--workers', type=int, default=1, help="воркеров outbox (как реплик бота)")
+    parser.add_argument('--blocked-share', type=float, default=0.05, help="доля заблокировавших бота")
+    parser.add_argument('--keep', action='store_true', help="не удалять участников симуляции в конце")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# Настройки бота читаются при импорте
+os.environ['DATABASE_URL'] = args.database_url
+if args.rate:
+    os.environ['TELEGRAM_GLOBAL_RATE'] = str(args.rate)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg
+from aiogram.client.session.base import BaseSession
+
+import challenge_bot as cb
+
+
+SIM_SCHEMA_SQL = '''
+CREATE SCHEMA IF NOT EXISTS sim;
+
+CREATE TABLE IF NOT EXISTS sim.clock (now TIMESTAMPTZ NOT NULL);
+
+-- Стоит в search_path раньше pg_catalog, поэтому NOW() в запросах бота - это она
+CREATE OR REPLACE FUNCTION sim.now() RETURNS TIMESTAMPTZ AS $$
+    SELECT now FROM sim.clock
+$$ LANGUAGE sql STABLE;
+
+DROP TABLE IF EXISTS sim.population;
+CREATE TABLE sim.population (
+    user_id BIGINT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    morning_at TIMESTAMPTZ,
+    evening_at TIMESTAMPTZ,
+    completed_at TIMESTAMPTZ
+);
+
+DROP TABLE IF EXISTS sim.enqueued;
+CREATE TABLE sim.enqueued (user_id BIGINT NOT NULL, kind TEXT NOT NULL, at TIMESTAMPTZ NOT NULL);
+'''
+
+CLEANUP_SQL = [
+    'DELETE FROM outbox WHERE user_id >= %(base)s',
+    'DELETE FROM outbox_archive WHERE user_id >= %(base)s',
+    'DELETE FROM outbox_dead_letter WHERE user_id >= %(base)s',
+    'DELETE FROM reminders WHERE user_id >= %(base)s',
+    'DELETE FROM challenge_day_results WHERE user_id >= %(base)s',
+    'DELETE FROM challenge_progress WHERE user_id >= %(base)s',
+    'DELETE FROM users WHERE user_id >= %(base)s',
+]
+
+# Стадии участников и их места в воронке; слоты утра и вечера - как у
+# schedule_next_reminder, смещение по user_id
+SEED_SQL = [
+    '''SELECT setseed(0.5)''',
+    '''INSERT INTO sim.population (user_id, stage)
+       SELECT %(base)s + i,
+              CASE WHEN r < 0.1 THEN 'day1' WHEN r < 0.5 THEN 'day2' WHEN r < 0.8 THEN 'day3' ELSE 'funnel' END
+       FROM (SELECT i, random() AS r FROM generate_series(1, %(users)s) AS i) AS s''',
+    '''UPDATE sim.population p
+       SET morning_at = (SELECT at FROM next_reminder_slot(%(tz)s, %(start)s - INTERVAL '1 second', %(morning)s, %(morning)s,
+                                                            make_interval(secs => p.user_id %% %(spread)s))),
+           evening_at = (SELECT at FROM next_reminder_slot(%(tz)s, %(start)s - INTERVAL '1 second', %(evening)s, %(evening)s,
+                                                            make_interval(secs => p.user_id %% %(spread)s))),
+           completed_at = CASE WHEN stage = 'funnel'
+                               THEN %(start)s - INTERVAL '12 hours' + random() * make_interval(secs => %(window)s) END''',
+    '''INSERT INTO users (user_id, username, started_at, created_at, bot_blocked)
+       SELECT user_id, 'sim' || user_id, %(start)s - INTERVAL '3 days', %(start)s - INTERVAL '3 days',
+              random() < %(blocked_share)s
+       FROM sim.population''',
+    '''INSERT INTO challenge_progress (user_id, age, age_category, current_day, is_active, started_at,
+                                     completed_at, first_offer_sent, purchased, next_action_at, next_action)
+       SELECT user_id, 5, '4-6',
+              CASE stage WHEN 'day1' THEN 1 WHEN 'day2' THEN 2 ELSE 3 END,
+              stage <> 'funnel',
+              %(start)s - CASE stage WHEN 'day1' THEN INTERVAL '2 hours' WHEN 'day2' THEN INTERVAL '1 day 2 hours'
+                                     ELSE INTERVAL '2 days 2 hours' END,
+              completed_at, stage = 'funnel', stage = 'funnel' AND random() < 0.1,
+              CASE WHEN stage = 'funnel' THEN completed_at + INTERVAL '12 hours' ELSE LEAST(morning_at, evening_at) END,
+              CASE WHEN stage = 'funnel' THEN 'offer_12h'
+                   WHEN morning_at < evening_at THEN 'morning' ELSE 'evening' END
+       FROM sim.population''',
+    '''INSERT INTO challenge_day_results (user_id, day, unlocked_at, completed, completed_at, time_spent)
+       SELECT p.user_id, d.day,
+              CASE WHEN p.stage = 'day1' THEN %(start)s - INTERVAL '2 hours'
+                   ELSE %(start)s - (CASE p.stage WHEN 'day2' THEN 2 ELSE 3 END - d.day + 1) * INTERVAL '1 day' END,
+              d.day < last_day.day OR p.stage = 'funnel',
+              CASE WHEN d.day < last_day.day OR p.stage = 'funnel'
+                   THEN COALESCE(p.completed_at, %(start)s) - (last_day.day - d.day) * INTERVAL '1 day' END,
+              (ARRAY['less5', '5-10', '10-15', 'more15'])[1 + floor(random() * 4)::int]
+       FROM sim.population p
+       CROSS JOIN LATERAL (SELECT CASE p.stage WHEN 'day1' THEN 1 WHEN 'day2' THEN 2 ELSE 3 END AS day) AS last_day
+       CROSS JOIN LATERAL generate_series(1, last_day.day) AS d (day)''',
+    '''ANALYZE users; ANALYZE challenge_progress; ANALYZE challenge_day_results''',
+]
+
+# Что положено было поставить и когда - для опоздания постановки
+EXPECTED_AT_SQL = '''
+    CASE WHEN e.kind LIKE '%%_reminder' THEN p.morning_at
+         WHEN e.kind LIKE '%%_evening' THEN p.evening_at
+         WHEN e.kind = 'offer_12h' THEN p.completed_at + INTERVAL '12 hours'
+         WHEN e.kind = 'offer_24h' THEN p.completed_at + INTERVAL '24 hours' END
+'''
+
+REPORT_SQL = f'''
+    WITH sent AS (
+        SELECT kind, COUNT(*) AS sent,
+               EXTRACT(EPOCH FROM MAX(finished_at) - MIN(created_at)) AS span,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM finished_at - created_at)) AS latency_p50,
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM finished_at - created_at)) AS latency_p95,
+               MAX(EXTRACT(EPOCH FROM finished_at - created_at)) AS latency_max
+        FROM outbox_archive
+        WHERE user_id >= %(base)s AND status = 'sent'
+        GROUP BY kind
+    ),
+    lag AS (
+        SELECT e.kind,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM e.at - {EXPECTED_AT_SQL})) AS lag_p50,
+               MAX(EXTRACT(EPOCH FROM e.at - {EXPECTED_AT_SQL})) AS lag_max
+        FROM sim.enqueued e
+        JOIN sim.population p USING (user_id)
+        GROUP BY e.kind
+    )
+    SELECT kind, sent.sent, sent.span, latency_p50, latency_p95, latency_max, lag_p50, lag_max
+    FROM sent FULL JOIN lag USING (kind)
+    ORDER BY kind
+'''
+
+
+class SimulationClock(cb.SchedulerClock):
+    """Часы симуляции для планировщика и для NOW() в SQL
+
+    sleep не ждет, а сдвигает время (с паузой 1/speed от сдвига), и
+    записывает новое время в sim.clock отдельным подключением - чтобы
+    запросы симуляции не попадали в счетчик запросов бота. При speed = 0
+    время сдвигается, только когда джобы планировщика закончились, иначе
+    часы убежали бы вперед от правил. На end часы останавливаются.
+    """
+
+    def __init__(self, conn, start, end, speed):
+        self.conn = conn
+        self.start = start
+        self.end = end
+        self.current = start
+        self.speed = speed
+        self.supervisor = None
+
+    def now(self):
+        return self.current
+
+    def monotonic(self):
+        return (self.current - self.start).total_seconds()
+
+    async def write(self, moment):
+        await self.conn.execute('UPDATE sim.clock SET now = %s', (moment,))
+
+    async def sleep(self, seconds):
+        if self.current >= self.end:
+            await asyncio.sleep(1)
+            return
+        if not self.speed:
+            while self.supervisor is not None and self.supervisor.running_count():
+                await asyncio.sleep(0.01)
+        self.current = min(self.current + timedelta(seconds=seconds), self.end)
+        # Отмена планировщика посреди запроса сломала бы подключение часов
+        await asyncio.shield(self.write(self.current))
+        await asyncio.sleep(seconds / self.speed if self.speed else 0)
+
+
+class StubSession(BaseSession):
+    """Сессия бота без Telegram: отвечает через latency секунд"""
+
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self.requests = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+async def configure_connection(conn):
+    """NOW() в подключениях пула - это sim.now()"""
+    await conn.set_autocommit(True)
+    await conn.execute('SET search_path = public, sim, pg_catalog')
+    await conn.set_autocommit(False)
+
+
+async def execute_all(conn, statements, params):
+    for sql in statements:
+        await conn.execute(sql, params)
+
+
+async def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    await cb.init_db_pool(configure=configure_connection)
+    await cb.init_db()
+
+    clock_conn = await psycopg.AsyncConnection.connect(args.database_url, autocommit=True)
+    await clock_conn.execute(SIM_SCHEMA_SQL)
+    # Старт - ближайшее утро по настоящим часам: NOW() по умолчанию у
+    # столбцов вроде outbox.available_at остается настоящим и не должен
+    # оказаться позже часов симуляции
+    cur = await clock_conn.execute(
+        '''SELECT (slot.at AT TIME ZONE current_setting('TimeZone'))::timestamp AS start
+           FROM next_reminder_slot(%s, pg_catalog.now(), %s, %s, INTERVAL '0') AS slot''',
+        (cb.DEFAULT_TIMEZONE, cb.MORNING_TIME, cb.MORNING_TIME))
+    start = (await cur.fetchone())[0]
+    await clock_conn.execute('DELETE FROM sim.clock')
+    await clock_conn.execute('INSERT INTO sim.clock VALUES (%s)', (start,))
+    end = start + timedelta(hours=args.hours)
+    clock = SimulationClock(clock_conn, start, end, args.speed)
+
+    params = {
+        **cb.reminder_slot_params(),
+        'tz': cb.DEFAULT_TIMEZONE,
+        'base': SIM_USER_ID_BASE,
+        'users': args.users,
+        'start': start,
+        'window': args.hours * 3600,
+        'blocked_share': args.blocked_share,
+    }
+    seeded_at = time.monotonic()
+    async with cb.get_db_connection() as conn:
+        await execute_all(conn, CLEANUP_SQL, params)
+        await execute_all(conn, SEED_SQL, params)
+    print(f"Участников: {args.users}, создано за {time.monotonic() - seeded_at:.1f} сек, старт симуляции {start}")
+
+    # Записываем, когда по часам симуляции что поставлено в очередь
+    enqueued = []
+    sweep_due_reminders = cb.sweep_due_reminders
+
+    async def recording_sweep(limit, sweep_run=None, catch_up=None):
+        sweep_run, due, jobs, suppressed = await sweep_due_reminders(limit, sweep_run, catch_up)
+        enqueued.extend((job['user_id'], job['kind'], clock.now()) for job in jobs)
+        return sweep_run, due, jobs, suppressed
+    cb.sweep_due_reminders = recording_sweep
+
+    # Запуски по часам симуляции не должны попасть в job_runs - по ним
+    # настоящий планировщик решает, когда запускать джобы
+    async def skip_job_run(job, started_at, duration, error=None):
+        pass
+    cb.save_job_run = skip_job_run
+
+    # И прошлые запуски из job_runs не при чем: по часам симуляции бот
+    # стартует впервые, без окна догона
+    async def no_job_runs():
+        return {}
+    cb.load_job_runs = no_job_runs
+
+    session = StubSession(args.latency_ms / 1000)
+    session.middleware(cb.telegram_rate_limiter)
+    cb.bot.session = session
+
+    supervisor = cb.JobSupervisor(cb.JOBS_MAX_CONCURRENT, clock)
+    clock.supervisor = supervisor
+    scheduler = cb.Scheduler(clock=clock, supervisor=supervisor)
+    cb.register_reminder_jobs(scheduler)
+    supervisor.start_service('scheduler', scheduler.run())
+    for worker in range(args.workers):
+        supervisor.start_service(f'outbox_worker_{worker}', cb.run_outbox_worker())
+
+    started = time.monotonic()
+    queries_before = cb.db_query_stats['queries']
+    while True:
+        await asyncio.sleep(5)
+        async with cb.get_db_connection() as conn:
+            cur = await conn.execute('SELECT COUNT(*) AS count FROM outbox WHERE user_id >= %s', (SIM_USER_ID_BASE,))
+            pending = (await cur.fetchone())['count']
+        print(f"[{time.monotonic() - started:6.0f} сек] часы симуляции {clock.now():%H:%M:%S}, "
+              f"поставлено {len(enqueued)}, отправлено {session.requests}, в очереди {pending}")
+        if clock.now() >= end and pending == 0:
+            break
+
+    elapsed = time.monotonic() - started
+    queries = cb.db_query_stats['queries'] - queries_before
+    supervisor.stop_service('scheduler')
+    await supervisor.shutdown(cb.SHUTDOWN_DRAIN_SECONDS)
+
+    async with clock_conn.cursor().copy('COPY sim.enqueued (user_id, kind, at) FROM STDIN') as copy:
+        for row in enqueued:
+            await copy.write_row(row)
+    async with cb.get_db_connection() as conn:
+        cur = await conn.execute(REPORT_SQL, params)
+        rows = await cur.fetchall()
+
+    sent = sum(row['sent'] or 0 for row in rows)
+    print()
+    print(f"Симуляция {args.hours} ч за {elapsed:.0f} сек: отправлено {sent}, "
+          f"{sent / elapsed:.1f} сообщ./сек, запросов к БД на сообщение {queries / max(sent, 1):.2f}")
+    print(f"Пропущено заблокировавших: правила {cb.blocked_suppression_stats['reminders']}, "
+          f"очередь {cb.blocked_suppression_stats['outbox']}; лимитер: {cb.telegram_rate_limiter.get_stats()}")
+    print(f"{'вид':<15}{'отправлено':>11}{'сообщ./сек':>12}{'очередь p50':>13}{'p95':>8}{'max':>8}"
+          f"{'опоздание p50':>15}{'max':>8}")
+    for row in rows:
+        rate = (row['sent'] or 0) / float(row['span']) if row['span'] else 0
+        print(f"{row['kind']:<15}{row['sent'] or 0:>11}{rate:>12.1f}"
+              f"{float(row['latency_p50'] or 0):>12.2f}с{float(row['latency_p95'] or 0):>7.2f}с"
+              f"{float(row['latency_max'] or 0):>7.2f}с"
+              f"{float(row['lag_p50'] or 0):>14.1f}с{float(row['lag_max'] or 0):>7.1f}с")
+
+    if not args.keep:
+        async with cb.get_db_connection() as conn:
+            await execute_all(conn, CLEANUP_SQL, params)
+    await clock_conn.close()
+    await cb.close_db_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,7 +1,8 @@
 import os
+import re
 import logging
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
@@ -9,11 +10,27 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import asyncio
 import aiohttp
+import time
+import heapq
+import bisect
+import random
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 import uuid
+import socket
+import signal
 import base64
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+import psycopg
+from psycopg.rows import dict_row
+from psycopg.pq import TransactionStatus
+from psycopg_pool import AsyncConnectionPool
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from aiogram.exceptions import (TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter,
+                                TelegramNetworkError, TelegramServerError, TelegramNotFound,
+                                TelegramEntityTooLarge)
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -30,6 +47,33 @@ YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY', 'live_GjW9oiwo6gkk3zAh3Et
 ADMIN_ID = int(os.getenv('ADMIN_ID', 6266485372))
 DATABASE_URL = os.getenv('DATABASE_URL')
 
+# Пул подключений к PostgreSQL
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 2))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))  # ожидание свободного соединения, сек
+
+# Клиент API ЮKassa: одна сессия на процесс, соединения переиспользуются
+YOOKASSA_API_URL = os.getenv('YOOKASSA_API_URL', 'https://api.yookassa.ru/v3')
+YOOKASSA_CONNECT_TIMEOUT = float(os.getenv('YOOKASSA_CONNECT_TIMEOUT', 5))  # сек на соединение (с TLS)
+YOOKASSA_READ_TIMEOUT = float(os.getenv('YOOKASSA_READ_TIMEOUT', 15))  # сек ожидания данных ответа
+YOOKASSA_POOL_SIZE = int(os.getenv('YOOKASSA_POOL_SIZE', 10))  # одновременных соединений
+YOOKASSA_KEEPALIVE_SECONDS = float(os.getenv('YOOKASSA_KEEPALIVE_SECONDS', 30))  # сколько держать простаивающее соединение
+
+# Получение апдейтов: задан WEBHOOK_URL - вебхук на встроенном aiohttp-сервере
+# (можно запускать несколько реплик за балансировщиком), иначе long polling
+# для локальной разработки
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес бота, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # 1-256 символов A-Z, a-z, 0-9, _ и -; Telegram пришлет его в заголовке
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))  # одновременных запросов от Telegram на все реплики
+
+# Миграции схемы БД
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATIONS_LOCK_ID = 7_310_001  # ключ pg_advisory_lock для наката миграций
+MIGRATION_NO_TRANSACTION = '-- migrate: no-transaction'
+
 # Ссылка на публичный канал челленджа
 CHALLENGE_CHANNEL_LINK = "https://t.me/supervnimanie"
 
@@ -52,9 +96,53 @@ TARIFFS_STARS = {
     'forever': {'name': 'Forever', 'days': 36500, 'price': 500, 'old_price': 1000}
 }
 
-# Время отправки сообщений (МСК = UTC+3)
-MORNING_HOUR = 6  # 9:00 МСК = 6:00 UTC
-EVENING_HOUR = 17  # 20:00 МСК = 17:00 UTC
+# Длительность челленджа в днях
+CHALLENGE_DAYS = 3
+
+# Время утренних и вечерних напоминаний - по местному времени участника
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Europe/Moscow')  # если участник не указал свой пояс
+MORNING_TIME = os.getenv('MORNING_TIME', '09:00')
+EVENING_TIME = os.getenv('EVENING_TIME', '20:00')
+REMINDER_SPREAD_MINUTES = int(os.getenv('REMINDER_SPREAD_MINUTES', 30))  # напоминания пояса расходятся на столько минут после MORNING_TIME/EVENING_TIME
+REMINDER_SWEEP_BATCH_SIZE = int(os.getenv('REMINDER_SWEEP_BATCH_SIZE', 200))  # участников за один проход
+REMINDER_SWEEP_SECONDS = float(os.getenv('REMINDER_SWEEP_SECONDS', 15))  # как часто проверять правила напоминаний
+
+# Ограничение частоты исходящих запросов к Telegram
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 25))  # сообщений/сек на процесс (лимит Telegram ~30 на бота; рассылки идут только с ведущей реплики)
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))  # сообщений/сек в один чат
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', 3))  # сколько сообщений в чат можно отправить подряд
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', 3))  # повторов после retry_after
+
+# Кэш материалов челленджа: страховочный срок жизни на случай,
+# если материалы поменяли в обход бота или другой репликой
+MATERIALS_CACHE_TTL = float(os.getenv('MATERIALS_CACHE_TTL', 300))  # сек
+
+# Кэш прогресса челленджа по пользователям. С вебхуком апдейты одного
+# пользователя приходят на разные реплики, а кэш у каждой свой - поэтому
+# по умолчанию он выключен (0)
+PROGRESS_CACHE_SIZE = int(os.getenv('PROGRESS_CACHE_SIZE', 10000))  # пользователей
+PROGRESS_CACHE_TTL = float(os.getenv('PROGRESS_CACHE_TTL', 0 if WEBHOOK_URL else 300))  # сек, 0 - не кэшировать
+
+# Планировщик
+SCHEDULER_MAX_SLEEP_SECONDS = float(os.getenv('SCHEDULER_MAX_SLEEP_SECONDS', 30))  # не спать дольше, чтобы заметить перевод часов
+JOBS_MAX_CONCURRENT = int(os.getenv('JOBS_MAX_CONCURRENT', 4))  # фоновых джоб одновременно, остальные ждут слота
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', 30))  # сколько при остановке ждать идущие джобы
+REPLICA_ID = os.getenv('REPLICA_ID') or f"{socket.gethostname()}:{os.getpid()}"  # имя процесса в /stats
+LEADER_RETRY_SECONDS = float(os.getenv('LEADER_RETRY_SECONDS', 5))  # как часто ведомая реплика пробует стать ведущей
+LEADER_HEARTBEAT_SECONDS = float(os.getenv('LEADER_HEARTBEAT_SECONDS', 5))  # как часто ведущая проверяет свое соединение
+FUNNEL_MAX_CATCH_UP_HOURS = float(os.getenv('FUNNEL_MAX_CATCH_UP_HOURS', 6))  # насколько далеко воронка догоняет пропущенные запуски
+REMINDER_MAX_CATCH_UP_HOURS = float(os.getenv('REMINDER_MAX_CATCH_UP_HOURS', 3))  # насколько поздно еще отправлять утреннее/вечернее напоминание
+
+# Очередь отправки напоминаний (outbox)
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))  # задач, забираемых воркером за раз
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 10))  # параллельных отправок в одном процессе
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', 5))  # как часто проверять пустую очередь
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', 300))  # через сколько задачу упавшего воркера заберет другой
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETRY_BASE_SECONDS = int(os.getenv('OUTBOX_RETRY_BASE_SECONDS', 60))  # задержка повтора, удваивается с каждой попыткой
+OUTBOX_RETRY_MAX_SECONDS = int(os.getenv('OUTBOX_RETRY_MAX_SECONDS', 3600))
+OUTBOX_SEND_RETRIES = int(os.getenv('OUTBOX_SEND_RETRIES', 2))  # повторов сетевой ошибки или 5xx сразу, до возврата в очередь
+OUTBOX_SEND_RETRY_BASE_SECONDS = float(os.getenv('OUTBOX_SEND_RETRY_BASE_SECONDS', 1))
 
 # Инициализация бота
 bot = Bot(token=BOT_TOKEN)
@@ -96,162 +184,382 @@ class UploadMaterialStates(StatesGroup):
 # БАЗА ДАННЫХ PostgreSQL
 # ========================================
 
+db_pool = None
+
+async def init_db_pool(configure=None):
+    """Открывает пул подключений к PostgreSQL
+
+    configure - корутина configure(conn), которая настраивает каждое новое
+    подключение пула (симуляция подменяет так NOW()).
+    """
+    global db_pool
+    db_pool = AsyncConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        kwargs={'row_factory': dict_row, 'cursor_factory': CountingCursor},
+        configure=configure,
+        open=False
+    )
+    await db_pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+    logging.info(f"DB pool opened (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+
+async def close_db_pool():
+    """Закрывает пул подключений"""
+    if db_pool is not None:
+        await db_pool.close()
+        logging.info("DB pool closed")
+
 def get_db_connection():
-    """Создает подключение к PostgreSQL"""
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-
-def init_db():
-    """Инициализация таблиц в PostgreSQL"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Таблица пользователей
-    cur.execute('''CREATE TABLE IF NOT EXISTS users
-                 (user_id BIGINT PRIMARY KEY,
-                  username TEXT,
-                  started_at TIMESTAMP,
-                  day1_completed BOOLEAN DEFAULT FALSE,
-                  day2_completed BOOLEAN DEFAULT FALSE,
-                  day3_completed BOOLEAN DEFAULT FALSE,
-                  subscription_until TIMESTAMP,
-                  tariff TEXT,
-                  bot_blocked BOOLEAN DEFAULT FALSE,
-                  created_at TIMESTAMP DEFAULT NOW())''')
-    
-    # Таблица платежей
-    cur.execute('''CREATE TABLE IF NOT EXISTS payments
-                 (payment_id TEXT PRIMARY KEY,
-                  user_id BIGINT,
-                  amount REAL,
-                  tariff TEXT,
-                  status TEXT,
-                  yookassa_id TEXT,
-                  created_at TIMESTAMP DEFAULT NOW())''')
-    
-    # Таблица напоминаний
-    cur.execute('''CREATE TABLE IF NOT EXISTS reminders
-                 (id SERIAL PRIMARY KEY,
-                  user_id BIGINT,
-                  day INTEGER,
-                  reminder_type TEXT,
-                  sent_at TIMESTAMP,
-                  UNIQUE(user_id, day, reminder_type))''')
-    
-    # Таблица прогресса челленджа
-    cur.execute('''CREATE TABLE IF NOT EXISTS challenge_progress (
-        user_id BIGINT PRIMARY KEY,
-        age INT,
-        age_category VARCHAR(10),
-        current_day INT DEFAULT 1,
-        is_active BOOLEAN DEFAULT TRUE,
-        started_at TIMESTAMP DEFAULT NOW(),
-        day1_completed BOOLEAN DEFAULT FALSE,
-        day1_time VARCHAR(20),
-        day1_difficulty VARCHAR(20),
-        day1_completed_at TIMESTAMP,
-        day2_completed BOOLEAN DEFAULT FALSE,
-        day2_time VARCHAR(20),
-        day2_completed_at TIMESTAMP,
-        day3_completed BOOLEAN DEFAULT FALSE,
-        day3_time VARCHAR(20),
-        day3_completed_at TIMESTAMP,
-        last_reminder_sent TIMESTAMP,
-        reminder_count INT DEFAULT 0,
-        day1_reminder_sent BOOLEAN DEFAULT FALSE,
-        day2_reminder_sent BOOLEAN DEFAULT FALSE,
-        day3_reminder_sent BOOLEAN DEFAULT FALSE,
-        category_changed BOOLEAN DEFAULT FALSE,
-        original_category VARCHAR(10),
-        completed_at TIMESTAMP,
-        purchased BOOLEAN DEFAULT FALSE,
-        created_at TIMESTAMP DEFAULT NOW(),
-        updated_at TIMESTAMP DEFAULT NOW()
-    )''')
-    
-    # Таблица материалов челленджа
-    cur.execute('''CREATE TABLE IF NOT EXISTS challenge_materials (
-        id SERIAL PRIMARY KEY,
-        age_category VARCHAR(10) NOT NULL,
-        day INT NOT NULL,
-        variant INT NOT NULL,
-        title TEXT NOT NULL,
-        description TEXT,
-        file_id TEXT NOT NULL,
-        file_type VARCHAR(20),
-        created_at TIMESTAMP DEFAULT NOW(),
-        UNIQUE(age_category, day, variant)
-    )''')
-
-        # Добавляем колонки для воронки продаж
-    cur.execute('ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS first_offer_sent BOOLEAN DEFAULT FALSE')
-    cur.execute('ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS reminder_12h_sent BOOLEAN DEFAULT FALSE')
-    cur.execute('ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS reminder_24h_sent BOOLEAN DEFAULT FALSE')
-    cur.execute('ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS promo_code_sent BOOLEAN DEFAULT FALSE')
-
-        # Добавляем колонки для вечерних напоминаний
-    cur.execute('ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS day1_evening_reminder_sent BOOLEAN DEFAULT FALSE')
-    cur.execute('ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS day2_evening_reminder_sent BOOLEAN DEFAULT FALSE')
-    cur.execute('ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS day3_evening_reminder_sent BOOLEAN DEFAULT FALSE')
-    
-    # Таблица для промокодов
-    cur.execute('''CREATE TABLE IF NOT EXISTS promo_codes (
-        code VARCHAR(50) PRIMARY KEY,
-        discount_percent INT,
-        valid_hours INT,
-        description TEXT,
-        created_at TIMESTAMP DEFAULT NOW()
-    )''')
-    
-    # Таблица использования промокодов
-    cur.execute('''CREATE TABLE IF NOT EXISTS promo_usage (
-        id SERIAL PRIMARY KEY,
-        user_id BIGINT,
-        promo_code VARCHAR(50),
-        used_at TIMESTAMP DEFAULT NOW(),
-        UNIQUE(user_id, promo_code)
-    )''')
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    logging.info("Database initialized!")
+    """Берет подключение из пула: async with get_db_connection() as conn
+
+    При выходе из блока транзакция коммитится (или откатывается при ошибке),
+    а подключение возвращается в пул. Если свободных подключений нет дольше
+    DB_POOL_TIMEOUT секунд - выбрасывается PoolTimeout.
+
+    Внутри обработки апдейта (DbUnitOfWorkMiddleware) все вызовы получают
+    одно и то же подключение апдейта, а коммит происходит перед запросами
+    к Telegram и ЮKassa и в конце апдейта.
+    """
+    uow = db_unit_of_work.get()
+    if uow is not None and not uow.closed:
+        return uow.connection()
+    return db_pool.connection()
+
+def get_db_pool_stats():
+    """Метрики пула подключений"""
+    stats = db_pool.get_stats()
+    return {
+        'size': stats.get('pool_size', 0),
+        'max': stats.get('pool_max', 0),
+        'available': stats.get('pool_available', 0),
+        'waiting': stats.get('requests_waiting', 0),
+        'requests': stats.get('requests_num', 0),
+        'wait_ms': stats.get('requests_wait_ms', 0),
+        'timeouts': stats.get('requests_errors', 0),
+        'connections_lost': stats.get('connections_lost', 0)
+    }
 
 # ========================================
-# ФУНКЦИИ РАБОТЫ С БД (ОСНОВНЫЕ)
+# ЕДИНИЦА РАБОТЫ НА АПДЕЙТ
 # ========================================
 
-def add_user(user_id, username):
-    """Добавление нового пользователя"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+# Единица работы текущего апдейта (None - вне обработки апдейта:
+# планировщик, миграции, фоновые задачи)
+db_unit_of_work = ContextVar('db_unit_of_work', default=None)
+
+# Счетчики запросов по апдейтам - для /stats
+db_uow_stats = {'updates': 0, 'updates_with_db': 0, 'queries': 0, 'max_queries': 0}
+
+# Все запросы процесса через пул, включая фоновые задачи
+db_query_stats = {'queries': 0}
+
+class CountingCursor(psycopg.AsyncCursor):
+    """Курсор, который считает запросы текущего апдейта и всего процесса"""
+    
+    async def execute(self, *args, **kwargs):
+        db_query_stats['queries'] += 1
+        uow = db_unit_of_work.get()
+        if uow is not None:
+            uow.queries += 1
+        return await super().execute(*args, **kwargs)
+
+class DbUnitOfWork:
+    """Одно подключение и одна транзакция на обработку апдейта
+
+    Подключение берется из пула лениво - при первом запросе, так что апдейты
+    без обращения к БД пул не трогают. Транзакция коммитится и подключение
+    возвращается в пул перед каждым запросом к Telegram или ЮKassa
+    (CommitBeforeOutboundMiddleware, YooKassaClient.request) и в конце
+    апдейта: блокировки строк не держатся, пока хэндлер ждет внешний сервис.
+    Если обработчик упал не из-за БД (например, Telegram не доставил
+    сообщение), уже сделанные записи все равно коммитятся - как и раньше,
+    когда каждый вызов коммитился сам. Откат - только если транзакция в
+    состоянии ошибки; хелперы, которые могут упасть на ограничении
+    (use_promo_code, create_payment), пишут в точке сохранения, чтобы их
+    ошибка не ломала остальные запросы апдейта.
+    """
+    
+    def __init__(self):
+        self.conn = None
+        self.queries = 0
+        self.checkouts = 0
+        self.closed = False
+        self.after_commit = []
+        self.after_rollback = []
+        self._lock = asyncio.Lock()
+    
+    @asynccontextmanager
+    async def connection(self):
+        async with self._lock:
+            if self.conn is None:
+                self.conn = await db_pool.getconn()
+                self.checkouts += 1
+        yield self.conn
+    
+    async def release(self):
+        """Завершить транзакцию и вернуть подключение в пул"""
+        async with self._lock:
+            conn, self.conn = self.conn, None
+            on_commit, self.after_commit = self.after_commit, []
+            on_rollback, self.after_rollback = self.after_rollback, []
+            if conn is None:
+                return
+            committed = False
+            try:
+                if conn.info.transaction_status == TransactionStatus.INERROR:
+                    await conn.rollback()
+                else:
+                    await conn.commit()
+                    committed = True
+            finally:
+                await db_pool.putconn(conn)
+                if not committed:
+                    for callback in on_rollback:
+                        callback()
+        
+        for callback in on_commit:
+            callback()
     
-    cur.execute('''INSERT INTO users (user_id, username, started_at, created_at)
-                   VALUES (%s, %s, %s, %s)
-                   ON CONFLICT (user_id) DO NOTHING''',
-                (user_id, username, datetime.now(), datetime.now()))
+    async def finish(self):
+        self.closed = True
+        await self.release()
+
+class DbUnitOfWorkMiddleware(BaseMiddleware):
+    """Открывает единицу работы с БД на время обработки апдейта"""
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    async def __call__(self, handler, event, data):
+        uow = DbUnitOfWork()
+        token = db_unit_of_work.set(uow)
+        try:
+            return await handler(event, data)
+        finally:
+            db_unit_of_work.reset(token)
+            await uow.finish()
+            
+            db_uow_stats['updates'] += 1
+            if uow.checkouts:
+                db_uow_stats['updates_with_db'] += 1
+                db_uow_stats['queries'] += uow.queries
+                db_uow_stats['max_queries'] = max(db_uow_stats['max_queries'], uow.queries)
+            logging.debug(f"Update {event.update_id}: {uow.queries} queries, {uow.checkouts} connection checkouts")
+
+async def release_db_connection():
+    """Досрочно закоммитить транзакцию апдейта и вернуть подключение в пул
+
+    Вызывается перед долгой работой без БД (паузы, отправка материалов),
+    чтобы не держать подключение из пула. Следующий запрос возьмет его снова.
+    """
+    uow = db_unit_of_work.get()
+    if uow is not None:
+        await uow.release()
+
+class CommitBeforeOutboundMiddleware(BaseRequestMiddleware):
+    """Коммитит транзакцию апдейта перед каждым запросом к Telegram
+
+    Подключается к сессии бота раньше ограничителя частоты: пока хэндлер
+    ждет Telegram или свою очередь на отправку, он не держит блокировки
+    строк users, challenge_progress и шардов funnel_counters.
+    """
+    
+    async def __call__(self, make_request, bot, method):
+        await release_db_connection()
+        return await make_request(bot, method)
+
+def on_db_commit(callback):
+    """Вызвать callback после коммита транзакции апдейта
+
+    Вне апдейта (или если апдейт еще не трогал БД) каждый вызов коммитится
+    сам, и callback выполняется сразу. При откате транзакции не вызывается.
+    """
+    uow = db_unit_of_work.get()
+    if uow is not None and not uow.closed and uow.conn is not None:
+        uow.after_commit.append(callback)
+    else:
+        callback()
+
+def on_db_rollback(callback):
+    """Вызвать callback, если транзакция апдейта будет откачена
 
-def get_user(user_id):
+    Вне апдейта запись к этому моменту уже закоммичена, и callback не нужен.
+    """
+    uow = db_unit_of_work.get()
+    if uow is not None and not uow.closed and uow.conn is not None:
+        uow.after_rollback.append(callback)
+
+# ========================================
+# МИГРАЦИИ СХЕМЫ
+# ========================================
+
+def load_migrations():
+    """Список миграций из MIGRATIONS_DIR: [(версия, имя, путь)] по возрастанию версии
+
+    Файлы называются NNNN_описание.sql, версия - числовой префикс.
+    Файл, который начинается со строки MIGRATION_NO_TRANSACTION, выполняется
+    вне транзакции (нужно для CREATE INDEX CONCURRENTLY).
+    """
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = re.match(r'^(\d+)_(\w+)\.sql$', filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    migrations.sort()
+    return migrations
+
+def split_sql_statements(sql):
+    """Разбить текст миграции на отдельные операторы по ';'
+
+    Нужно для миграций без транзакции (CREATE INDEX CONCURRENTLY нельзя
+    выполнять в одном вызове с другими операторами). В таких файлах не
+    должно быть ';' внутри строк и тел функций.
+    """
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+async def get_schema_version():
+    """Текущая версия схемы (0 - миграции еще ни разу не применялись)"""
+    try:
+        async with get_db_connection() as conn:
+            cur = await conn.execute('SELECT MAX(version) AS version FROM schema_version')
+            row = await cur.fetchone()
+    except psycopg.errors.UndefinedTable:
+        return 0
+    return row['version'] or 0
+
+async def apply_migrations(migrations):
+    """Применить недостающие миграции под advisory lock
+
+    Используется отдельное подключение вне пула: advisory lock сессионный,
+    и пока одна реплика накатывает миграции, остальные ждут блокировку,
+    а потом видят уже обновленную версию и ничего не делают.
+    
+    Ждем через pg_try_advisory_lock, а не pg_advisory_lock: висящий в ожидании
+    запрос держит открытую транзакцию, и CREATE INDEX CONCURRENTLY у реплики,
+    которая накатывает миграцию, ждал бы ее - взаимная блокировка.
+    """
+    async with await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True, row_factory=dict_row) as conn:
+        while True:
+            cur = await conn.execute('SELECT pg_try_advisory_lock(%s) AS locked', (MIGRATIONS_LOCK_ID,))
+            if (await cur.fetchone())['locked']:
+                break
+            logging.info("Another process is applying migrations, waiting...")
+            await asyncio.sleep(1)
+        
+        try:
+            await conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+                version INT PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
+            )''')
+            
+            cur = await conn.execute('SELECT COALESCE(MAX(version), 0) AS version FROM schema_version')
+            current = (await cur.fetchone())['version']
+            
+            for version, name, path in migrations:
+                if version <= current:
+                    continue
+                
+                with open(path, encoding='utf-8') as f:
+                    sql = f.read()
+                
+                logging.info(f"Applying migration {version}_{name}...")
+                
+                if sql.startswith(MIGRATION_NO_TRANSACTION):
+                    # Операторы выполняются по одному в autocommit и должны быть идемпотентны:
+                    # при сбое посередине миграция повторится целиком
+                    for statement in split_sql_statements(sql):
+                        await conn.execute(statement)
+                    await conn.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)',
+                                       (version, name))
+                else:
+                    # Каждая миграция - в своей транзакции вместе с записью о версии
+                    async with conn.transaction():
+                        await conn.execute(sql)
+                        await conn.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)',
+                                           (version, name))
+                
+                logging.info(f"Migration {version}_{name} applied")
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_ID,))
+
+async def init_db():
+    """Проверка версии схемы и применение недостающих миграций
+
+    Обычный старт стоит одного запроса к schema_version.
+    """
+    migrations = load_migrations()
+    latest = migrations[-1][0] if migrations else 0
+    
+    version = await get_schema_version()
+    if version >= latest:
+        logging.info(f"Database schema is up to date (version {version})")
+        return
+    
+    logging.info(f"Database schema version {version}, latest {latest} - migrating")
+    await apply_migrations(migrations)
+    logging.info("Database initialized!")
+
+# ========================================
+# ФУНКЦИИ РАБОТЫ С БД (ОСНОВНЫЕ)
+# ========================================
+
+async def add_user(user_id, username):
+    """Добавление нового пользователя
+
+    Вызывается из /start: если пользователь раньше заблокировал бота,
+    раз он снова пишет - пометка bot_blocked снимается.
+    """
+    async with get_db_connection() as conn:
+        await conn.execute('''INSERT INTO users (user_id, username, started_at, created_at)
+                              VALUES (%s, %s, %s, %s)
+                              ON CONFLICT (user_id) DO UPDATE SET bot_blocked = FALSE
+                              WHERE users.bot_blocked''',
+                           (user_id, username, datetime.now(), datetime.now()))
+
+async def get_user(user_id):
     """Получение данных пользователя"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
-    return user
-
-def mark_user_blocked(user_id, blocked=True):
-    """Пометить пользователя как заблокировавшего бота"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('UPDATE users SET bot_blocked = %s WHERE user_id = %s', (blocked, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with get_db_connection() as conn:
+        cur = await conn.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
+        return await cur.fetchone()
+
+# Сколько отправок пропущено из-за bot_blocked с запуска бота - для /stats
+blocked_suppression_stats = {'reminders': 0, 'outbox': 0}
+
+async def mark_user_blocked(user_id, blocked=True):
+    """Пометить пользователя как заблокировавшего бота
+
+    Таким получателям ничего не отправляют: правила напоминаний их
+    пропускают, а уже поставленные задачи outbox архивируются без отправки.
+    """
+    async with get_db_connection() as conn:
+        await conn.execute('UPDATE users SET bot_blocked = %s WHERE user_id = %s', (blocked, user_id))
+
+async def set_user_timezone(user_id, timezone):
+    """Сохранить часовой пояс пользователя и пересчитать время его напоминаний
+
+    timezone - название пояса (Asia/Yekaterinburg) или смещение от UTC
+    (+5, UTC+5). Возвращает каноническое название пояса или None, если
+    такого пояса Postgres не знает.
+    """
+    offset = re.fullmatch(r'(?:UTC|GMT)?\s*([+-]\d{1,2})', timezone.strip(), re.IGNORECASE)
+    if offset:
+        # В поясах Etc/GMT знак обратный: Etc/GMT-5 - это UTC+5
+        timezone = f"Etc/GMT{-int(offset.group(1)):+d}"
+    
+    async with get_db_connection() as conn:
+        cur = await conn.execute('SELECT name FROM pg_timezone_names WHERE lower(name) = lower(%s)',
+                                 (timezone.strip(),))
+        row = await cur.fetchone()
+        if row is None:
+            return None
+        
+        await conn.execute('UPDATE users SET timezone = %s WHERE user_id = %s', (row['name'], user_id))
+        await schedule_next_reminder(conn, user_id)
+    
+    # next_action_at в кэше прогресса устарел - перечитаем при следующем обращении
+    progress_cache.evict(user_id)
+    return row['name']
 
 # ========================================
 # ФУНКЦИИ РАБОТЫ С ЧЕЛЛЕНДЖЕМ
@@ -266,190 +574,397 @@ def determine_age_category(age):
     else:  # 7+ лет
         return '5-7'
 
-def start_challenge(user_id, age):
+class ProgressCache:
+    """LRU-кэш прогресса челленджа по user_id с ограничением размера и TTL
+
+    Кэшируется и отсутствие прогресса (None). Хелперы, которые пишут прогресс,
+    сразу обновляют запись в кэше (write-through), поэтому повторные нажатия
+    кнопок одним пользователем не ходят в Postgres. Изменения в обход этих
+    хелперов (или другой репликой) видны не позже чем через TTL, поэтому
+    чтение перед записью (get_challenge_progress(fresh=True)) идет в БД.
+    ttl <= 0 - кэш выключен.
+    """
+    
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, user_id):
+        """(найдено, прогресс)"""
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return True, dict(entry[1]) if entry[1] is not None else None
+    
+    def put(self, user_id, progress, version=None):
+        """Положить прогресс; version - значение self.version до чтения из БД
+
+        Если с начала чтения в кэш что-то записали, прочитанное могло устареть
+        и не кладется.
+        """
+        if self.ttl <= 0 or (version is not None and version != self.version):
+            return
+        self.version += 1
+        self.entries[user_id] = (time.monotonic() + self.ttl, progress)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    
+    def update(self, user_id, fields):
+        self.version += 1
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[1] is not None:
+            entry[1].update(fields)
+    
+    def evict(self, user_id):
+        self.version += 1
+        self.entries.pop(user_id, None)
+    
+    def get_stats(self):
+        return {'size': len(self.entries), 'max': self.max_size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+progress_cache = ProgressCache(PROGRESS_CACHE_SIZE, PROGRESS_CACHE_TTL)
+
+def write_through_progress(user_id, **fields):
+    """Отразить запись прогресса в кэше; при откате транзакции запись выкидывается"""
+    progress_cache.update(user_id, fields)
+    on_db_rollback(lambda: progress_cache.evict(user_id))
+
+async def start_challenge(user_id, age):
     """Начать челлендж для пользователя"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     category = determine_age_category(age)
+    now = datetime.now()
+    
+    async with get_db_connection() as conn:
+        await conn.execute('''INSERT INTO challenge_progress 
+                              (user_id, age, age_category, started_at)
+                              VALUES (%s, %s, %s, %s)
+                              ON CONFLICT (user_id) 
+                              DO UPDATE SET age = %s, age_category = %s, started_at = %s, is_active = TRUE''',
+                           (user_id, age, category, now, age, category, now))
+        
+        # День 1 открыт с момента старта
+        await conn.execute('''INSERT INTO challenge_day_results (user_id, day, unlocked_at)
+                              VALUES (%s, 1, %s)
+                              ON CONFLICT (user_id, day) DO UPDATE SET unlocked_at = EXCLUDED.unlocked_at''',
+                           (user_id, now))
+        
+        await schedule_next_reminder(conn, user_id)
+        
+        # При повторном старте часть полей остается от прошлого прогресса -
+        # кладем в кэш то, что реально лежит в БД
+        progress = await fetch_challenge_progress(conn, user_id)
+    
+    progress_cache.put(user_id, progress)
+    on_db_rollback(lambda: progress_cache.evict(user_id))
+
+def reminder_slot_sql(tz_sql, user_id_sql):
+    """Выборка (next_action_at, next_action) ближайшего слота напоминания участника"""
+    return f'''SELECT slot.at, slot.action
+                FROM next_reminder_slot({tz_sql}, NOW(), %(morning)s, %(evening)s,
+                                        make_interval(secs => {user_id_sql} %% %(spread)s)) slot'''
+
+def reminder_slot_params():
+    return {
+        'default_tz': DEFAULT_TIMEZONE,
+        'morning': MORNING_TIME,
+        'evening': EVENING_TIME,
+        'spread': max(REMINDER_SPREAD_MINUTES * 60, 1)
+    }
+
+async def schedule_next_reminder(conn, user_id):
+    """Назначить участнику ближайшее утреннее или вечернее напоминание
+
+    Время считается по его часовому поясу (users.timezone или DEFAULT_TIMEZONE).
+    Если ни одно правило дней ему уже не напомнит, next_action_at = NULL.
+    Возвращает новые (next_action_at, next_action) или None, если участник
+    не проходит челлендж.
+    """
+    tz_sql = "COALESCE((SELECT timezone FROM users u WHERE u.user_id = cp.user_id), %(default_tz)s)"
+    cur = await conn.execute(f'''UPDATE challenge_progress cp
+                                 SET (next_action_at, next_action) = (
+                                     {reminder_slot_sql(tz_sql, 'cp.user_id')}
+                                     WHERE {reminder_pending_sql(tz_sql, 'cp.user_id')}
+                                 )
+                                 WHERE cp.user_id = %(user_id)s AND cp.is_active = TRUE
+                                 RETURNING cp.next_action_at, cp.next_action''',
+                             {**reminder_slot_params(), 'user_id': user_id})
+    return await cur.fetchone()
+
+def build_challenge_progress(rows):
+    """Собрать прогресс из строки challenge_progress и строк challenge_day_results
+
+    Результаты дней раскладываются в ключи dayN_completed, dayN_time,
+    dayN_difficulty, dayN_completed_at - в том виде, в каком их читают хэндлеры.
+    """
+    if not rows:
+        return None
+    
+    progress = {key: value for key, value in rows[0].items() if not key.startswith('result_')}
+    for day in range(1, CHALLENGE_DAYS + 1):
+        progress[f'day{day}_completed'] = False
+        progress[f'day{day}_time'] = None
+        progress[f'day{day}_difficulty'] = None
+        progress[f'day{day}_completed_at'] = None
+    
+    for row in rows:
+        day = row['result_day']
+        if day is None:
+            continue
+        progress[f'day{day}_completed'] = row['result_completed']
+        progress[f'day{day}_time'] = row['result_time']
+        progress[f'day{day}_difficulty'] = row['result_difficulty']
+        progress[f'day{day}_completed_at'] = row['result_completed_at']
     
-    cur.execute('''INSERT INTO challenge_progress 
-                   (user_id, age, age_category, started_at)
-                   VALUES (%s, %s, %s, %s)
-                   ON CONFLICT (user_id) 
-                   DO UPDATE SET age = %s, age_category = %s, started_at = %s, is_active = TRUE''',
-                (user_id, age, category, datetime.now(), age, category, datetime.now()))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def get_challenge_progress(user_id):
-    """Получить прогресс челленджа пользователя"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM challenge_progress WHERE user_id = %s', (user_id,))
-    progress = cur.fetchone()
-    cur.close()
-    conn.close()
     return progress
 
-def update_challenge_day(user_id, day, time_spent, difficulty=None):
-    """Обновить данные по дню челленджа"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    if day == 1:
-        if difficulty:
-            cur.execute('''UPDATE challenge_progress 
-                           SET day1_completed = TRUE, day1_time = %s, 
-                               day1_difficulty = %s, day1_completed_at = %s, current_day = 2
-                           WHERE user_id = %s''',
-                        (time_spent, difficulty, datetime.now(), user_id))
+async def fetch_challenge_progress(conn, user_id):
+    """Прочитать прогресс из БД в рамках переданного подключения"""
+    cur = await conn.execute('''SELECT cp.*, d.day AS result_day, d.completed AS result_completed,
+                                           d.completed_at AS result_completed_at, d.time_spent AS result_time,
+                                           d.difficulty AS result_difficulty
+                                    FROM challenge_progress cp
+                                    LEFT JOIN challenge_day_results d ON d.user_id = cp.user_id
+                                    WHERE cp.user_id = %s
+                                    ORDER BY d.day''',
+                             (user_id,))
+    return build_challenge_progress(await cur.fetchall())
+
+async def get_challenge_progress(user_id, fresh=False):
+    """Получить прогресс челленджа пользователя
+
+    fresh=True - прочитать из БД в обход кэша: для данных, которые пойдут
+    в запись или которые могла поменять другая реплика.
+    """
+    if not fresh:
+        found, progress = progress_cache.get(user_id)
+        if found:
+            return progress
+    
+    version = progress_cache.version
+    async with get_db_connection() as conn:
+        progress = await fetch_challenge_progress(conn, user_id)
+    
+    progress_cache.put(user_id, progress, version)
+    return dict(progress) if progress is not None else None
+
+async def update_challenge_day(user_id, day, time_spent, difficulty=None):
+    """Обновить данные по дню челленджа
+
+    Время и сложность, если не переданы (None), остаются прежними.
+    """
+    now = datetime.now()
+    
+    async with get_db_connection() as conn:
+        # Время дня 1 сохранено раньше (save_day_time), сложность спрашиваем не всегда
+        cur = await conn.execute('''INSERT INTO challenge_day_results
+                                    (user_id, day, unlocked_at, completed, completed_at, time_spent, difficulty)
+                                    VALUES (%s, %s, %s, TRUE, %s, %s, %s)
+                                    ON CONFLICT (user_id, day) DO UPDATE
+                                    SET completed = TRUE, completed_at = EXCLUDED.completed_at,
+                                        time_spent = COALESCE(EXCLUDED.time_spent, challenge_day_results.time_spent),
+                                        difficulty = COALESCE(EXCLUDED.difficulty, challenge_day_results.difficulty)
+                                    RETURNING time_spent, difficulty''',
+                                 (user_id, day, now, now, time_spent, difficulty))
+        saved = await cur.fetchone()
+        
+        if day < CHALLENGE_DAYS:
+            # Открываем следующий день
+            await conn.execute('''INSERT INTO challenge_day_results (user_id, day, unlocked_at)
+                                  VALUES (%s, %s, %s)
+                                  ON CONFLICT (user_id, day) DO NOTHING''',
+                               (user_id, day + 1, now))
+            await conn.execute('UPDATE challenge_progress SET current_day = %s WHERE user_id = %s',
+                               (day + 1, user_id))
+            # Расписание могло остановиться, пока участник не проходил день
+            slot = await schedule_next_reminder(conn, user_id)
         else:
-            cur.execute('''UPDATE challenge_progress 
-                           SET day1_completed = TRUE, day1_time = %s, 
-                               day1_completed_at = %s, current_day = 2
-                           WHERE user_id = %s''',
-                        (time_spent, datetime.now(), user_id))
-    elif day == 2:
-        cur.execute('''UPDATE challenge_progress 
-                       SET day2_completed = TRUE, day2_time = %s, 
-                           day2_completed_at = %s, current_day = 3
-                       WHERE user_id = %s''',
-                    (time_spent, datetime.now(), user_id))
-    elif day == 3:
-        cur.execute('''UPDATE challenge_progress 
-                       SET day3_completed = TRUE, day3_time = %s, 
-                           day3_completed_at = %s, completed_at = %s, is_active = FALSE
-                       WHERE user_id = %s''',
-                    (time_spent, datetime.now(), datetime.now(), user_id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def change_age_category(user_id, new_category):
-    """Сменить категорию возраста"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+            # Челлендж пройден - дальше шаги воронки продаж
+            funnel_action, funnel_hours = FUNNEL_STEPS[0]
+            funnel_at = now + timedelta(hours=funnel_hours)
+            await conn.execute('''UPDATE challenge_progress 
+                                  SET completed_at = %s, is_active = FALSE, next_action_at = %s, next_action = %s
+                                  WHERE user_id = %s''',
+                               (now, funnel_at, funnel_action, user_id))
+    
+    fields = {f'day{day}_completed': True, f'day{day}_completed_at': now,
+              f'day{day}_time': saved['time_spent'], f'day{day}_difficulty': saved['difficulty']}
+    if day < CHALLENGE_DAYS:
+        fields['current_day'] = day + 1
+        if slot is not None:
+            fields.update(slot)
+    else:
+        fields.update(completed_at=now, is_active=False, next_action_at=funnel_at, next_action=funnel_action)
+    write_through_progress(user_id, **fields)
+
+async def save_day_time(user_id, day, time_spent):
+    """Сохранить время дня до того, как день будет завершен"""
+    async with get_db_connection() as conn:
+        await conn.execute('UPDATE challenge_day_results SET time_spent = %s WHERE user_id = %s AND day = %s',
+                           (time_spent, user_id, day))
     
-    # Сохраняем оригинальную категорию если это первая смена
-    cur.execute('''UPDATE challenge_progress 
-                   SET age_category = %s, category_changed = TRUE
-                   WHERE user_id = %s''',
-                (new_category, user_id))
+    write_through_progress(user_id, **{f'day{day}_time': time_spent})
+
+async def change_age_category(user_id, new_category):
+    """Сменить категорию возраста"""
+    async with get_db_connection() as conn:
+        # Сохраняем оригинальную категорию если это первая смена
+        await conn.execute('''UPDATE challenge_progress 
+                              SET age_category = %s, category_changed = TRUE
+                              WHERE user_id = %s''',
+                           (new_category, user_id))
+    
+    write_through_progress(user_id, age_category=new_category, category_changed=True)
+
+class MaterialsCatalog:
+    """Материалы челленджа в памяти процесса
+
+    Комбинаций категория/день всего девять, и меняются они только командами
+    админа, поэтому весь каталог читается из БД одним запросом и дальше
+    отдается без обращения к БД. save_material и /delete_material
+    сбрасывают каталог после коммита; MATERIALS_CACHE_TTL - страховка
+    от изменений в обход бота.
+    """
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.materials = {}
+        self.loaded_at = None
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self._lock = asyncio.Lock()
+    
+    def is_fresh(self):
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+    
+    async def load(self):
+        """Перечитать каталог из БД (если его не перечитал параллельный вызов)"""
+        async with self._lock:
+            if self.is_fresh():
+                return
+            
+            version = self.version
+            async with get_db_connection() as conn:
+                cur = await conn.execute('''SELECT * FROM challenge_materials
+                                            ORDER BY age_category, day, variant''')
+                rows = await cur.fetchall()
+            
+            materials = {}
+            for row in rows:
+                materials.setdefault((row['age_category'], row['day']), []).append(row)
+            self.materials = materials
+            self.reloads += 1
+            
+            # Если каталог сбросили во время чтения - данные могли устареть
+            if version == self.version:
+                self.loaded_at = time.monotonic()
+            logging.info(f"Materials catalog loaded: {len(rows)} materials")
+    
+    def invalidate(self):
+        self.version += 1
+        self.loaded_at = None
+    
+    async def get(self, age_category, day):
+        if self.is_fresh():
+            self.hits += 1
+        else:
+            self.misses += 1
+            await self.load()
+        return list(self.materials.get((age_category, day), []))
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'reloads': self.reloads,
+                'materials': sum(len(items) for items in self.materials.values())}
+
+materials_catalog = MaterialsCatalog(MATERIALS_CACHE_TTL)
 
-def get_challenge_materials(age_category, day):
+async def get_challenge_materials(age_category, day):
     """Получить материалы для дня челленджа"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''SELECT * FROM challenge_materials 
-                   WHERE age_category = %s AND day = %s
-                   ORDER BY variant''',
-                (age_category, day))
-    materials = cur.fetchall()
-    cur.close()
-    conn.close()
-    return materials
-
-def is_challenge_participant(user_id):
+    return await materials_catalog.get(age_category, day)
+
+async def is_challenge_participant(user_id):
     """Проверить является ли пользователь участником челленджа"""
-    progress = get_challenge_progress(user_id)
+    progress = await get_challenge_progress(user_id)
     if progress and progress.get('day3_completed'):
         return True
     return False
 
-def save_material(age_category, day, variant, title, description, file_id, file_type):
+async def save_material(age_category, day, variant, title, description, file_id, file_type):
     """Сохранить материал в БД"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Проверяем существует ли уже такой материал
-    cur.execute('''SELECT id FROM challenge_materials 
-                   WHERE age_category = %s AND day = %s AND variant = %s''',
-                (age_category, day, variant))
-    
-    existing = cur.fetchone()
-    
-    if existing:
-        # Обновляем существующий
-        cur.execute('''UPDATE challenge_materials 
-                       SET title = %s, description = %s, file_id = %s, file_type = %s
-                       WHERE age_category = %s AND day = %s AND variant = %s''',
-                    (title, description, file_id, file_type, age_category, day, variant))
-        result = "updated"
-    else:
-        # Создаём новый
-        cur.execute('''INSERT INTO challenge_materials 
-                       (age_category, day, variant, title, description, file_id, file_type)
-                       VALUES (%s, %s, %s, %s, %s, %s, %s)''',
-                    (age_category, day, variant, title, description, file_id, file_type))
-        result = "created"
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    
+    async with get_db_connection() as conn:
+        # Проверяем существует ли уже такой материал
+        cur = await conn.execute('''SELECT id FROM challenge_materials 
+                                    WHERE age_category = %s AND day = %s AND variant = %s''',
+                                 (age_category, day, variant))
+        
+        existing = await cur.fetchone()
+        
+        if existing:
+            # Обновляем существующий
+            await conn.execute('''UPDATE challenge_materials 
+                                  SET title = %s, description = %s, file_id = %s, file_type = %s
+                                  WHERE age_category = %s AND day = %s AND variant = %s''',
+                               (title, description, file_id, file_type, age_category, day, variant))
+            result = "updated"
+        else:
+            # Создаём новый
+            await conn.execute('''INSERT INTO challenge_materials 
+                                  (age_category, day, variant, title, description, file_id, file_type)
+                                  VALUES (%s, %s, %s, %s, %s, %s, %s)''',
+                               (age_category, day, variant, title, description, file_id, file_type))
+            result = "created"
+    
+    on_db_commit(materials_catalog.invalidate)
     return result
 
-def create_promo_code(code, discount_percent, valid_hours, description):
+async def create_promo_code(code, discount_percent, valid_hours, description):
     """Создать промокод"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute('''INSERT INTO promo_codes (code, discount_percent, valid_hours, description)
-                   VALUES (%s, %s, %s, %s)
-                   ON CONFLICT (code) DO UPDATE 
-                   SET discount_percent = %s, valid_hours = %s, description = %s''',
-                (code, discount_percent, valid_hours, description, discount_percent, valid_hours, description))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def check_promo_code(user_id, code):
+    async with get_db_connection() as conn:
+        await conn.execute('''INSERT INTO promo_codes (code, discount_percent, valid_hours, description)
+                              VALUES (%s, %s, %s, %s)
+                              ON CONFLICT (code) DO UPDATE 
+                              SET discount_percent = %s, valid_hours = %s, description = %s''',
+                           (code, discount_percent, valid_hours, description, discount_percent, valid_hours, description))
+
+async def check_promo_code(user_id, code):
     """Проверить промокод"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Проверяем существует ли промокод
-    cur.execute('SELECT * FROM promo_codes WHERE code = %s', (code,))
-    promo = cur.fetchone()
-    
-    if not promo:
-        cur.close()
-        conn.close()
-        return None
-    
-    # Проверяем не использовал ли уже
-    cur.execute('SELECT * FROM promo_usage WHERE user_id = %s AND promo_code = %s', (user_id, code))
-    used = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    async with get_db_connection() as conn:
+        # Проверяем существует ли промокод
+        cur = await conn.execute('SELECT * FROM promo_codes WHERE code = %s', (code,))
+        promo = await cur.fetchone()
+        
+        if not promo:
+            return None
+        
+        # Проверяем не использовал ли уже
+        cur = await conn.execute('SELECT * FROM promo_usage WHERE user_id = %s AND promo_code = %s', (user_id, code))
+        used = await cur.fetchone()
     
     if used:
         return {'error': 'already_used'}
     
     return promo
 
-def use_promo_code(user_id, code):
+async def use_promo_code(user_id, code):
     """Отметить промокод как использованный"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute('''INSERT INTO promo_usage (user_id, promo_code)
-                   VALUES (%s, %s)''',
-                (user_id, code))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with get_db_connection() as conn:
+        # Повторное использование нарушит UNIQUE - откатываем только эту запись
+        async with conn.transaction():
+            await conn.execute('''INSERT INTO promo_usage (user_id, promo_code)
+                                  VALUES (%s, %s)''',
+                               (user_id, code))
 
 # ========================================
 # КЛАВИАТУРЫ ДЛЯ ЧЕЛЛЕНДЖА
@@ -538,6 +1053,199 @@ def get_variant_keyboard():
     ])
     return keyboard
 
+# ========================================
+# ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ К TELEGRAM
+# ========================================
+
+class TokenBucket:
+    """Маркерная корзина: rate маркеров в секунду, запас не больше capacity"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def reserve(self, cost=1):
+        """Забрать cost маркеров и вернуть, сколько секунд ждать, пока они накопятся
+
+        Маркеры забираются сразу (баланс может уйти в минус), поэтому
+        параллельные отправки выстраиваются в очередь с шагом 1/rate,
+        а не просыпаются одновременно.
+        """
+        self.refill()
+        self.tokens -= cost
+        return max(0.0, -self.tokens / self.rate)
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """Общий ограничитель исходящих сообщений: корзина на бота и на каждый чат
+
+    Подключается к сессии бота, поэтому через него проходят и рассылки,
+    и ответы хэндлеров. Ограничиваются только методы, которые отправляют
+    или меняют сообщения (статус «печатает» - не сообщение и лимитом не
+    считается); альбом стоит столько маркеров, сколько в нем элементов. Если Telegram все же ответил retry_after, новые отправки
+    ждут указанное время, общий лимит снижается вдвое и потом раз в минуту
+    возвращается к TELEGRAM_GLOBAL_RATE, а запрос повторяется.
+    """
+    
+    LIMITED_METHOD_PREFIXES = ('Send', 'Copy', 'Forward', 'Edit')
+    UNLIMITED_METHODS = ('SendChatAction',)
+    RATE_RECOVERY_SECONDS = 60
+    MAX_CHAT_BUCKETS = 10000
+    
+    def __init__(self, global_rate, chat_rate, chat_burst, max_retries):
+        self.global_rate = global_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.max_retries = max_retries
+        self.paused_until = 0.0
+        self.rate_changed_at = 0.0
+        self.stats = {'requests': 0, 'throttled': 0, 'wait_seconds': 0.0, 'retry_after': 0}
+    
+    def method_cost(self, method):
+        name = type(method).__name__
+        if name in self.UNLIMITED_METHODS or not name.startswith(self.LIMITED_METHOD_PREFIXES):
+            return 0
+        media = getattr(method, 'media', None)
+        return len(media) if isinstance(media, list) else 1
+    
+    def get_chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                # Выкидываем корзины простаивающих чатов - они и так полные
+                for idle_chat_id, idle_bucket in list(self.chat_buckets.items()):
+                    idle_bucket.refill()
+                    if idle_bucket.tokens >= idle_bucket.capacity:
+                        del self.chat_buckets[idle_chat_id]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    
+    def recover_rate(self):
+        bucket = self.global_bucket
+        now = time.monotonic()
+        if bucket.rate < self.global_rate and now - self.rate_changed_at >= self.RATE_RECOVERY_SECONDS:
+            bucket.refill()
+            bucket.rate = min(self.global_rate, bucket.rate * 1.25)
+            self.rate_changed_at = now
+    
+    async def acquire(self, chat_id, cost):
+        self.stats['requests'] += 1
+        self.recover_rate()
+        
+        wait = self.global_bucket.reserve(cost)
+        if chat_id is not None:
+            wait = max(wait, self.get_chat_bucket(chat_id).reserve(cost))
+        
+        if wait > 0:
+            self.stats['throttled'] += 1
+            self.stats['wait_seconds'] += wait
+            await asyncio.sleep(wait)
+        
+        # Запросы, которые уже ждали своей очереди, когда пришел retry_after
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            self.stats['wait_seconds'] += pause
+            await asyncio.sleep(pause)
+    
+    def on_retry_after(self, retry_after):
+        self.stats['retry_after'] += 1
+        bucket = self.global_bucket
+        bucket.refill()
+        bucket.rate = max(1.0, bucket.rate / 2)
+        # Долг в retry_after секунд: новые отправки встанут в очередь после паузы
+        bucket.tokens = min(bucket.tokens, 0.0) - retry_after * bucket.rate
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        self.rate_changed_at = time.monotonic()
+        logging.info(f"Telegram flood control: retry after {retry_after}s, global rate lowered to {bucket.rate:.1f} msg/s")
+    
+    async def __call__(self, make_request, bot, method):
+        cost = self.method_cost(method)
+        if not cost:
+            return await make_request(bot, method)
+        
+        chat_id = getattr(method, 'chat_id', None)
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(chat_id, cost)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.on_retry_after(e.retry_after)
+                if attempt == self.max_retries:
+                    raise
+    
+    def get_stats(self):
+        return {**self.stats, 'rate': self.global_bucket.rate, 'chats': len(self.chat_buckets)}
+
+telegram_rate_limiter = TelegramRateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE,
+                                            TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRIES)
+
+# ========================================
+# ОТПРАВКА МАТЕРИАЛОВ
+# ========================================
+
+def build_material_caption(material):
+    """Подпись к материалу с экранированными названием и описанием"""
+    caption = f"📄 <b>{escape_html(material['title'])}</b>"
+    description = escape_html(material.get('description'))
+    if description:
+        caption += f"\n\n{description}"
+    return caption
+
+async def send_material(user_id, material):
+    """Отправить один материал отдельным сообщением"""
+    caption = build_material_caption(material)
+    if material['file_type'] == 'photo':
+        await bot.send_photo(user_id, material['file_id'], caption=caption, parse_mode="HTML")
+    elif material['file_type'] == 'document':
+        await bot.send_document(user_id, material['file_id'], caption=caption, parse_mode="HTML")
+
+async def send_day_materials(user_id, materials):
+    """Отправить материалы дня альбомами: фото и документы отдельно
+
+    Telegram не смешивает фото и документы в одном альбоме, а в альбоме
+    не больше 10 элементов - поэтому день из 3 вариантов уходит одним-двумя
+    запросами. Если Telegram отклонил альбом (например, один из file_id
+    больше недействителен), материалы этого альбома отправляются по одному.
+    """
+    groups = [
+        ([m for m in materials if m['file_type'] == 'photo'], types.InputMediaPhoto),
+        ([m for m in materials if m['file_type'] == 'document'], types.InputMediaDocument),
+    ]
+    
+    for group, media_type in groups:
+        for start in range(0, len(group), 10):
+            chunk = group[start:start + 10]
+            
+            if len(chunk) == 1:
+                try:
+                    await send_material(user_id, chunk[0])
+                except Exception as e:
+                    logging.error(f"Error sending material: {e}")
+                continue
+            
+            try:
+                await bot.send_media_group(user_id, [
+                    media_type(media=m['file_id'], caption=build_material_caption(m), parse_mode="HTML")
+                    for m in chunk
+                ])
+            except TelegramBadRequest as e:
+                logging.error(f"Media group rejected for user {user_id}, sending one by one: {e}")
+                for material in chunk:
+                    try:
+                        await send_material(user_id, material)
+                    except Exception as e:
+                        logging.error(f"Error sending material: {e}")
+            except Exception as e:
+                logging.error(f"Error sending materials: {e}")
+
 # ========================================
 # ХЭНДЛЕРЫ ЧЕЛЛЕНДЖА
 # ========================================
@@ -549,10 +1257,10 @@ async def cmd_start(message: types.Message, state: FSMContext):
     username = message.from_user.username or "unknown"
     
     # Добавляем пользователя в БД
-    add_user(user_id, username)
+    await add_user(user_id, username)
     
     # Проверяем есть ли уже прогресс в челлендже
-    progress = get_challenge_progress(user_id)
+    progress = await get_challenge_progress(user_id)
     
     if progress and progress.get('is_active'):
         # Челлендж уже идет
@@ -568,7 +1276,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
     
     # Проверяем завершен ли челлендж
     if progress and progress.get('day3_completed'):
-        user = get_user(user_id)
+        user = await get_user(user_id)
         # Проверяем есть ли активная подписка
         if user and user.get('subscription_until'):
             if datetime.now() < user['subscription_until']:
@@ -608,6 +1316,30 @@ async def cmd_start(message: types.Message, state: FSMContext):
     
     await state.set_state(ChallengeStates.CHOOSING_AGE)
 
+@dp.message(Command("timezone"))
+async def cmd_timezone(message: types.Message):
+    """Часовой пояс для утренних и вечерних напоминаний: /timezone Asia/Yekaterinburg или /timezone +5"""
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        user = await get_user(message.from_user.id)
+        current = (user or {}).get('timezone') or DEFAULT_TIMEZONE
+        await message.answer(
+            f"🕘 Напоминания приходят в {MORNING_TIME} и {EVENING_TIME} по вашему времени.\n"
+            f"Сейчас часовой пояс: <b>{escape_html(current)}</b>\n\n"
+            "Чтобы изменить, отправьте, например:\n"
+            "/timezone Asia/Yekaterinburg\n"
+            "или смещение от UTC: /timezone +5",
+            parse_mode="HTML"
+        )
+        return
+    
+    timezone = await set_user_timezone(message.from_user.id, parts[1])
+    if timezone is None:
+        await message.answer("❌ Не нашел такой часовой пояс. Пример: /timezone Europe/Moscow или /timezone +3")
+        return
+    
+    await message.answer(f"✅ Часовой пояс сохранен: {escape_html(timezone)}", parse_mode="HTML")
+
 @dp.callback_query(F.data.startswith("age_"), StateFilter(ChallengeStates.CHOOSING_AGE))
 async def process_age_selection(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора возраста"""
@@ -618,7 +1350,7 @@ async def process_age_selection(callback: types.CallbackQuery, state: FSMContext
     category = determine_age_category(age)
     
     # Сохраняем в БД
-    start_challenge(user_id, age)
+    await start_challenge(user_id, age)
     
     # Формируем текст в зависимости от категории
     category_text = {
@@ -646,7 +1378,7 @@ async def process_age_selection(callback: types.CallbackQuery, state: FSMContext
 async def start_day1(callback: types.CallbackQuery):
     """Начало Дня 1"""
     user_id = callback.from_user.id
-    progress = get_challenge_progress(user_id)
+    progress = await get_challenge_progress(user_id)
     
     if not progress:
         await callback.answer("Ошибка! Начните с /start", show_alert=True)
@@ -655,7 +1387,7 @@ async def start_day1(callback: types.CallbackQuery):
     category = progress['age_category']
     
     # Получаем материалы для этой категории
-    materials = get_challenge_materials(category, 1)
+    materials = await get_challenge_materials(category, 1)
     
     # Формируем список вариантов
     if category == '3-5':
@@ -693,22 +1425,14 @@ async def start_day1(callback: types.CallbackQuery):
     
     await callback.message.edit_text(text, parse_mode="HTML")
     
+    # Отвечаем на нажатие сразу, не дожидаясь отправки материалов
+    await callback.answer()
+    
+    # Дальше только запросы к Telegram API - не держим подключение к БД
+    await release_db_connection()
+    
     # Отправляем материалы
-    if materials:
-        for material in materials:
-            try:
-                caption = f"📄 <b>{material['title']}</b>"
-                if material.get('description'):
-                    caption += f"\n\n{material['description']}"
-                
-                if material['file_type'] == 'photo':
-                    await bot.send_photo(user_id, material['file_id'], caption=caption, parse_mode="HTML")
-                elif material['file_type'] == 'document':
-                    await bot.send_document(user_id, material['file_id'], caption=caption, parse_mode="HTML")
-                
-                await asyncio.sleep(0.5)
-            except Exception as e:
-                logging.error(f"Error sending material: {e}")
+    await send_day_materials(user_id, materials)
     
     # Отправляем кнопки завершения
     await bot.send_message(
@@ -716,8 +1440,6 @@ async def start_day1(callback: types.CallbackQuery):
         "Выполнили задание?",
         reply_markup=get_day_completed_keyboard_new(1)
     )
-    
-    await callback.answer()
 
 @dp.callback_query(F.data == "day1_done")
 async def day1_completed(callback: types.CallbackQuery):
@@ -743,13 +1465,7 @@ async def day1_time_selected(callback: types.CallbackQuery):
     )
     
     # Сохраняем время в БД временно
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('UPDATE challenge_progress SET day1_time = %s WHERE user_id = %s', 
-                (time_value, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    await save_day_time(user_id, 1, time_value)
     
     await callback.answer()
 
@@ -759,11 +1475,11 @@ async def day1_difficulty_selected(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     difficulty = callback.data.replace("diff_", "")
     
-    progress = get_challenge_progress(user_id)
-    time_spent = progress.get('day1_time')
+    # Категория нужна для предложения ниже: кэш мог отстать от другой реплики
+    progress = await get_challenge_progress(user_id, fresh=True)
     
-    # Обновляем БД
-    update_challenge_day(user_id, 1, time_spent, difficulty)
+    # Обновляем БД; время уже сохранено при выборе (save_day_time)
+    await update_challenge_day(user_id, 1, None, difficulty)
     
     # В зависимости от сложности - предлагаем смену категории или просто хвалим
     if difficulty == 'easy':
@@ -856,6 +1572,15 @@ def escape_html(text):
         return text
     return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
+def format_duration(seconds):
+    """Длительность в секундах как '2 ч 5 мин' / '5 мин' / '40 сек'"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин"
+    return f"{seconds} сек"
+
 def format_time(time_value):
     """Форматировать время для отображения"""
     if not time_value:
@@ -871,496 +1596,819 @@ def format_time(time_value):
             return new
     return time_value
 
-async def send_day2_reminders():
-    """Отправка напоминаний о Дне 2"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Находим пользователей, которые завершили День 1 и ещё не получили напоминание
-    cur.execute('''
-        SELECT user_id, age_category 
-        FROM challenge_progress 
-        WHERE day1_completed = TRUE 
-        AND day2_completed = FALSE
-        AND day2_reminder_sent = FALSE
-        AND DATE(day1_completed_at) < CURRENT_DATE
-        AND is_active = TRUE
-    ''')
-    
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    logging.info(f"Found {len(users)} users for Day 2 reminders")
-    
-    for user in users:
-        try:
-            user_id = user['user_id']
-            category = user['age_category']
-            
-            # Получаем материалы
-            materials = get_challenge_materials(category, 2)
-            
-            text = (
-                "☀️ <b>Доброе утро!</b>\n\n"
-                "🎯 <b>ДЕНЬ 2: Развитие концентрации</b>\n\n"
-                "Вчера отлично! Сегодня продолжим! 💪\n\n"
-                "Готовы к новым заданиям?"
-            )
-            
-            await bot.send_message(
-                user_id,
-                text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🚀 Начать День 2!", callback_data="start_day2")]
-                ]),
-                parse_mode="HTML"
-            )
-            
-            # Отмечаем что напоминание отправлено
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute('''UPDATE challenge_progress 
-                          SET day2_reminder_sent = TRUE 
-                          WHERE user_id = %s''', (user_id,))
-            conn.commit()
-            cur.close()
-            conn.close()
-            
-        except TelegramForbiddenError:
-            mark_user_blocked(user_id, True)
-        except Exception as e:
-            logging.error(f"Error sending Day 2 reminder to {user_id}: {e}")
-        
-        await asyncio.sleep(0.5)
-
-async def send_day3_reminders():
-    """Отправка напоминаний о Дне 3"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        SELECT user_id, age_category 
-        FROM challenge_progress 
-        WHERE day2_completed = TRUE 
-        AND day3_completed = FALSE
-        AND day3_reminder_sent = FALSE
-        AND DATE(day2_completed_at) < CURRENT_DATE
-        AND is_active = TRUE
-    ''')
-    
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
-    
-    logging.info(f"Found {len(users)} users for Day 3 reminders")
-    
-    for user in users:
-        try:
-            user_id = user['user_id']
-            
-            text = (
-                "☀️ <b>Доброе утро!</b>\n\n"
-                "🎯 <b>ДЕНЬ 3: Финальный рывок!</b>\n\n"
-                "Сегодня последний день челленджа! 🏆\n\n"
-                "После этого вас ждёт специальное предложение! 💎\n\n"
-                "Готовы завершить челлендж?"
-            )
-            
-            await bot.send_message(
-                user_id,
-                text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🚀 Начать День 3!", callback_data="start_day3")]
-                ]),
-                parse_mode="HTML"
-            )
-            
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute('''UPDATE challenge_progress 
-                          SET day3_reminder_sent = TRUE 
-                          WHERE user_id = %s''', (user_id,))
-            conn.commit()
-            cur.close()
-            conn.close()
-            
-            logging.info(f"Day 3 reminder sent to user {user_id}")
-            
-        except TelegramForbiddenError:
-            mark_user_blocked(user_id, True)
-        except Exception as e:
-            logging.error(f"Error sending Day 3 reminder to {user_id}: {e}")
-        
-        await asyncio.sleep(0.5)
-
-async def send_12h_reminder():
-    """Отправка напоминаний через 12 часов после завершения челленджа"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Находим тех, кто завершил челлендж 12 часов назад и не купил
-    cur.execute('''
-        SELECT cp.user_id, cp.day1_time, cp.day3_time
-        FROM challenge_progress cp
-        LEFT JOIN users u ON cp.user_id = u.user_id
-        WHERE cp.day3_completed = TRUE
-        AND cp.first_offer_sent = TRUE
-        AND cp.reminder_12h_sent = FALSE
-        AND cp.purchased = FALSE
-        AND (u.subscription_until IS NULL OR u.subscription_until < NOW())
-        AND cp.day3_completed_at < NOW() - INTERVAL '12 hours'
-        AND cp.day3_completed_at > NOW() - INTERVAL '13 hours'
-    ''')
-    
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
-    
-    logging.info(f"Found {len(users)} users for 12h reminder")
-    
-    for user in users:
-        try:
-            user_id = user['user_id']
-            
-            # Считаем прогресс
-            def time_to_minutes(time_str):
-                if not time_str:
-                    return 0
-                if 'less5' in time_str:
-                    return 4
-                elif '5-10' in time_str:
-                    return 7
-                elif '10-15' in time_str:
-                    return 12
-                elif 'more15' in time_str:
-                    return 18
-                return 0
-            
-            day1_mins = time_to_minutes(user['day1_time'])
-            day3_mins = time_to_minutes(user['day3_time'])
-            progress_diff = day3_mins - day1_mins
-            
-            text = (
-                "⏰ <b>ОСТАЛОСЬ 12 ЧАСОВ!</b>\n\n"
-                "Специальная цена 990₽ за доступ НАВСЕГДА\n"
-                "действует ещё 12 часов!\n\n"
-                "После этого цена будет 1490₽ 📈\n\n"
-                "─────────────────────\n"
-                "📊 <b>НАПОМИНАЮ ВАШ ПРОГРЕСС:</b>\n"
-                f"За 3 дня: +{progress_diff} минут концентрации\n\n"
-                "Представьте что будет через 14 дней! 🚀\n"
-                "─────────────────────\n\n"
-                "💰 <b>ТАРИФЫ:</b>\n\n"
-                "1 месяц: 290₽\n"
-                "НАВСЕГДА: 990₽ 🔥\n\n"
-                "Экономия 500₽ только сегодня!\n\n"
-                "❌ <b>Если не уверены:</b>\n"
-                "Гарантия 7 дней - не подошло = вернём деньги.\n"
-                "Без вопросов."
-            )
-            
-            await bot.send_message(
-                user_id,
-                text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="1️⃣ 1 МЕСЯЦ - 290₽", callback_data="challenge_1month")],
-                    [InlineKeyboardButton(text="♾️ НАВСЕГДА - 990₽ 🔥", callback_data="challenge_forever")],
-                    [InlineKeyboardButton(text="❓ Вопросы", url="https://t.me/razvitie_dety")]
-                ]),
-                parse_mode="HTML"
-            )
-            
-            # Отмечаем что напоминание отправлено
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute('''UPDATE challenge_progress 
-                          SET reminder_12h_sent = TRUE 
-                          WHERE user_id = %s''', (user_id,))
-            conn.commit()
-            cur.close()
-            conn.close()
-            
-            logging.info(f"12h reminder sent to user {user_id}")
-            
-        except TelegramForbiddenError:
-            mark_user_blocked(user_id, True)
-        except Exception as e:
-            logging.error(f"Error sending 12h reminder to {user_id}: {e}")
-        
-        await asyncio.sleep(0.5)
-
-async def send_24h_final_offer():
-    """Отправка финального предложения через 24 часа с промокодом"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Находим тех, кто завершил челлендж 24 часа назад и не купил
-    cur.execute('''
-        SELECT cp.user_id
-        FROM challenge_progress cp
-        LEFT JOIN users u ON cp.user_id = u.user_id
-        WHERE cp.day3_completed = TRUE
-        AND cp.reminder_12h_sent = TRUE
-        AND cp.reminder_24h_sent = FALSE
-        AND cp.purchased = FALSE
-        AND (u.subscription_until IS NULL OR u.subscription_until < NOW())
-        AND cp.day3_completed_at < NOW() - INTERVAL '24 hours'
-        AND cp.day3_completed_at > NOW() - INTERVAL '25 hours'
-    ''')
-    
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
-    
-    logging.info(f"Found {len(users)} users for 24h final offer")
-    
-    for user in users:
-        try:
-            user_id = user['user_id']
-            
-            text = (
-                "💔 <b>Жаль что не решились...</b>\n\n"
-                "Но я понимаю - 990₽ это деньги.\n\n"
-                "Поэтому специально для ВАС:\n\n"
-                "🎁 <b>ПРОМОКОД: CHALLENGE50</b>\n"
-                "Скидка 50% на тариф «1 месяц»\n\n"
-                "<s>290₽</s> → <b>145₽</b> 💰\n\n"
-                "─────────────────────\n"
-                "Попробуйте за полцены!\n\n"
-                "Если понравится - всегда сможете\n"
-                "перейти на «Навсегда»\n\n"
-                "⏰ Промокод действует 48 часов\n\n"
-                "<i>P.S. Вы прошли 3 дня - не останавливайтесь\n"
-                "на половине пути!</i> 💪"
+# ========================================
+# ОЧЕРЕДЬ ОТПРАВКИ (OUTBOX)
+# ========================================
+
+# Отправщики сообщений по видам задач outbox: kind -> корутина send(job)
+OUTBOX_SENDERS = {}
+
+# Ошибки, которые проходят сами: сеть, 5xx Telegram
+OUTBOX_TRANSIENT_ERRORS = (TelegramNetworkError, TelegramServerError)
+
+# Ошибки, которые повтор не исправит: неверный запрос или разметка, чат не
+# найден, слишком большое сообщение, нет отправщика или поля в payload
+OUTBOX_PERMANENT_ERRORS = (TelegramBadRequest, TelegramNotFound, TelegramEntityTooLarge, LookupError)
+
+# Ошибки отправки по классам с запуска бота - для /stats
+outbox_error_stats = {}
+
+# Будит воркер этого процесса, когда джоба положила задачи в очередь,
+# чтобы рассылка не ждала следующего опроса таблицы
+outbox_wakeup = asyncio.Event()
+
+def outbox_sender(kind):
+    """Декоратор: зарегистрировать отправщик для задач вида kind"""
+    def register(send):
+        OUTBOX_SENDERS[kind] = send
+        return send
+    return register
+
+async def claim_outbox_jobs(limit):
+    """Забрать пачку готовых задач
+
+    SKIP LOCKED пропускает строки, которые сейчас забирает другой воркер,
+    а сдвиг available_at на время аренды прячет забранные строки от
+    остальных воркеров до конца обработки. Если процесс упадет, строки
+    вернутся в очередь, когда аренда истечет.
+    """
+    async with get_db_connection() as conn:
+        cur = await conn.execute('''
+            UPDATE outbox
+            SET available_at = NOW() + make_interval(secs => %s),
+                attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE available_at <= NOW()
+                ORDER BY available_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
             )
-            
-            await bot.send_message(
-                user_id,
-                text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🎁 АКТИВИРОВАТЬ ПРОМОКОД", callback_data="activate_promo_CHALLENGE50")],
-                    [InlineKeyboardButton(text="♾️ Или купить НАВСЕГДА - 990₽", callback_data="challenge_forever")],
-                    [InlineKeyboardButton(text="❓ Вопросы", url="https://t.me/razvitie_dety")]
-                ]),
-                parse_mode="HTML"
+            RETURNING *, EXISTS (SELECT 1 FROM users u
+                                 WHERE u.user_id = outbox.user_id AND u.bot_blocked) AS recipient_blocked
+        ''', (OUTBOX_LEASE_SECONDS, limit))
+        return await cur.fetchall()
+
+def wave_progress_sql(source, column):
+    """CTE waves: прибавить задачи из CTE source к счетчику column их волн
+
+    Возвращает волны, которые этим обработаны целиком (запечатаны и
+    total задач дошли до итога).
+    """
+    return f'''
+            waves AS (
+                UPDATE outbox_waves w
+                SET {column} = w.{column} + c.count,
+                    finished_at = CASE WHEN w.sealed AND w.sent + w.blocked + w.suppressed + w.dead + c.count >= w.total
+                                       THEN NOW() END
+                FROM (SELECT kind, sweep_run, COUNT(*) AS count FROM {source}
+                      WHERE sweep_run IS NOT NULL GROUP BY kind, sweep_run) c
+                WHERE w.kind = c.kind AND w.sweep_run = c.sweep_run
+                RETURNING w.*
+            )'''
+
+def log_finished_waves(waves):
+    """Итог каждой завершенной волны - в лог"""
+    for wave in waves:
+        if wave['finished_at'] is None:
+            continue
+        logging.info(f"Outbox wave {wave['kind']} #{wave['sweep_run']} finished in "
+                     f"{format_duration((wave['finished_at'] - wave['started_at']).total_seconds())}: "
+                     f"{wave['total']} jobs, {wave['sent']} sent, {wave['blocked']} blocked, "
+                     f"{wave['suppressed']} suppressed, {wave['dead']} dead")
+
+async def archive_outbox_jobs(job_ids, status, error=None):
+    """Перенести задачи из outbox в outbox_archive с итоговым статусом ('sent', 'blocked' или 'suppressed')"""
+    if not job_ids:
+        return
+
+    async with get_db_connection() as conn:
+        cur = await conn.execute(f'''
+            WITH done AS (
+                DELETE FROM outbox WHERE id = ANY(%s) RETURNING *
+            ),
+            archived AS (
+                INSERT INTO outbox_archive (id, kind, user_id, payload, attempts, status, last_error, created_at, sweep_run)
+                SELECT id, kind, user_id, payload, attempts, %s, COALESCE(%s, last_error), created_at, sweep_run
+                FROM done
+            ),{wave_progress_sql('done', status)}
+            SELECT * FROM waves
+        ''', (list(job_ids), status, error))
+        log_finished_waves(await cur.fetchall())
+
+def backoff_delay(base, attempt, maximum):
+    """Экспоненциальная задержка с разбросом: от половины до полной base * 2^attempt
+
+    Разброс не дает задачам, упавшим вместе, вместе же и вернуться.
+    """
+    delay = min(base * 2 ** attempt, maximum)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+async def retry_outbox_job(job, error, delay=None, count_attempt=True):
+    """Вернуть задачу в очередь через delay секунд или с экспоненциальной задержкой
+
+    count_attempt=False - попытка не в счет OUTBOX_MAX_ATTEMPTS (flood control
+    - не вина задачи).
+    """
+    if delay is None:
+        delay = backoff_delay(OUTBOX_RETRY_BASE_SECONDS, job['attempts'] - 1, OUTBOX_RETRY_MAX_SECONDS)
+    async with get_db_connection() as conn:
+        await conn.execute('''UPDATE outbox
+                              SET available_at = NOW() + make_interval(secs => %s), last_error = %s,
+                                  attempts = attempts - %s
+                              WHERE id = %s''',
+                           (delay, error, 0 if count_attempt else 1, job['id']))
+
+async def dead_letter_outbox_job(job, error):
+    """Перенести задачу, которую не отправить, в outbox_dead_letter"""
+    async with get_db_connection() as conn:
+        cur = await conn.execute(f'''
+            WITH dead AS (
+                DELETE FROM outbox WHERE id = %s RETURNING *
+            ),
+            moved AS (
+                INSERT INTO outbox_dead_letter (id, kind, user_id, payload, attempts, error_class, last_error,
+                                                created_at, sweep_run)
+                SELECT id, kind, user_id, payload, attempts, %s, %s, created_at, sweep_run
+                FROM dead
+            ),{wave_progress_sql('dead', 'dead')}
+            SELECT * FROM waves
+        ''', (job['id'], type(error).__name__, f"{type(error).__name__}: {error}"))
+        waves = await cur.fetchall()
+    logging.warning(f"Outbox {job['kind']} to {job['user_id']} moved to dead letter: {type(error).__name__}: {error}")
+    log_finished_waves(waves)
+
+async def requeue_dead_letters(kind=None):
+    """Вернуть задачи из outbox_dead_letter в очередь (все или одного вида) с нулем попыток"""
+    async with get_db_connection() as conn:
+        cur = await conn.execute('''
+            WITH dead AS (
+                DELETE FROM outbox_dead_letter WHERE %(kind)s::text IS NULL OR kind = %(kind)s RETURNING *
+            ),
+            -- Волна этих задач снова не закончена
+            waves AS (
+                UPDATE outbox_waves w
+                SET dead = w.dead - c.count, finished_at = NULL
+                FROM (SELECT kind, sweep_run, COUNT(*) AS count FROM dead
+                      WHERE sweep_run IS NOT NULL GROUP BY kind, sweep_run) c
+                WHERE w.kind = c.kind AND w.sweep_run = c.sweep_run
             )
-            
-            # Отмечаем что финальное предложение отправлено
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute('''UPDATE challenge_progress 
-                          SET reminder_24h_sent = TRUE, promo_code_sent = TRUE 
-                          WHERE user_id = %s''', (user_id,))
-            conn.commit()
-            cur.close()
-            conn.close()
-            
-            logging.info(f"24h final offer sent to user {user_id}")
-            
-        except TelegramForbiddenError:
-            mark_user_blocked(user_id, True)
-        except Exception as e:
-            logging.error(f"Error sending 24h offer to {user_id}: {e}")
-        
-        await asyncio.sleep(0.5)
-
-async def send_day1_evening_reminder():
-    """Вечернее напоминание для Дня 1"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Находим тех, кто начал День 1 сегодня, но не завершил
-    cur.execute('''
-        SELECT user_id, age_category
-        FROM challenge_progress
-        WHERE is_active = TRUE
-        AND current_day = 1
-        AND day1_completed = FALSE
-        AND day1_evening_reminder_sent = FALSE
-        AND DATE(started_at) = CURRENT_DATE
-    ''')
-    
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
-    
-    logging.info(f"Found {len(users)} users for Day 1 evening reminder")
-    
-    for user in users:
+            INSERT INTO outbox (id, kind, user_id, payload, created_at, sweep_run)
+            SELECT id, kind, user_id, payload, created_at, sweep_run
+            FROM dead
+            RETURNING id
+        ''', {'kind': kind})
+        requeued = len(await cur.fetchall())
+
+    if requeued:
+        on_db_commit(outbox_wakeup.set)
+    return requeued
+
+async def send_with_retry(send, job):
+    """Отправить задачу, повторяя временные ошибки
+
+    retry_after выдерживает telegram_rate_limiter: он же притормаживает
+    остальные отправки. Сетевые ошибки и 5xx повторяются здесь до
+    OUTBOX_SEND_RETRIES раз с экспоненциальной задержкой и разбросом; если
+    не помогло, ошибка уходит наверх и задача возвращается в очередь.
+    Все ошибки считаются по классам в outbox_error_stats.
+    """
+    for attempt in range(OUTBOX_SEND_RETRIES + 1):
         try:
-            user_id = user['user_id']
-            
-            text = (
-                "🌙 <b>Добрый вечер!</b>\n\n"
-                "Заметил, что вы еще не завершили задания Дня 1.\n\n"
-                "Не переживайте - еще есть время! ⏰\n\n"
-                "💪 Всего 5-10 минут с ребенком - и первый день позади!\n\n"
-                "📝 Даже если не успели - отметьте это, чтобы завтра получить новые задания.\n\n"
-                "Вы справитесь! 🎯"
-            )
-            
-            await bot.send_message(
-                user_id,
-                text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="✅ Выполнил!", callback_data="day1_done")],
-                    [InlineKeyboardButton(text="❌ Не получилось", callback_data="day1_failed")],
-                    [InlineKeyboardButton(text="🔄 Напомнить завтра", callback_data="back")]
-                ]),
-                parse_mode="HTML"
-            )
-            
-            # Отмечаем что напоминание отправлено
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute('''UPDATE challenge_progress 
-                          SET day1_evening_reminder_sent = TRUE 
-                          WHERE user_id = %s''', (user_id,))
-            conn.commit()
-            cur.close()
-            conn.close()
-            
-            logging.info(f"Day 1 evening reminder sent to user {user_id}")
-            
-        except TelegramForbiddenError:
-            mark_user_blocked(user_id, True)
+            return await send(job)
         except Exception as e:
-            logging.error(f"Error sending Day 1 evening reminder to {user_id}: {e}")
-        
-        await asyncio.sleep(0.5)
+            error_class = type(e).__name__
+            outbox_error_stats[error_class] = outbox_error_stats.get(error_class, 0) + 1
+            if not isinstance(e, OUTBOX_TRANSIENT_ERRORS) or attempt == OUTBOX_SEND_RETRIES:
+                raise
+            logging.warning(f"Outbox {job['kind']} to {job['user_id']}: {error_class}, retrying")
+            await asyncio.sleep(backoff_delay(OUTBOX_SEND_RETRY_BASE_SECONDS, attempt, OUTBOX_RETRY_MAX_SECONDS))
+
+async def process_outbox_batch(jobs):
+    """Отправить пачку задач и разложить результаты
+
+    Отправляют до OUTBOX_CONCURRENCY корутин одновременно, темп задает
+    telegram_rate_limiter. Доставка "хотя бы один раз": если процесс упадет
+    между отправкой и архивацией, после истечения аренды задачу отправят снова.
+    Напоминания от повторной отправки защищает журнал reminders (send_reminder).
+    """
+    # Получатель заблокировал бота уже после постановки задачи - не отправляем
+    suppressed = [job['id'] for job in jobs if job['recipient_blocked']]
+    if suppressed:
+        await archive_outbox_jobs(suppressed, 'suppressed')
+        blocked_suppression_stats['outbox'] += len(suppressed)
+        jobs = [job for job in jobs if not job['recipient_blocked']]
+
+    semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    sent, blocked, failed = [], [], []
+
+    async def deliver(job):
+        send = OUTBOX_SENDERS.get(job['kind'])
+        if send is None:
+            failed.append((job, LookupError(f"unknown outbox kind {job['kind']}")))
+            return
+
+        async with semaphore:
+            try:
+                await send_with_retry(send, job)
+                sent.append(job['id'])
+                logging.info(f"Outbox {job['kind']} sent to user {job['user_id']}")
+            except TelegramForbiddenError:
+                # Заблокировавшему бота повторять незачем
+                blocked.append(job)
+            except Exception as e:
+                failed.append((job, e))
+                logging.error(f"Error sending outbox {job['kind']} to {job['user_id']}: {type(e).__name__}: {e}")
+
+    await asyncio.gather(*(deliver(job) for job in jobs))
+
+    await archive_outbox_jobs(sent, 'sent')
+    await archive_outbox_jobs([job['id'] for job in blocked], 'blocked')
+    for job in blocked:
+        await mark_user_blocked(job['user_id'], True)
+
+    for job, error in failed:
+        if isinstance(error, TelegramRetryAfter):
+            # Flood control не прошел за TELEGRAM_MAX_RETRIES повторов - ждем,
+            # сколько сказал Telegram, получатель не теряется
+            await retry_outbox_job(job, f"{type(error).__name__}: {error}", delay=error.retry_after, count_attempt=False)
+        elif isinstance(error, OUTBOX_PERMANENT_ERRORS) or job['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            await dead_letter_outbox_job(job, error)
+        else:
+            await retry_outbox_job(job, f"{type(error).__name__}: {error}")
 
+    logging.info(f"Outbox batch: {len(sent)} sent, {len(blocked)} blocked, {len(failed)} failed, "
+                 f"{len(suppressed)} suppressed")
 
-async def send_day2_evening_reminder():
-    """Вечернее напоминание для Дня 2"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Находим тех, кто начал День 2 (получил напоминание утром), но не завершил
-    cur.execute('''
-        SELECT user_id, age_category
-        FROM challenge_progress
-        WHERE is_active = TRUE
-        AND current_day = 2
-        AND day2_completed = FALSE
-        AND day2_evening_reminder_sent = FALSE
-        AND day2_reminder_sent = TRUE
-        AND DATE(day1_completed_at) < CURRENT_DATE
-    ''')
-    
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
-    
-    logging.info(f"Found {len(users)} users for Day 2 evening reminder")
-    
-    for user in users:
+async def run_outbox_worker():
+    """Фоновая задача: разбирает очередь outbox
+
+    Работает только на ведущей реплике: ограничитель Telegram у каждого
+    процесса свой, и воркеры N реплик рассылали бы в N раз быстрее общего
+    лимита бота. Несколько воркеров (например, при смене ведущей) не
+    получают одни и те же задачи.
+    """
+    while True:
         try:
-            user_id = user['user_id']
-            
-            text = (
-                "🌙 <b>Добрый вечер!</b>\n\n"
-                "День 2 еще не завершен! ⏰\n\n"
-                "Вы уже прошли половину пути - не останавливайтесь! 💪\n\n"
-                "📝 Даже 5 минут с ребенком дадут результат!\n\n"
-                "Завтра финальный рывок - День 3! 🏆"
-            )
-            
-            await bot.send_message(
-                user_id,
-                text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="✅ Выполнил!", callback_data="day2_done")],
-                    [InlineKeyboardButton(text="❌ Не получилось", callback_data="day2_failed")],
-                    [InlineKeyboardButton(text="🔄 Напомнить завтра", callback_data="back")]
-                ]),
-                parse_mode="HTML"
-            )
-            
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute('''UPDATE challenge_progress 
-                          SET day2_evening_reminder_sent = TRUE 
-                          WHERE user_id = %s''', (user_id,))
-            conn.commit()
-            cur.close()
-            conn.close()
-            
-            logging.info(f"Day 2 evening reminder sent to user {user_id}")
-            
-        except TelegramForbiddenError:
-            mark_user_blocked(user_id, True)
+            jobs = await claim_outbox_jobs(OUTBOX_BATCH_SIZE)
+            if jobs:
+                await process_outbox_batch(jobs)
+                continue
+
+            outbox_wakeup.clear()
+            try:
+                await asyncio.wait_for(outbox_wakeup.wait(), OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
         except Exception as e:
-            logging.error(f"Error sending Day 2 evening reminder to {user_id}: {e}")
-        
-        await asyncio.sleep(0.5)
+            logging.error(f"Error in run_outbox_worker: {e}")
+            await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+async def get_outbox_stats():
+    """Состояние очереди для /stats: ожидающие задачи и итоги за сутки"""
+    async with get_db_connection() as conn:
+        cur = await conn.execute('SELECT kind, COUNT(*) AS count FROM outbox GROUP BY kind ORDER BY kind')
+        pending = {row['kind']: row['count'] for row in await cur.fetchall()}
+
+        cur = await conn.execute('''SELECT status, COUNT(*) AS count FROM outbox_archive
+                                    WHERE finished_at > NOW() - INTERVAL '1 day'
+                                    GROUP BY status''')
+        finished = {row['status']: row['count'] for row in await cur.fetchall()}
+
+        cur = await conn.execute("""SELECT COUNT(*) AS count FROM outbox_dead_letter
+                                    WHERE failed_at > NOW() - INTERVAL '1 day'""")
+        finished['dead'] = (await cur.fetchone())['count']
+
+        cur = await conn.execute('SELECT COUNT(*) AS count FROM users WHERE bot_blocked')
+        blocked_users = (await cur.fetchone())['count']
+
+        # Последняя волна каждого вида
+        cur = await conn.execute('''SELECT DISTINCT ON (kind) *
+                                    FROM outbox_waves
+                                    ORDER BY kind, sweep_run DESC''')
+        waves = await cur.fetchall()
+    return {'pending': pending, 'finished': finished, 'errors': dict(outbox_error_stats),
+            'blocked_users': blocked_users, 'waves': waves}
 
+# ========================================
+# НАПОМИНАНИЯ
+# ========================================
 
-async def send_day3_evening_reminder():
-    """Вечернее напоминание для Дня 3"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute('''
-        SELECT user_id, age_category
-        FROM challenge_progress
-        WHERE is_active = TRUE
-        AND current_day = 3
-        AND day3_completed = FALSE
-        AND day3_evening_reminder_sent = FALSE
-        AND day3_reminder_sent = TRUE
-        AND DATE(day2_completed_at) < CURRENT_DATE
-    ''')
+class ReminderRule:
+    """Правило напоминания: когда, кому и что отправить
+
+    kind - вид задачи в outbox. action - при каком next_action участника
+    правило проверяется: 'morning', 'evening' или шаг воронки (FUNNEL_STEPS).
+    table - где лежат флаги отправки: 'day' - строка дня в
+    challenge_day_results (алиас d, начало сегодняшнего дня по поясу
+    участника - l.today), 'progress' - challenge_progress (алиас cp).
+    flags - флаги, которые ставятся вместе с постановкой в очередь; первый
+    отсекает участника от повторной постановки. day - день челленджа для
+    журнала отправок reminders. where - условие на SQL. payload -
+    SQL-выражение jsonb с подстановками для text (только для 'progress').
+    buttons - ряды кнопок, каждая - аргументы InlineKeyboardButton.
+    """
+    
+    def __init__(self, kind, action, table, flags, day, where, text, buttons, payload=None):
+        self.kind = kind
+        self.action = action
+        self.table = table
+        self.flags = flags
+        self.day = day
+        self.where = where
+        self.text = text
+        self.buttons = buttons
+        self.payload = payload
+
+# Правила по kind
+REMINDER_RULES = {}
+
+# Шаги воронки после завершения челленджа: (next_action, часов после завершения)
+FUNNEL_STEPS = (('offer_12h', 12), ('offer_24h', 24))
+
+# Сколько задач поставило каждое правило с запуска бота - для /stats
+reminder_rule_stats = {}
+
+# Итоги проверки журнала reminders перед отправкой с запуска бота - для /stats
+reminder_ledger_stats = {'claimed': 0, 'duplicates': 0}
+
+def add_reminder_rule(rule):
+    REMINDER_RULES[rule.kind] = rule
+    outbox_sender(rule.kind)(send_reminder)
+
+async def claim_reminder(user_id, rule):
+    """Занять строку журнала reminders перед отправкой
+
+    Строка ключуется и запуском челленджа (started_at участника), так что
+    после повторного старта напоминания уходят снова. Возвращает id
+    строки, если она занята этим вызовом и напоминание можно отправлять,
+    иначе None. Строку, занятую, но так и не отправленную дольше аренды
+    outbox (процесс упал посреди отправки), можно занять заново.
+    """
+    async with get_db_connection() as conn:
+        cur = await conn.execute('''INSERT INTO reminders (user_id, run_started_at, day, reminder_type, claimed_at)
+                                    SELECT %(user_id)s,
+                                           COALESCE((SELECT started_at FROM challenge_progress
+                                                     WHERE user_id = %(user_id)s), 'epoch'),
+                                           %(day)s, %(kind)s, NOW()
+                                    ON CONFLICT (user_id, run_started_at, day, reminder_type) DO UPDATE
+                                    SET claimed_at = NOW()
+                                    WHERE reminders.sent_at IS NULL
+                                    AND reminders.claimed_at < NOW() - make_interval(secs => %(lease)s)
+                                    RETURNING id''',
+                                 {'user_id': user_id, 'day': rule.day, 'kind': rule.kind,
+                                  'lease': OUTBOX_LEASE_SECONDS})
+        row = await cur.fetchone()
+        return row['id'] if row is not None else None
+
+async def finish_reminder(reminder_id, sent):
+    """Отметить напоминание отправленным или освободить строку журнала для повтора"""
+    async with get_db_connection() as conn:
+        if sent:
+            await conn.execute('UPDATE reminders SET sent_at = NOW() WHERE id = %s', (reminder_id,))
+        else:
+            await conn.execute('DELETE FROM reminders WHERE id = %s AND sent_at IS NULL', (reminder_id,))
+
+async def send_reminder(job):
+    """Отправщик outbox для всех правил напоминаний
+
+    Отправляет, только если занял строку журнала reminders: повторная
+    доставка той же задачи другим воркером или после истечения аренды
+    ничего не отправит.
+    """
+    rule = REMINDER_RULES[job['kind']]
+    reminder_id = await claim_reminder(job['user_id'], rule)
+    if reminder_id is None:
+        reminder_ledger_stats['duplicates'] += 1
+        logging.info(f"Reminder {rule.kind} for user {job['user_id']} is already sent or in progress, skipping")
+        return
+    reminder_ledger_stats['claimed'] += 1
     
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
+    try:
+        await bot.send_message(
+            job['user_id'],
+            rule.text.format(**job['payload']),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(**button) for button in row] for row in rule.buttons
+            ]),
+            parse_mode="HTML"
+        )
+    except Exception:
+        await finish_reminder(reminder_id, sent=False)
+        raise
+    await finish_reminder(reminder_id, sent=True)
+
+def reminder_pending_sql(tz_sql, user_id_sql, firing=None):
+    """Условие: правилам дней еще есть о чем напомнить участнику
+
+    Правило еще может сработать, если его флаг у незавершенного дня не
+    стоит и условие where выполняется сегодня или завтра по поясу
+    участника (следующий слот - не позже завтра; условия "день открыт до
+    сегодня" дальше остаются верными). Если нет - расписание участника
+    останавливается (next_action_at = NULL) и строка больше не
+    переписывается дважды в сутки. Открытие следующего дня назначает его
+    заново.
+
+    firing(rule) - SQL-условие, что правило срабатывает этим же запросом.
+    Его флаги ставятся в том же снимке и здесь еще не видны, поэтому
+    строки дней читаются такими, какими они станут после запроса.
+    """
+    day_rules = [rule for rule in REMINDER_RULES.values() if rule.table == 'day']
+    local_today = f"date_trunc('day', NOW() AT TIME ZONE {tz_sql}) AT TIME ZONE {tz_sql}"
+    days = 'challenge_day_results d'
+    if firing:
+        flags = {}
+        for rule in day_rules:
+            for flag in rule.flags:
+                flags.setdefault(flag, []).append(
+                    f"({firing(rule)} AND d.{rule.flags[0]} = FALSE AND {rule.where})")
+        columns = ''.join(f",\n                                    d.{flag} OR {' OR '.join(fired)} AS {flag}"
+                          for flag, fired in flags.items())
+        days = f'''(SELECT d.user_id, d.day, d.completed, d.unlocked_at{columns}
+                              FROM challenge_day_results d, (SELECT {local_today} AS today) AS l
+                              WHERE d.user_id = {user_id_sql}) AS d'''
+    conditions = ' OR '.join(f"(d.{rule.flags[0]} = FALSE AND {rule.where})" for rule in day_rules)
+    return f'''EXISTS (
+                        SELECT 1
+                        FROM {days},
+                             (SELECT {local_today} + days.n * INTERVAL '1 day' AS today
+                              FROM (VALUES (0), (1)) AS days (n)) AS l
+                        WHERE d.user_id = {user_id_sql} AND d.completed = FALSE
+                        AND ({conditions})
+                    )'''
+
+def build_reminder_sweep_sql():
+    """Запрос одного прохода по участникам с подошедшим next_action_at
+
+    Одним запросом: забираем пачку участников (SKIP LOCKED - реплики берут
+    разных), назначаем им следующий next_action, проверяем все правила их
+    текущего next_action, ставим флаги и кладем задачи в outbox.
+
+    Слот, просроченный больше окна догона (параметры reminder_catch_up и
+    funnel_catch_up, см. sweep_due_reminders), только сдвигается -
+    напоминать уже поздно.
+    """
+    day_rules = [rule for rule in REMINDER_RULES.values() if rule.table == 'day']
+    progress_rules = [rule for rule in REMINDER_RULES.values() if rule.table == 'progress']
+    funnel_actions = ', '.join(f"'{action}'" for action, _ in FUNNEL_STEPS)
+    fresh = (f"cp.next_action_at > NOW() - make_interval(secs => CASE WHEN cp.next_action IN ({funnel_actions}) "
+             f"THEN %(funnel_catch_up)s ELSE %(reminder_catch_up)s END)")
+    # Заблокировавшим бота правила не отправляют ничего, расписание при этом идет дальше
+    blocked = "COALESCE((SELECT u.bot_blocked FROM users u WHERE u.user_id = cp.user_id), FALSE)"
+    
+    # Правила по challenge_progress проверяются прямо при выборке участника:
+    # его строку этим же запросом обновляет сдвиг next_action_at
+    progress_kind = ' '.join(
+        f"WHEN cp.next_action = '{rule.action}' AND cp.{rule.flags[0]} = FALSE AND {rule.where} THEN '{rule.kind}'"
+        for rule in progress_rules
+    )
+    progress_payload = ' '.join(
+        f"WHEN cp.next_action = '{rule.action}' THEN {rule.payload}"
+        for rule in progress_rules if rule.payload
+    )
+    progress_flags = {}
+    for rule in progress_rules:
+        for flag in rule.flags:
+            progress_flags.setdefault(flag, []).append(f"'{rule.kind}'")
+    set_flags = ''.join(
+        f",\n                {flag} = cp.{flag} OR COALESCE(due.progress_kind IN ({', '.join(kinds)}), FALSE)"
+        for flag, kinds in progress_flags.items()
+    )
     
-    logging.info(f"Found {len(users)} users for Day 3 evening reminder")
+    # Следующий next_action: утро/вечер по поясу, пока правилам дней есть что
+    # отправить, потом шаги воронки; после последнего шага - NULL
+    pending = reminder_pending_sql(
+        'due.tz', 'cp.user_id',
+        firing=lambda rule: f"due.fresh AND NOT due.blocked AND due.next_action = '{rule.action}'")
+    next_steps = ''.join(
+        f"\n                    UNION ALL\n"
+        f"                    SELECT cp.completed_at + INTERVAL '{hours} hours', '{action}'\n"
+        f"                    WHERE NOT cp.is_active AND due.next_action = '{previous}'"
+        for (previous, _), (action, hours) in zip(FUNNEL_STEPS, FUNNEL_STEPS[1:])
+    )
     
-    for user in users:
-        try:
-            user_id = user['user_id']
-            
-            text = (
-                "🌙 <b>Добрый вечер!</b>\n\n"
-                "🏆 <b>ФИНАЛЬНЫЙ ДЕНЬ!</b>\n\n"
-                "Вы так близко к завершению челленджа! 💪\n\n"
-                "Не упустите возможность:\n"
-                "✅ Увидеть результаты 3 дней работы\n"
-                "✅ Получить специальную скидку 40%\n"
-                "✅ Завершить начатое!\n\n"
-                "📝 Всего несколько минут - и вы в финале! 🎯"
-            )
-            
-            await bot.send_message(
-                user_id,
-                text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="✅ Выполнил!", callback_data="day3_done")],
-                    [InlineKeyboardButton(text="❌ Не получилось", callback_data="day3_failed")],
-                    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back")]
-                ]),
-                parse_mode="HTML"
+    day_ctes = ''.join(f'''
+            "{rule.kind}" AS (
+                UPDATE challenge_day_results d
+                SET {', '.join(f'{flag} = TRUE' for flag in rule.flags)}
+                FROM local_day l
+                WHERE l.next_action = '{rule.action}'
+                AND d.user_id = l.user_id
+                AND d.completed = FALSE
+                AND d.{rule.flags[0]} = FALSE
+                AND {rule.where}
+                RETURNING d.user_id, '{rule.kind}' AS kind, '{{}}'::jsonb AS payload
+            ),''' for rule in day_rules)
+    day_selects = ''.join(f'\n                SELECT kind, user_id, payload FROM "{rule.kind}"\n                UNION ALL'
+                          for rule in day_rules)
+    
+    return f'''
+            WITH due AS (
+                SELECT cp.user_id, cp.next_action, cp.is_active,
+                       COALESCE((SELECT u.timezone FROM users u WHERE u.user_id = cp.user_id), %(default_tz)s) AS tz,
+                       {blocked} AS blocked,
+                       {fresh} AS fresh,
+                       CASE WHEN NOT {fresh} OR {blocked} THEN NULL {progress_kind} END AS progress_kind,
+                       CASE {progress_payload} ELSE '{{}}'::jsonb END AS payload
+                FROM challenge_progress cp
+                WHERE cp.next_action_at <= NOW()
+                ORDER BY cp.next_action_at
+                LIMIT %(limit)s
+                FOR UPDATE OF cp SKIP LOCKED
+            ),
+            advanced AS (
+                UPDATE challenge_progress cp
+                SET (next_action_at, next_action) = (
+                    {reminder_slot_sql('due.tz', 'cp.user_id')}
+                    WHERE cp.is_active AND {pending}{next_steps}
+                ){set_flags}
+                FROM due
+                WHERE cp.user_id = due.user_id
+            ),
+            local_day AS (
+                SELECT user_id, next_action, date_trunc('day', NOW() AT TIME ZONE tz) AT TIME ZONE tz AS today
+                FROM due
+                WHERE fresh AND is_active AND NOT blocked
+            ),{day_ctes}
+            run AS (
+                SELECT COALESCE(%(sweep_run)s::bigint, nextval('reminder_sweep_runs')) AS sweep_run
+            ),
+            queued AS (
+                INSERT INTO outbox (kind, user_id, payload, sweep_run)
+                SELECT kind, user_id, payload, (SELECT sweep_run FROM run)
+                FROM ({day_selects}
+                SELECT progress_kind, user_id, payload FROM due WHERE progress_kind IS NOT NULL) AS jobs
+                RETURNING user_id, kind
+            ),
+            waves AS (
+                INSERT INTO outbox_waves (kind, sweep_run, total)
+                SELECT kind, (SELECT sweep_run FROM run), COUNT(*) FROM queued GROUP BY kind
+                ON CONFLICT (kind, sweep_run) DO UPDATE SET total = outbox_waves.total + EXCLUDED.total
             )
-            
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute('''UPDATE challenge_progress 
-                          SET day3_evening_reminder_sent = TRUE 
-                          WHERE user_id = %s''', (user_id,))
-            conn.commit()
-            cur.close()
-            conn.close()
-            
-            logging.info(f"Day 3 evening reminder sent to user {user_id}")
-            
-        except TelegramForbiddenError:
-            mark_user_blocked(user_id, True)
-        except Exception as e:
-            logging.error(f"Error sending Day 3 evening reminder to {user_id}: {e}")
-        
-        await asyncio.sleep(0.5)
+            SELECT (SELECT sweep_run FROM run) AS sweep_run,
+                   (SELECT COUNT(*) FROM due) AS due,
+                   (SELECT COUNT(*) FROM due WHERE fresh AND blocked) AS suppressed,
+                   COALESCE((SELECT jsonb_agg(jsonb_build_object('user_id', user_id, 'kind', kind)) FROM queued),
+                            '[]'::jsonb) AS queued
+        '''
+
+async def sweep_due_reminders(limit, sweep_run=None, catch_up=None):
+    """Один проход правил напоминаний по пачке участников
+
+    sweep_run - номер запуска джобы, задачи которого составляют волны
+    outbox_waves; None - взять новый. Слоты, просроченные не больше чем на
+    REMINDER_MAX_CATCH_UP_HOURS (воронка - FUNNEL_MAX_CATCH_UP_HOURS) или
+    на catch_up (timedelta, время с прошлого успешного запуска), еще
+    отправляются. Возвращает (номер запуска, сколько
+    участников обработано, [{'user_id', 'kind'}] поставленных задач,
+    скольких участников пропустили из-за bot_blocked).
+    """
+    gap = catch_up.total_seconds() if catch_up is not None else 0
+    async with get_db_connection() as conn:
+        cur = await conn.execute(reminder_sweep_sql, {
+            **reminder_slot_params(),
+            'sweep_run': sweep_run,
+            'limit': limit,
+            'reminder_catch_up': max(REMINDER_MAX_CATCH_UP_HOURS * 3600, gap),
+            'funnel_catch_up': max(FUNNEL_MAX_CATCH_UP_HOURS * 3600, gap)
+        })
+        result = await cur.fetchone()
+    
+    for job in result['queued']:
+        rule = REMINDER_RULES[job['kind']]
+        if rule.table == 'progress':
+            write_through_progress(job['user_id'], **{flag: True for flag in rule.flags})
+    if result['queued']:
+        on_db_commit(outbox_wakeup.set)
+    return result['sweep_run'], result['due'], result['queued'], result['suppressed']
+
+async def run_reminder_rules(catch_up=None):
+    """Джоба планировщика: все правила напоминаний для участников, у которых подошло время
+
+    Участники обрабатываются небольшими пачками по мере наступления их
+    next_action_at, поэтому нагрузка на БД и Telegram растянута во времени.
+    catch_up - время с прошлого успешного запуска: после простоя дольше
+    окон догона правил окно расширяется на весь простой, и пропущенные
+    за него шаги воронки все равно уходят (один раз - флаги правил).
+    """
+    if catch_up is not None and catch_up > timedelta(hours=min(REMINDER_MAX_CATCH_UP_HOURS,
+                                                               FUNNEL_MAX_CATCH_UP_HOURS)):
+        logging.warning(f"Reminder rules last succeeded {catch_up} ago, catching up the whole gap")
+    due_total = 0
+    queued = {}
+    sweep_run = None
+    while True:
+        sweep_run, due, jobs, suppressed = await sweep_due_reminders(REMINDER_SWEEP_BATCH_SIZE, sweep_run,
+                                                                     catch_up)
+        due_total += due
+        blocked_suppression_stats['reminders'] += suppressed
+        for job in jobs:
+            queued[job['kind']] = queued.get(job['kind'], 0) + 1
+            reminder_rule_stats[job['kind']] = reminder_rule_stats.get(job['kind'], 0) + 1
+        if due < REMINDER_SWEEP_BATCH_SIZE:
+            break
+    
+    if queued:
+        summary = ', '.join(f"{kind} {count}" for kind, count in sorted(queued.items()))
+        logging.info(f"Reminder rules: {due_total} participants due, queued {summary} (run #{sweep_run})")
+        await seal_outbox_waves(sweep_run, list(queued))
+
+async def seal_outbox_waves(sweep_run, kinds):
+    """Запуск больше не добавит задач в свои волны: отметить их запечатанными
+
+    Воркеры могли разослать волну еще до конца запуска - такие волны
+    завершаются сразу.
+    """
+    async with get_db_connection() as conn:
+        cur = await conn.execute('''UPDATE outbox_waves
+                                    SET sealed = TRUE,
+                                        finished_at = CASE WHEN sent + blocked + suppressed + dead >= total
+                                                           THEN NOW() END
+                                    WHERE kind = ANY(%s) AND sweep_run = %s
+                                    RETURNING *''',
+                                 (kinds, sweep_run))
+        log_finished_waves(await cur.fetchall())
+
+# ====== ПРАВИЛА ======
+
+# Утро: напоминаем о дне, открытом до сегодняшнего числа
+add_reminder_rule(ReminderRule(
+    kind='day2_reminder',
+    action='morning',
+    table='day',
+    flags=('reminder_sent',),
+    day=2,
+    where="d.day = 2 AND d.unlocked_at < l.today",
+    text=(
+        "☀️ <b>Доброе утро!</b>\n\n"
+        "🎯 <b>ДЕНЬ 2: Развитие концентрации</b>\n\n"
+        "Вчера отлично! Сегодня продолжим! 💪\n\n"
+        "Готовы к новым заданиям?"
+    ),
+    buttons=[
+        [{'text': "🚀 Начать День 2!", 'callback_data': "start_day2"}]
+    ]
+))
+
+add_reminder_rule(ReminderRule(
+    kind='day3_reminder',
+    action='morning',
+    table='day',
+    flags=('reminder_sent',),
+    day=3,
+    where="d.day = 3 AND d.unlocked_at < l.today",
+    text=(
+        "☀️ <b>Доброе утро!</b>\n\n"
+        "🎯 <b>ДЕНЬ 3: Финальный рывок!</b>\n\n"
+        "Сегодня последний день челленджа! 🏆\n\n"
+        "После этого вас ждёт специальное предложение! 💎\n\n"
+        "Готовы завершить челлендж?"
+    ),
+    buttons=[
+        [{'text': "🚀 Начать День 3!", 'callback_data': "start_day3"}]
+    ]
+))
+
+# Вечер: о Дне 1, начатом сегодня, и о следующих днях, о которых уже напомнили утром
+add_reminder_rule(ReminderRule(
+    kind='day1_evening',
+    action='evening',
+    table='day',
+    flags=('evening_reminder_sent',),
+    day=1,
+    where="d.day = 1 AND d.unlocked_at >= l.today AND d.unlocked_at < l.today + INTERVAL '1 day'",
+    text=(
+        "🌙 <b>Добрый вечер!</b>\n\n"
+        "Заметил, что вы еще не завершили задания Дня 1.\n\n"
+        "Не переживайте - еще есть время! ⏰\n\n"
+        "💪 Всего 5-10 минут с ребенком - и первый день позади!\n\n"
+        "📝 Даже если не успели - отметьте это, чтобы завтра получить новые задания.\n\n"
+        "Вы справитесь! 🎯"
+    ),
+    buttons=[
+        [{'text': "✅ Выполнил!", 'callback_data': "day1_done"}],
+        [{'text': "❌ Не получилось", 'callback_data': "day1_failed"}],
+        [{'text': "🔄 Напомнить завтра", 'callback_data': "back"}]
+    ]
+))
+
+add_reminder_rule(ReminderRule(
+    kind='day2_evening',
+    action='evening',
+    table='day',
+    flags=('evening_reminder_sent',),
+    day=2,
+    where="d.day = 2 AND d.reminder_sent = TRUE AND d.unlocked_at < l.today",
+    text=(
+        "🌙 <b>Добрый вечер!</b>\n\n"
+        "День 2 еще не завершен! ⏰\n\n"
+        "Вы уже прошли половину пути - не останавливайтесь! 💪\n\n"
+        "📝 Даже 5 минут с ребенком дадут результат!\n\n"
+        "Завтра финальный рывок - День 3! 🏆"
+    ),
+    buttons=[
+        [{'text': "✅ Выполнил!", 'callback_data': "day2_done"}],
+        [{'text': "❌ Не получилось", 'callback_data': "day2_failed"}],
+        [{'text': "🔄 Напомнить завтра", 'callback_data': "back"}]
+    ]
+))
+
+add_reminder_rule(ReminderRule(
+    kind='day3_evening',
+    action='evening',
+    table='day',
+    flags=('evening_reminder_sent',),
+    day=3,
+    where="d.day = 3 AND d.reminder_sent = TRUE AND d.unlocked_at < l.today",
+    text=(
+        "🌙 <b>Добрый вечер!</b>\n\n"
+        "🏆 <b>ФИНАЛЬНЫЙ ДЕНЬ!</b>\n\n"
+        "Вы так близко к завершению челленджа! 💪\n\n"
+        "Не упустите возможность:\n"
+        "✅ Увидеть результаты 3 дней работы\n"
+        "✅ Получить специальную скидку 40%\n"
+        "✅ Завершить начатое!\n\n"
+        "📝 Всего несколько минут - и вы в финале! 🎯"
+    ),
+    buttons=[
+        [{'text': "✅ Выполнил!", 'callback_data': "day3_done"}],
+        [{'text': "❌ Не получилось", 'callback_data': "day3_failed"}],
+        [{'text': "🏠 Главное меню", 'callback_data': "back"}]
+    ]
+))
+
+# Воронка продаж: не купившим и без активной подписки
+NO_ACTIVE_SUBSCRIPTION = ("NOT EXISTS (SELECT 1 FROM users u "
+                          "WHERE u.user_id = cp.user_id AND u.subscription_until >= NOW())")
+
+add_reminder_rule(ReminderRule(
+    kind='offer_12h',
+    action='offer_12h',
+    table='progress',
+    flags=('reminder_12h_sent',),
+    day=CHALLENGE_DAYS,
+    where=f"cp.first_offer_sent = TRUE AND cp.purchased = FALSE AND {NO_ACTIVE_SUBSCRIPTION}",
+    payload=(
+        "jsonb_build_object('progress_diff', "
+        f"time_spent_minutes((SELECT time_spent FROM challenge_day_results WHERE user_id = cp.user_id AND day = {CHALLENGE_DAYS})) "
+        "- time_spent_minutes((SELECT time_spent FROM challenge_day_results WHERE user_id = cp.user_id AND day = 1)))"
+    ),
+    text=(
+        "⏰ <b>ОСТАЛОСЬ 12 ЧАСОВ!</b>\n\n"
+        "Специальная цена 990₽ за доступ НАВСЕГДА\n"
+        "действует ещё 12 часов!\n\n"
+        "После этого цена будет 1490₽ 📈\n\n"
+        "─────────────────────\n"
+        "📊 <b>НАПОМИНАЮ ВАШ ПРОГРЕСС:</b>\n"
+        "За 3 дня: +{progress_diff} минут концентрации\n\n"
+        "Представьте что будет через 14 дней! 🚀\n"
+        "─────────────────────\n\n"
+        "💰 <b>ТАРИФЫ:</b>\n\n"
+        "1 месяц: 290₽\n"
+        "НАВСЕГДА: 990₽ 🔥\n\n"
+        "Экономия 500₽ только сегодня!\n\n"
+        "❌ <b>Если не уверены:</b>\n"
+        "Гарантия 7 дней - не подошло = вернём деньги.\n"
+        "Без вопросов."
+    ),
+    buttons=[
+        [{'text': "1️⃣ 1 МЕСЯЦ - 290₽", 'callback_data': "challenge_1month"}],
+        [{'text': "♾️ НАВСЕГДА - 990₽ 🔥", 'callback_data': "challenge_forever"}],
+        [{'text': "❓ Вопросы", 'url': "https://t.me/razvitie_dety"}]
+    ]
+))
+
+# Вместе с финальным предложением отмечаем, что промокод выдан
+add_reminder_rule(ReminderRule(
+    kind='offer_24h',
+    action='offer_24h',
+    table='progress',
+    flags=('reminder_24h_sent', 'promo_code_sent'),
+    day=CHALLENGE_DAYS,
+    where=f"cp.reminder_12h_sent = TRUE AND cp.purchased = FALSE AND {NO_ACTIVE_SUBSCRIPTION}",
+    text=(
+        "💔 <b>Жаль что не решились...</b>\n\n"
+        "Но я понимаю - 990₽ это деньги.\n\n"
+        "Поэтому специально для ВАС:\n\n"
+        "🎁 <b>ПРОМОКОД: CHALLENGE50</b>\n"
+        "Скидка 50% на тариф «1 месяц»\n\n"
+        "<s>290₽</s> → <b>145₽</b> 💰\n\n"
+        "─────────────────────\n"
+        "Попробуйте за полцены!\n\n"
+        "Если понравится - всегда сможете\n"
+        "перейти на «Навсегда»\n\n"
+        "⏰ Промокод действует 48 часов\n\n"
+        "<i>P.S. Вы прошли 3 дня - не останавливайтесь\n"
+        "на половине пути!</i> 💪"
+    ),
+    buttons=[
+        [{'text': "🎁 АКТИВИРОВАТЬ ПРОМОКОД", 'callback_data': "activate_promo_CHALLENGE50"}],
+        [{'text': "♾️ Или купить НАВСЕГДА - 990₽", 'callback_data': "challenge_forever"}],
+        [{'text': "❓ Вопросы", 'url': "https://t.me/razvitie_dety"}]
+    ]
+))
+
+reminder_sweep_sql = build_reminder_sweep_sql()
 
 @dp.callback_query(F.data.startswith("change_cat_"))
 async def change_category_from_failed(callback: types.CallbackQuery):
@@ -1369,10 +2417,10 @@ async def change_category_from_failed(callback: types.CallbackQuery):
     new_category = callback.data.replace("change_cat_", "")
     
     # Обновляем категорию
-    change_age_category(user_id, new_category)
+    await change_age_category(user_id, new_category)
     
     # Получаем обновленный прогресс
-    progress = get_challenge_progress(user_id)
+    progress = await get_challenge_progress(user_id, fresh=True)
     
     await callback.message.edit_text(
         f"✅ Перевёл в категорию {new_category} лет!\n\n"
@@ -1381,7 +2429,7 @@ async def change_category_from_failed(callback: types.CallbackQuery):
     )
     
     # Получаем материалы для новой категории
-    materials = get_challenge_materials(new_category, 1)
+    materials = await get_challenge_materials(new_category, 1)
     
     # Формируем список вариантов
     if new_category == '3-5':
@@ -1419,26 +2467,14 @@ async def change_category_from_failed(callback: types.CallbackQuery):
     
     await bot.send_message(user_id, text, parse_mode="HTML")
     
+    # Отвечаем на нажатие сразу, не дожидаясь отправки материалов
+    await callback.answer()
+    
+    # Дальше только запросы к Telegram API - не держим подключение к БД
+    await release_db_connection()
+    
     # Отправляем материалы
-    if materials:
-        for material in materials:
-            try:
-                # Экранируем HTML символы
-                title = escape_html(material['title'])
-                description = escape_html(material.get('description'))
-                
-                caption = f"📄 <b>{title}</b>"
-                if description:
-                    caption += f"\n\n{description}"
-                
-                if material['file_type'] == 'photo':
-                    await bot.send_photo(user_id, material['file_id'], caption=caption, parse_mode="HTML")
-                elif material['file_type'] == 'document':
-                    await bot.send_document(user_id, material['file_id'], caption=caption, parse_mode="HTML")
-                
-                await asyncio.sleep(0.5)
-            except Exception as e:
-                logging.error(f"Error sending material: {e}")
+    await send_day_materials(user_id, materials)
     
     # Отправляем кнопки завершения
     await bot.send_message(
@@ -1446,14 +2482,12 @@ async def change_category_from_failed(callback: types.CallbackQuery):
         "Выполнили задание?",
         reply_markup=get_day_completed_keyboard_new(1)
     )
-    
-    await callback.answer()
 
 @dp.callback_query(F.data == "day1_failed")
 async def day1_failed(callback: types.CallbackQuery):
     """День 1 не получился"""
     user_id = callback.from_user.id
-    progress = get_challenge_progress(user_id)
+    progress = await get_challenge_progress(user_id)
     
     if not progress:
         await callback.answer("Ошибка! Начните с /start", show_alert=True)
@@ -1502,14 +2536,14 @@ async def day1_failed(callback: types.CallbackQuery):
 async def start_day2(callback: types.CallbackQuery):
     """Начало Дня 2"""
     user_id = callback.from_user.id
-    progress = get_challenge_progress(user_id)
+    progress = await get_challenge_progress(user_id)
     
     if not progress:
         await callback.answer("Ошибка! Начните с /start", show_alert=True)
         return
     
     category = progress['age_category']
-    materials = get_challenge_materials(category, 2)
+    materials = await get_challenge_materials(category, 2)
     
     text = (
         "🎯 <b>ДЕНЬ 2: Развитие концентрации</b>\n\n"
@@ -1524,33 +2558,20 @@ async def start_day2(callback: types.CallbackQuery):
     
     await callback.message.edit_text(text, parse_mode="HTML")
     
+    # Отвечаем на нажатие сразу, не дожидаясь отправки материалов
+    await callback.answer()
+    
+    # Дальше только запросы к Telegram API - не держим подключение к БД
+    await release_db_connection()
+    
     # Отправляем материалы
-    if materials:
-        for material in materials:
-            try:
-                title = escape_html(material['title'])
-                description = escape_html(material.get('description'))
-                
-                caption = f"📄 <b>{title}</b>"
-                if description:
-                    caption += f"\n\n{description}"
-                
-                if material['file_type'] == 'photo':
-                    await bot.send_photo(user_id, material['file_id'], caption=caption, parse_mode="HTML")
-                elif material['file_type'] == 'document':
-                    await bot.send_document(user_id, material['file_id'], caption=caption, parse_mode="HTML")
-                
-                await asyncio.sleep(0.5)
-            except Exception as e:
-                logging.error(f"Error sending material: {e}")
+    await send_day_materials(user_id, materials)
     
     await bot.send_message(
         user_id,
         "Выполнили задание?",
         reply_markup=get_day_completed_keyboard_new(2)
     )
-    
-    await callback.answer()
 
 @dp.callback_query(F.data == "day2_done")
 async def day2_completed(callback: types.CallbackQuery):
@@ -1569,7 +2590,7 @@ async def day2_time_selected(callback: types.CallbackQuery):
     time_value = callback.data.replace("time2_", "")
     
     # Сохраняем и завершаем День 2
-    update_challenge_day(user_id, 2, time_value)
+    await update_challenge_day(user_id, 2, time_value)
     
     await callback.message.edit_text(
         "🎉 <b>День 2 пройден!</b>\n\n"
@@ -1609,14 +2630,14 @@ async def day2_failed(callback: types.CallbackQuery):
 async def start_day3(callback: types.CallbackQuery):
     """Начало Дня 3"""
     user_id = callback.from_user.id
-    progress = get_challenge_progress(user_id)
+    progress = await get_challenge_progress(user_id)
     
     if not progress:
         await callback.answer("Ошибка! Начните с /start", show_alert=True)
         return
     
     category = progress['age_category']
-    materials = get_challenge_materials(category, 3)
+    materials = await get_challenge_materials(category, 3)
     
     text = (
         "🎯 <b>ДЕНЬ 3: Финальный рывок!</b>\n\n"
@@ -1631,33 +2652,20 @@ async def start_day3(callback: types.CallbackQuery):
     
     await callback.message.edit_text(text, parse_mode="HTML")
     
+    # Отвечаем на нажатие сразу, не дожидаясь отправки материалов
+    await callback.answer()
+    
+    # Дальше только запросы к Telegram API - не держим подключение к БД
+    await release_db_connection()
+    
     # Отправляем материалы
-    if materials:
-        for material in materials:
-            try:
-                title = escape_html(material['title'])
-                description = escape_html(material.get('description'))
-                
-                caption = f"📄 <b>{title}</b>"
-                if description:
-                    caption += f"\n\n{description}"
-                
-                if material['file_type'] == 'photo':
-                    await bot.send_photo(user_id, material['file_id'], caption=caption, parse_mode="HTML")
-                elif material['file_type'] == 'document':
-                    await bot.send_document(user_id, material['file_id'], caption=caption, parse_mode="HTML")
-                
-                await asyncio.sleep(0.5)
-            except Exception as e:
-                logging.error(f"Error sending material: {e}")
+    await send_day_materials(user_id, materials)
     
     await bot.send_message(
         user_id,
         "Выполнили задание?",
         reply_markup=get_day_completed_keyboard_new(3)
     )
-    
-    await callback.answer()
 
 @dp.callback_query(F.data == "day3_done")
 async def day3_completed(callback: types.CallbackQuery):
@@ -1676,10 +2684,10 @@ async def day3_time_selected(callback: types.CallbackQuery):
     time_value = callback.data.replace("time3_", "")
     
     # Сохраняем и завершаем День 3
-    update_challenge_day(user_id, 3, time_value)
+    await update_challenge_day(user_id, 3, time_value)
     
-    # Получаем полный прогресс для анализа
-    progress = get_challenge_progress(user_id)
+    # Получаем полный прогресс для анализа: время дней 1-2 могла записать другая реплика
+    progress = await get_challenge_progress(user_id, fresh=True)
     
     # Функция для конвертации времени в минуты (для подсчета прогресса)
     def time_to_minutes(time_str):
@@ -1725,6 +2733,9 @@ async def day3_time_selected(callback: types.CallbackQuery):
         parse_mode="HTML"
     )
     
+    # Дальше сообщения идут с паузами - не держим подключение к БД
+    await release_db_connection()
+    
     await asyncio.sleep(2)
     
     # Второе сообщение - результаты
@@ -1798,14 +2809,11 @@ async def day3_time_selected(callback: types.CallbackQuery):
     )
     
     # Отмечаем что первое предложение отправлено
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''UPDATE challenge_progress 
-                   SET first_offer_sent = TRUE 
-                   WHERE user_id = %s''', (user_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with get_db_connection() as conn:
+        await conn.execute('''UPDATE challenge_progress 
+                              SET first_offer_sent = TRUE 
+                              WHERE user_id = %s''', (user_id,))
+    write_through_progress(user_id, first_offer_sent=True)
     
     await callback.answer()
 
@@ -1846,52 +2854,37 @@ def get_main_menu():
 # ОПЛАТА И YOOKASSA (без изменений)
 # ========================================
 
-def create_payment(user_id, amount, tariff, yookassa_id):
+async def create_payment(user_id, amount, tariff, yookassa_id):
     """Создание записи о платеже"""
-    conn = get_db_connection()
-    cur = conn.cursor()
     payment_id = f"{user_id}_{int(datetime.now().timestamp())}"
     
-    cur.execute('''INSERT INTO payments (payment_id, user_id, amount, tariff, status, yookassa_id, created_at)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s)''',
-                (payment_id, user_id, amount, tariff, 'pending', yookassa_id, datetime.now()))
+    async with get_db_connection() as conn:
+        # Два платежа за одну секунду совпадут по payment_id - откатываем только эту запись
+        async with conn.transaction():
+            await conn.execute('''INSERT INTO payments (payment_id, user_id, amount, tariff, status, yookassa_id, created_at)
+                                  VALUES (%s, %s, %s, %s, %s, %s, %s)''',
+                               (payment_id, user_id, amount, tariff, 'pending', yookassa_id, datetime.now()))
     
-    conn.commit()
-    cur.close()
-    conn.close()
     return payment_id
 
-def update_payment_status(identifier, status):
+async def update_payment_status(identifier, status):
     """Обновление статуса платежа по yookassa_id или payment_id"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Пробуем обновить по yookassa_id
-    cur.execute('UPDATE payments SET status = %s WHERE yookassa_id = %s', (status, identifier))
-    
-    if cur.rowcount == 0:
-        # Если не нашли - пробуем по payment_id
-        cur.execute('UPDATE payments SET status = %s WHERE payment_id = %s', (status, identifier))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with get_db_connection() as conn:
+        # Пробуем обновить по yookassa_id
+        cur = await conn.execute('UPDATE payments SET status = %s WHERE yookassa_id = %s', (status, identifier))
+        
+        if cur.rowcount == 0:
+            # Если не нашли - пробуем по payment_id
+            await conn.execute('UPDATE payments SET status = %s WHERE payment_id = %s', (status, identifier))
 
-def get_payment_by_yookassa_id(yookassa_id):
+async def get_payment_by_yookassa_id(yookassa_id):
     """Получение платежа по ID ЮКассы"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM payments WHERE yookassa_id = %s', (yookassa_id,))
-    payment = cur.fetchone()
-    cur.close()
-    conn.close()
-    return payment
-
-def grant_subscription(user_id, tariff_code):
+    async with get_db_connection() as conn:
+        cur = await conn.execute('SELECT * FROM payments WHERE yookassa_id = %s', (yookassa_id,))
+        return await cur.fetchone()
+
+async def grant_subscription(user_id, tariff_code):
     """Выдать подписку пользователю"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     # Проверяем в каком словаре искать тариф
     if tariff_code.startswith('stars_'):
         # Убираем префикс stars_
@@ -1907,37 +2900,155 @@ def grant_subscription(user_id, tariff_code):
     
     subscription_until = datetime.now() + timedelta(days=tariff['days'])
     
-    cur.execute('''UPDATE users 
-                   SET subscription_until = %s, tariff = %s 
-                   WHERE user_id = %s''',
-                (subscription_until, tariff_code, user_id))
-    
-    # Отмечаем что участник челленджа купил
-    cur.execute('''UPDATE challenge_progress 
-                   SET purchased = TRUE 
-                   WHERE user_id = %s''',
-                (user_id,))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with get_db_connection() as conn:
+        await conn.execute('''UPDATE users 
+                              SET subscription_until = %s, tariff = %s 
+                              WHERE user_id = %s''',
+                           (subscription_until, tariff_code, user_id))
+        
+        # Отмечаем что участник челленджа купил
+        await conn.execute('''UPDATE challenge_progress 
+                              SET purchased = TRUE 
+                              WHERE user_id = %s''',
+                           (user_id,))
+    
+    write_through_progress(user_id, purchased=True)
+
+async def get_funnel_counters():
+    """Счетчики воронки: {имя: значение}
+
+    Счетчики ведут триггеры (migrations/0004_funnel_counters.sql), здесь
+    только чтение маленькой таблицы funnel_counters по первичному ключу.
+    """
+    async with get_db_connection() as conn:
+        cur = await conn.execute('SELECT name, SUM(value) AS value FROM funnel_counters GROUP BY name')
+        return {row['name']: row['value'] for row in await cur.fetchall()}
+
+async def reconcile_funnel_counters():
+    """Пересчитать счетчики воронки по исходным таблицам
+
+    Возвращает {имя: (было, стало)} для счетчиков, которые разошлись.
+    На время пересчета запись в funnel_counters (а значит, и в таблицы
+    с триггерами) ждет его завершения.
+    """
+    before = await get_funnel_counters()
+    async with get_db_connection() as conn:
+        await conn.execute('SELECT funnel_counters_rebuild()')
+    after = await get_funnel_counters()
+    
+    return {
+        name: (before.get(name, 0), after.get(name, 0))
+        for name in sorted(set(before) | set(after))
+        if before.get(name, 0) != after.get(name, 0)
+    }
 
 # ЮKassa API
+class YooKassaClient:
+    """Клиент API ЮKassa с общей сессией на процесс
+
+    - соединения к api.yookassa.ru держатся открытыми до
+      YOOKASSA_KEEPALIVE_SECONDS и переиспользуются, TLS-рукопожатие не
+      повторяется на каждом "Проверить оплату";
+    - заголовок Basic-авторизации считается один раз;
+    - таймауты на соединение и на чтение ответа: при таймауте или сетевой
+      ошибке запрос возвращает None, как при ошибке API;
+    - время ответа копится в гистограмме по каждому методу для /stats.
+
+    Сессия открывается в start() при запуске бота и закрывается в close()
+    при остановке.
+    """
+    
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # верхние границы корзин, сек
+    
+    def __init__(self, shop_id, secret_key, base_url=YOOKASSA_API_URL):
+        self.base_url = base_url.rstrip('/')
+        auth = base64.b64encode(f"{shop_id}:{secret_key}".encode('utf-8')).decode('ascii')
+        self.headers = {"Authorization": f"Basic {auth}"}
+        self.session = None
+        self.latency = {}
+    
+    async def start(self):
+        if self.session is not None and not self.session.closed:
+            return
+        connector = aiohttp.TCPConnector(limit=YOOKASSA_POOL_SIZE, keepalive_timeout=YOOKASSA_KEEPALIVE_SECONDS,
+                                         ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(connect=YOOKASSA_CONNECT_TIMEOUT, sock_read=YOOKASSA_READ_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers)
+    
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+    
+    def observe(self, endpoint, seconds, error=False):
+        """Учесть время ответа метода endpoint в гистограмме"""
+        stats = self.latency.setdefault(endpoint, {
+            'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0,
+            'buckets': [0] * (len(self.LATENCY_BUCKETS) + 1)
+        })
+        stats['count'] += 1
+        stats['errors'] += int(error)
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+        stats['buckets'][bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+    
+    async def request(self, endpoint, method, path, **kwargs):
+        """Запрос к API: JSON ответа при 200, иначе None (ошибка пишется в лог)
+
+        Если сервер закрыл соединение из пула, пока оно простаивало, запрос
+        повторяется один раз на новом соединении. Повтор безопасен: GET
+        ничего не меняет, а POST идет с тем же Idempotence-Key.
+        Транзакция апдейта коммитится до запроса.
+        """
+        await release_db_connection()
+        await self.start()
+        started = time.monotonic()
+        error = True
+        try:
+            for attempt in range(2):
+                try:
+                    async with self.session.request(method, f"{self.base_url}{path}", **kwargs) as response:
+                        if response.status == 200:
+                            error = False
+                            return await response.json()
+                        logging.error(f"YooKassa {endpoint} error: {response.status}, {await response.text()}")
+                        return None
+                except aiohttp.ServerDisconnectedError:
+                    if attempt:
+                        raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"YooKassa {endpoint} request failed: {type(e).__name__}: {e}")
+            return None
+        finally:
+            self.observe(endpoint, time.monotonic() - started, error)
+    
+    async def create_payment(self, data):
+        return await self.request('create_payment', 'POST', '/payments', json=data,
+                                  headers={"Idempotence-Key": str(uuid.uuid4())})
+    
+    async def get_payment(self, payment_id):
+        return await self.request('get_payment', 'GET', f"/payments/{payment_id}")
+    
+    def get_stats(self):
+        """{метод: count, errors, avg, max, p50, p95} - перцентили по верхней границе корзины"""
+        result = {}
+        for endpoint, stats in self.latency.items():
+            percentiles = {}
+            for name, share in (('p50', 0.5), ('p95', 0.95)):
+                seen = 0
+                for bound, count in zip(self.LATENCY_BUCKETS + (stats['max'],), stats['buckets']):
+                    seen += count
+                    if seen >= share * stats['count']:
+                        percentiles[name] = min(bound, stats['max'])
+                        break
+            result[endpoint] = {'count': stats['count'], 'errors': stats['errors'],
+                                'avg': stats['total'] / stats['count'], 'max': stats['max'], **percentiles}
+        return result
+
+yookassa = YooKassaClient(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
+
 async def create_yookassa_payment(amount, description, user_id):
     """Создание платежа в ЮKassa"""
-    url = "https://api.yookassa.ru/v3/payments"
-    
-    idempotence_key = str(uuid.uuid4())
-    auth_string = f"{YOOKASSA_SHOP_ID}:{YOOKASSA_SECRET_KEY}"
-    auth_bytes = auth_string.encode('utf-8')
-    auth_b64 = base64.b64encode(auth_bytes).decode('utf-8')
-    
-    headers = {
-        "Idempotence-Key": idempotence_key,
-        "Content-Type": "application/json",
-        "Authorization": f"Basic {auth_b64}"
-    }
-    
     data = {
         "amount": {
             "value": f"{amount:.2f}",
@@ -1945,7 +3056,7 @@ async def create_yookassa_payment(amount, description, user_id):
         },
         "confirmation": {
             "type": "redirect",
-            "return_url": f"https://t.me/{(await bot.get_me()).username}"
+            "return_url": f"https://t.me/{(await bot.me()).username}"
         },
         "capture": True,
         "description": description,
@@ -1954,35 +3065,11 @@ async def create_yookassa_payment(amount, description, user_id):
         }
     }
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=data, headers=headers) as response:
-            if response.status == 200:
-                result = await response.json()
-                return result
-            else:
-                logging.error(f"YooKassa error: {response.status}, {await response.text()}")
-                return None
+    return await yookassa.create_payment(data)
 
 async def check_yookassa_payment(payment_id):
     """Проверка статуса платежа в ЮKassa"""
-    url = f"https://api.yookassa.ru/v3/payments/{payment_id}"
-    
-    auth_string = f"{YOOKASSA_SHOP_ID}:{YOOKASSA_SECRET_KEY}"
-    auth_bytes = auth_string.encode('utf-8')
-    auth_b64 = base64.b64encode(auth_bytes).decode('utf-8')
-    
-    headers = {
-        "Authorization": f"Basic {auth_b64}"
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                result = await response.json()
-                return result
-            else:
-                logging.error(f"YooKassa check error: {response.status}")
-                return None
+    return await yookassa.get_payment(payment_id)
 
 # ========================================
 # КЛАВИАТУРЫ ДЛЯ ОПЛАТЫ
@@ -2043,7 +3130,7 @@ def get_tariffs_menu(use_stars=False, is_challenge_participant=False):
 async def my_progress(callback: types.CallbackQuery):
     """Показать прогресс пользователя"""
     user_id = callback.from_user.id
-    progress = get_challenge_progress(user_id)
+    progress = await get_challenge_progress(user_id)
     
     if not progress:
         await callback.answer("Начните челлендж с /start", show_alert=True)
@@ -2113,7 +3200,7 @@ async def show_tariffs(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
     # Проверяем является ли участником челленджа
-    is_participant = is_challenge_participant(user_id)
+    is_participant = await is_challenge_participant(user_id)
     
     if is_participant:
         text = (
@@ -2157,7 +3244,7 @@ async def show_tariffs(callback: types.CallbackQuery):
 async def show_tariffs_rub(callback: types.CallbackQuery):
     """Показать тарифы для оплаты рублями"""
     user_id = callback.from_user.id
-    is_participant = is_challenge_participant(user_id)
+    is_participant = await is_challenge_participant(user_id)
     
     if is_participant:
         text = (
@@ -2214,7 +3301,7 @@ async def process_challenge_tariff(callback: types.CallbackQuery):
         )
         return
     
-    create_payment(user_id, tariff['price'], tariff_code, payment['id'])
+    await create_payment(user_id, tariff['price'], tariff_code, payment['id'])
     confirmation_url = payment['confirmation']['confirmation_url']
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -2260,7 +3347,7 @@ async def process_tariff(callback: types.CallbackQuery):
         )
         return
     
-    create_payment(user_id, tariff['price'], tariff_code, payment['id'])
+    await create_payment(user_id, tariff['price'], tariff_code, payment['id'])
     confirmation_url = payment['confirmation']['confirmation_url']
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -2294,7 +3381,7 @@ async def check_payment(callback: types.CallbackQuery):
     status = payment_info.get('status')
     
     if status == 'succeeded':
-        payment = get_payment_by_yookassa_id(yookassa_payment_id)
+        payment = await get_payment_by_yookassa_id(yookassa_payment_id)
         if payment:
             user_id = payment['user_id']
             tariff_code = payment['tariff']
@@ -2305,8 +3392,8 @@ async def check_payment(callback: types.CallbackQuery):
             else:
                 tariff = TARIFFS[tariff_code]
             
-            update_payment_status(yookassa_payment_id, 'completed')
-            grant_subscription(user_id, tariff_code)
+            await update_payment_status(yookassa_payment_id, 'completed')
+            await grant_subscription(user_id, tariff_code)
             
             try:
                 # Создаём инвайт в клуб
@@ -2359,7 +3446,7 @@ async def activate_promo(callback: types.CallbackQuery):
     promo_code = callback.data.replace("activate_promo_", "")
     
     # Проверяем промокод
-    promo = check_promo_code(user_id, promo_code)
+    promo = await check_promo_code(user_id, promo_code)
     
     if not promo:
         await callback.answer("❌ Промокод не найден!", show_alert=True)
@@ -2399,7 +3486,7 @@ async def process_promo_payment(callback: types.CallbackQuery):
     promo_code = callback.data.replace("promo_pay_", "")
     
     # Проверяем промокод еще раз
-    promo = check_promo_code(user_id, promo_code)
+    promo = await check_promo_code(user_id, promo_code)
     
     if not promo or (isinstance(promo, dict) and promo.get('error')):
         await callback.answer("❌ Ошибка промокода!", show_alert=True)
@@ -2427,11 +3514,11 @@ async def process_promo_payment(callback: types.CallbackQuery):
         return
     
     # Сохраняем платеж с меткой промокода
-    payment_id = create_payment(user_id, final_price, f"1month_promo_{promo_code}", payment['id'])
+    payment_id = await create_payment(user_id, final_price, f"1month_promo_{promo_code}", payment['id'])
     confirmation_url = payment['confirmation']['confirmation_url']
     
     # Отмечаем промокод как использованный
-    use_promo_code(user_id, promo_code)
+    await use_promo_code(user_id, promo_code)
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💳 Оплатить", url=confirmation_url)],
@@ -2472,7 +3559,7 @@ async def process_stars_payment(callback: types.CallbackQuery):
     payment_payload = f"stars_{user_id}_{tariff_code}_{int(datetime.now().timestamp())}"
     
     # Сохраняем платеж в БД
-    create_payment(user_id, tariff['price'], f"stars_{tariff_code}", payment_payload)
+    await create_payment(user_id, tariff['price'], f"stars_{tariff_code}", payment_payload)
     
     try:
         # Отправляем invoice (счет) для Stars
@@ -2535,10 +3622,10 @@ async def process_successful_payment(message: types.Message):
             tariff_code = parts[2]
             
             # Обновляем статус платежа
-            update_payment_status(payload, 'completed')
+            await update_payment_status(payload, 'completed')
             
             # Выдаем подписку
-            grant_subscription(user_id, f"stars_{tariff_code}")
+            await grant_subscription(user_id, f"stars_{tariff_code}")
             
             # Получаем инфо о тарифе
             if tariff_code in TARIFFS_STARS:
@@ -2649,38 +3736,21 @@ async def admin_stats(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         return
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Общая статистика
-    cur.execute('SELECT COUNT(*) as count FROM users')
-    total_users = cur.fetchone()['count']
-    
-    # Статистика челленджа
-    cur.execute('SELECT COUNT(*) as count FROM challenge_progress')
-    challenge_started = cur.fetchone()['count']
-    
-    cur.execute('SELECT COUNT(*) as count FROM challenge_progress WHERE day1_completed = TRUE')
-    day1_completed = cur.fetchone()['count']
-    
-    cur.execute('SELECT COUNT(*) as count FROM challenge_progress WHERE day2_completed = TRUE')
-    day2_completed = cur.fetchone()['count']
-    
-    cur.execute('SELECT COUNT(*) as count FROM challenge_progress WHERE day3_completed = TRUE')
-    day3_completed = cur.fetchone()['count']
-    
-    cur.execute('SELECT COUNT(*) as count FROM challenge_progress WHERE purchased = TRUE')
-    challenge_purchased = cur.fetchone()['count']
-    
-    # Оплаты
-    cur.execute('SELECT COUNT(*) as count FROM users WHERE subscription_until > NOW()')
-    paid_users = cur.fetchone()['count']
-    
-    cur.execute('SELECT COALESCE(SUM(amount), 0) as total FROM payments WHERE status = %s', ('completed',))
-    revenue = cur.fetchone()['total']
-    
-    cur.close()
-    conn.close()
+    # Воронка - из счетчиков, которые ведут триггеры
+    counters = await get_funnel_counters()
+    total_users = int(counters.get('users_total', 0))
+    challenge_started = int(counters.get('challenge_started', 0))
+    day1_completed = int(counters.get('day1_completed', 0))
+    day2_completed = int(counters.get('day2_completed', 0))
+    day3_completed = int(counters.get('day3_completed', 0))
+    challenge_purchased = int(counters.get('challenge_purchased', 0))
+    revenue = counters.get('revenue', 0)
+    
+    # Активные подписки зависят от текущего времени - считаем по частичному индексу
+    async with get_db_connection() as conn:
+        cur = await conn.execute('''SELECT COUNT(*) as count FROM users
+                                    WHERE subscription_until IS NOT NULL AND subscription_until > NOW()''')
+        paid_users = (await cur.fetchone())['count']
     
     # Конверсии
     if challenge_started > 0:
@@ -2708,8 +3778,162 @@ async def admin_stats(message: types.Message):
         f"💰 Общий доход: {revenue:.0f}₽"
     )
     
+    # Состояние пула подключений к БД
+    pool = get_db_pool_stats()
+    avg_queries = db_uow_stats['queries'] / max(db_uow_stats['updates_with_db'], 1)
+    text += (
+        "\n\n⚙️ <b>Пул БД:</b>\n"
+        f"Соединений: {pool['size']}/{pool['max']} (свободно {pool['available']})\n"
+        f"Ждут соединения: {pool['waiting']}\n"
+        f"Запросов к пулу: {pool['requests']}, ожидание {pool['wait_ms']} мс, таймаутов {pool['timeouts']}\n"
+        f"Апдейтов с БД: {db_uow_stats['updates_with_db']} из {db_uow_stats['updates']}, "
+        f"запросов на апдейт: в среднем {avg_queries:.1f}, максимум {db_uow_stats['max_queries']}"
+    )
+    
+    cache = progress_cache.get_stats()
+    text += (
+        "\n\n🧠 <b>Кэш прогресса:</b>\n"
+        f"Пользователей: {cache['size']}/{cache['max']}, попаданий {cache['hits']}, "
+        f"промахов {cache['misses']}, вытеснено {cache['evictions']}"
+    )
+    
+    outbox = await get_outbox_stats()
+    pending = ', '.join(f"{escape_html(kind)} {count}" for kind, count in outbox['pending'].items()) or 'пусто'
+    finished = outbox['finished']
+    text += (
+        "\n\n📣 <b>Очередь рассылок:</b>\n"
+        f"Ожидают: {pending}\n"
+        f"За сутки: ✅ {finished.get('sent', 0)}, 🚫 {finished.get('blocked', 0)}, "
+        f"🔕 {finished.get('suppressed', 0)}, ❌ {finished['dead']} (/requeue_dead)\n"
+        f"Ошибки отправки с запуска: "
+        f"{', '.join(f'{error_class} {count}' for error_class, count in sorted(outbox['errors'].items())) or 'нет'}\n"
+        f"Поставлено правилами с запуска: "
+        f"{', '.join(f'{kind} {count}' for kind, count in sorted(reminder_rule_stats.items())) or 'ничего'}\n"
+        f"Журнал отправок: занято {reminder_ledger_stats['claimed']}, "
+        f"повторов отсечено {reminder_ledger_stats['duplicates']}\n"
+        f"🔕 Заблокировали бота: {outbox['blocked_users']}, пропущено с запуска: "
+        f"напоминаний {blocked_suppression_stats['reminders']}, задач очереди {blocked_suppression_stats['outbox']}"
+    )
+    if outbox['waves']:
+        text += "\n<b>Последние волны:</b>"
+        for wave in outbox['waves']:
+            done = wave['sent'] + wave['blocked'] + wave['suppressed'] + wave['dead']
+            status = f"завершена в {wave['finished_at']:%H:%M}" if wave['finished_at'] else "идет"
+            text += (
+                f"\n{escape_html(wave['kind'])} #{wave['sweep_run']} ({status}): {done}/{wave['total']}, "
+                f"✅ {wave['sent']}, 🚫 {wave['blocked']}, 🔕 {wave['suppressed']}, ❌ {wave['dead']}"
+            )
+    
+    leader = await scheduler_leader.get_info()
+    if leader is None:
+        text += "\n\n👑 <b>Планировщик:</b> ведущей реплики еще не было"
+    else:
+        this_replica = " (эта реплика)" if scheduler_leader.is_leader else ""
+        stale = " ⚠️ нет пульса" if leader['heartbeat_age'] > LEADER_HEARTBEAT_SECONDS * 3 else ""
+        text += (
+            "\n\n👑 <b>Планировщик:</b>\n"
+            f"Ведущая реплика: {escape_html(leader['holder'])}{this_replica}, "
+            f"лидерство {format_duration(leader['lease_age'])}, "
+            f"пульс {leader['heartbeat_age']:.0f} сек назад{stale}\n"
+            f"Эта реплика: {escape_html(REPLICA_ID)}, становилась ведущей {scheduler_leader.elections} раз"
+        )
+    
+    limiter = telegram_rate_limiter.get_stats()
+    text += (
+        "\n\n📨 <b>Исходящие в Telegram:</b>\n"
+        f"Отправок: {limiter['requests']}, ждали лимита {limiter['throttled']} раз "
+        f"({limiter['wait_seconds']:.0f} сек), retry_after: {limiter['retry_after']}\n"
+        f"Текущий лимит: {limiter['rate']:.1f} сообщ./сек, чатов в учете: {limiter['chats']}"
+    )
+    
+    payments_api = yookassa.get_stats()
+    if payments_api:
+        text += "\n\n💳 <b>ЮKassa API:</b>"
+        for endpoint, stats in sorted(payments_api.items()):
+            text += (
+                f"\n{endpoint}: {stats['count']} запросов, ошибок {stats['errors']}, "
+                f"p50 ≤ {stats['p50']:.2f} сек, p95 ≤ {stats['p95']:.2f} сек, max {stats['max']:.2f} сек"
+            )
+    
+    catalog = materials_catalog.get_stats()
+    text += (
+        "\n\n📚 <b>Кэш материалов:</b>\n"
+        f"Материалов: {catalog['materials']}, попаданий {catalog['hits']}, "
+        f"промахов {catalog['misses']}, загрузок из БД {catalog['reloads']}"
+    )
+    
+    await message.answer(text, parse_mode="HTML")
+
+@dp.message(Command("reconcile_stats"))
+async def admin_reconcile_stats(message: types.Message):
+    """Пересчет счетчиков воронки с нуля (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    await message.answer("⏳ Пересчитываю счетчики статистики...")
+    
+    drift = await reconcile_funnel_counters()
+    # Отпускаем блокировку funnel_counters до ответа в Telegram
+    await release_db_connection()
+    
+    if not drift:
+        await message.answer("✅ Счетчики совпадают с данными, расхождений нет.")
+        return
+    
+    lines = [f"• {name}: {before:.0f} → {after:.0f}" for name, (before, after) in drift.items()]
+    await message.answer(
+        "✅ <b>Счетчики пересчитаны</b>\n\n"
+        "Исправлены расхождения:\n" + "\n".join(lines),
+        parse_mode="HTML"
+    )
+
+@dp.message(Command("jobs"))
+async def admin_jobs(message: types.Message):
+    """Расписание фоновых джоб (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    text = (
+        "⏰ <b>Расписание джоб</b>\n"
+        f"Идет одновременно: {job_supervisor.running_count()} из {job_supervisor.max_concurrent}\n"
+    )
+    if not scheduler_leader.is_leader:
+        text += "⚠️ Эта реплика не ведущая: джобы выполняет другая (см. /stats)\n"
+    for job in scheduler.get_jobs():
+        record = job_supervisor.record(job.name)
+        if job_supervisor.is_running(job.name):
+            status = "▶️ идет"
+        elif job.due_at is None:
+            status = "не запланирована"
+        else:
+            status = f"следующий запуск {job.due_at:%d.%m %H:%M:%S}"
+        text += f"\n<b>{escape_html(job.name)}</b>: {status}\n"
+        if record['last_started_at']:
+            text += f"Прошлый запуск: {record['last_started_at']:%d.%m %H:%M:%S}"
+            if record['last_duration'] is not None:
+                text += f" ({record['last_duration']:.1f} сек)"
+            text += "\n"
+        text += (
+            f"Запусков: {record['runs']}, ошибок: {record['failures']}, пропущено слотов: {job.missed}, "
+            f"пропущено из-за долгого запуска: {record['skipped']}, "
+            f"ждали слота: {record['waited']}\n"
+        )
+        if record['last_error']:
+            text += f"❌ Ошибка: {escape_html(record['last_error'])}\n"
+
     await message.answer(text, parse_mode="HTML")
 
+@dp.message(Command("requeue_dead"))
+async def admin_requeue_dead(message: types.Message):
+    """Вернуть в очередь неотправленные задачи: /requeue_dead [вид] (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    parts = message.text.split()
+    kind = parts[1] if len(parts) > 1 else None
+    requeued = await requeue_dead_letters(kind)
+    await message.answer(f"✅ Возвращено в очередь: {requeued}")
+
 @dp.message(Command("upload_material"))
 async def cmd_upload_material(message: types.Message, state: FSMContext):
     """Команда для загрузки материалов (только для админа)"""
@@ -2869,7 +4093,7 @@ async def upload_photo_received(message: types.Message, state: FSMContext):
     description = data.get('description')
     
     # Сохраняем в БД
-    result = save_material(category, day, variant, title, description, file_id, file_type)
+    result = await save_material(category, day, variant, title, description, file_id, file_type)
     
     action = "обновлён" if result == "updated" else "создан"
     
@@ -2906,7 +4130,7 @@ async def upload_document_received(message: types.Message, state: FSMContext):
     description = data.get('description')
     
     # Сохраняем в БД
-    result = save_material(category, day, variant, title, description, file_id, file_type)
+    result = await save_material(category, day, variant, title, description, file_id, file_type)
     
     action = "обновлён" if result == "updated" else "создан"
     
@@ -2968,16 +4192,11 @@ async def cmd_list_materials(message: types.Message):
         await message.answer("⛔️ Эта команда доступна только администратору.")
         return
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute('''SELECT age_category, day, variant, title, file_type
-                   FROM challenge_materials
-                   ORDER BY age_category, day, variant''')
-    
-    materials = cur.fetchall()
-    cur.close()
-    conn.close()
+    async with get_db_connection() as conn:
+        cur = await conn.execute('''SELECT age_category, day, variant, title, file_type
+                                    FROM challenge_materials
+                                    ORDER BY age_category, day, variant''')
+        materials = await cur.fetchall()
     
     if not materials:
         await message.answer("📭 Материалов пока нет.")
@@ -3042,19 +4261,15 @@ async def cmd_delete_material(message: types.Message):
         await message.answer("❌ Неверный формат! День и вариант должны быть числами.")
         return
     
-    conn = get_db_connection()
-    cur = conn.cursor()
+    async with get_db_connection() as conn:
+        cur = await conn.execute('''DELETE FROM challenge_materials 
+                                    WHERE age_category = %s AND day = %s AND variant = %s
+                                    RETURNING title''',
+                                 (category, day, variant))
+        deleted = await cur.fetchone()
     
-    cur.execute('''DELETE FROM challenge_materials 
-                   WHERE age_category = %s AND day = %s AND variant = %s
-                   RETURNING title''',
-                (category, day, variant))
-    
-    deleted = cur.fetchone()
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    if deleted:
+        on_db_commit(materials_catalog.invalidate)
     
     if deleted:
         await message.answer(
@@ -3090,7 +4305,7 @@ async def cmd_create_promo(message: types.Message):
         hours = int(parts[3])
         description = parts[4]
         
-        create_promo_code(code, discount, hours, description)
+        await create_promo_code(code, discount, hours, description)
         
         await message.answer(
             f"✅ Промокод создан!\n\n"
@@ -3107,65 +4322,577 @@ async def cmd_create_promo(message: types.Message):
 # ПЛАНИРОВЩИК ЗАДАЧ
 # ========================================
 
-async def run_scheduled_reminders():
-    """Фоновая задача для всех напоминаний"""
-    from datetime import datetime
+class SchedulerClock:
+    """Часы планировщика
+
+    Расписание считается по настенному времени (now), а ожидание - по
+    монотонным часам (monotonic), которые не прыгают при переводе
+    системного времени.
+    """
     
-    while True:
+    def now(self):
+        return datetime.now()
+    
+    def monotonic(self):
+        return time.monotonic()
+    
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+class ScheduledJob:
+    """Джоба планировщика: запуск каждые every (timedelta)
+
+    catch_up=True - func получает catch_up: сколько прошло с прошлого
+    успешного запуска (после рестарта - по job_runs), или None, если
+    успешных запусков еще не было. Так джоба расширяет окно догона на
+    время простоя.
+    """
+    
+    def __init__(self, name, func, every, catch_up=False):
+        self.name = name
+        self.func = func
+        self.every = every
+        self.catch_up = catch_up
+        
+        self.next_run = None  # ближайший слот по расписанию
+        self.due_at = None  # когда запускать по настенным часам
+        self.deadline = None  # то же по монотонным часам
+        self.covered_until = None  # до какого времени отработал прошлый успешный запуск
+        self.missed = 0
+    
+    def next_slot(self, after):
+        """Первый слот расписания строго после after
+
+        Слоты кратны every от начала суток, чтобы реплики совпадали.
+        """
+        midnight = after.replace(hour=0, minute=0, second=0, microsecond=0)
+        return after - (after - midnight) % self.every + self.every
+
+async def load_job_runs():
+    """Конец последнего успешного запуска каждой джобы: {имя: datetime}"""
+    async with get_db_connection() as conn:
+        cur = await conn.execute('SELECT job_name, last_success_at FROM job_runs WHERE last_success_at IS NOT NULL')
+        return {row['job_name']: row['last_success_at'] for row in await cur.fetchall()}
+
+async def save_job_run(job, started_at, duration, error=None):
+    """Записать итог запуска джобы в job_runs"""
+    async with get_db_connection() as conn:
+        await conn.execute('''INSERT INTO job_runs (job_name, last_success_at, last_started_at,
+                                                    last_duration_seconds, last_error, runs, failures)
+                              VALUES (%s, %s, %s, %s, %s, 1, %s)
+                              ON CONFLICT (job_name) DO UPDATE
+                              SET last_success_at = COALESCE(EXCLUDED.last_success_at, job_runs.last_success_at),
+                                  last_started_at = EXCLUDED.last_started_at,
+                                  last_duration_seconds = EXCLUDED.last_duration_seconds,
+                                  last_error = EXCLUDED.last_error,
+                                  runs = job_runs.runs + 1,
+                                  failures = job_runs.failures + EXCLUDED.failures''',
+                           (job.name, None if error else job.covered_until, started_at,
+                            duration, error, 1 if error else 0))
+
+class JobSupervisor:
+    """Запуск фоновых задач процесса
+
+    Джобы (конечные задачи с именем):
+    - ссылки на идущие задачи хранятся здесь, сборщик мусора их не соберет;
+    - одна джоба не идет в двух экземплярах: перекрывающийся запуск
+      отклоняется;
+    - одновременно выполняется не больше max_concurrent джоб, остальные
+      ждут свободного слота;
+    - длительность и итог каждого запуска пишутся в records.
+
+    Сервисы (бесконечные циклы вроде воркера outbox) в лимит не входят.
+    shutdown перестает принимать запуски, ждет идущие джобы и только потом
+    останавливает сервисы: ведущая реплика держит блокировку планировщика,
+    пока ее джобы не закончатся.
+    """
+    
+    def __init__(self, max_concurrent, clock=None):
+        self.max_concurrent = max_concurrent
+        self.clock = clock or SchedulerClock()
+        self.tasks = {}  # имя джобы -> задача (идет или ждет слота)
+        self.services = {}
+        self.records = {}
+        self.closing = False
+        self._slots = asyncio.Semaphore(max_concurrent)
+    
+    def record(self, name):
+        return self.records.setdefault(name, {
+            'runs': 0, 'failures': 0, 'skipped': 0, 'waited': 0,
+            'last_started_at': None, 'last_duration': None, 'last_error': None
+        })
+    
+    def is_running(self, name):
+        task = self.tasks.get(name)
+        return task is not None and not task.done()
+    
+    def running_count(self):
+        return sum(1 for name in self.tasks if self.is_running(name))
+    
+    def submit(self, name, func):
+        """Запустить func() как джобу name. Возвращает False, если запуск отклонен"""
+        record = self.record(name)
+        if self.closing:
+            record['skipped'] += 1
+            return False
+        
+        if self.is_running(name):
+            record['skipped'] += 1
+            logging.warning(f"Job {name} is still running, skipping this run")
+            return False
+        
+        self.tasks[name] = asyncio.create_task(self._run(name, func, record))
+        return True
+    
+    async def _run(self, name, func, record):
         try:
-            now = datetime.now()
-            hour = now.hour
-            minute = now.minute
-            
-            # Утренние напоминания (6:00 UTC = 9:00 МСК)
-            if hour == 6 and minute == 0:
-                asyncio.create_task(send_day2_reminders())
-                asyncio.create_task(send_day3_reminders())
-            
-            # Вечерние напоминания (17:00 UTC = 20:00 МСК)
-            if hour == 17 and minute == 0:
-                asyncio.create_task(send_day1_evening_reminder())
-                asyncio.create_task(send_day2_evening_reminder())
-                asyncio.create_task(send_day3_evening_reminder())
-            
-            # Воронка продаж (каждый час на :00 и :30)
-            if minute == 0:
-                asyncio.create_task(send_12h_reminder())
-            if minute == 30:
-                asyncio.create_task(send_24h_final_offer())
-            
-            # Проверяем каждую минуту
-            await asyncio.sleep(60)
+            if self._slots.locked():
+                record['waited'] += 1
+                logging.info(f"Job {name} is waiting for a free slot, {self.max_concurrent} jobs running")
             
+            async with self._slots:
+                record['last_started_at'] = self.clock.now()
+                started = self.clock.monotonic()
+                try:
+                    await func()
+                    record['last_error'] = None
+                except asyncio.CancelledError:
+                    record['last_error'] = 'cancelled'
+                    raise
+                except Exception as e:
+                    record['failures'] += 1
+                    record['last_error'] = str(e)
+                    logging.error(f"Error in job {name}: {e}")
+                finally:
+                    record['runs'] += 1
+                    record['last_duration'] = self.clock.monotonic() - started
+                    logging.info(f"Job {name} finished in {record['last_duration']:.1f}s: "
+                                 f"{record['last_error'] or 'ok'}")
+        finally:
+            self.tasks.pop(name, None)
+    
+    def cancel_jobs(self, names):
+        """Отменить идущие и ждущие слота джобы с именами из names"""
+        for name in names:
+            if self.is_running(name):
+                logging.warning(f"Cancelling job {name}")
+                self.tasks[name].cancel()
+    
+    def start_service(self, name, coro):
+        """Запустить бесконечную фоновую задачу"""
+        task = self.services[name] = asyncio.create_task(coro)
+        task.add_done_callback(lambda task: self._on_service_done(name, task))
+    
+    def stop_service(self, name):
+        task = self.services.pop(name, None)
+        if task is not None:
+            task.cancel()
+    
+    def _on_service_done(self, name, task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Background service {name} crashed: {task.exception()}")
+    
+    async def shutdown(self, timeout):
+        """Дождаться идущих джоб (не дольше timeout секунд) и остановить сервисы"""
+        self.closing = True
+        jobs = [task for task in self.tasks.values() if not task.done()]
+        if jobs:
+            logging.info(f"Waiting for {len(jobs)} running job(s) to finish")
+            _, pending = await asyncio.wait(jobs, timeout=timeout)
+            for task in pending:
+                logging.warning(f"Job did not finish in {timeout}s, cancelling")
+                task.cancel()
+            jobs = list(pending)
+        
+        for task in self.services.values():
+            task.cancel()
+        await asyncio.gather(*self.services.values(), *jobs, return_exceptions=True)
+
+job_supervisor = JobSupervisor(JOBS_MAX_CONCURRENT)
+
+class Scheduler:
+    """Планировщик на куче: джобы упорядочены по времени ближайшего запуска
+
+    Между запусками спит ровно до ближайшей джобы (но не дольше
+    SCHEDULER_MAX_SLEEP_SECONDS, чтобы заметить перевод часов или сон
+    машины). Слот, который наступил, пока процесс стоял, не теряется:
+    джоба запускается сразу, пропущенные слоты считаются в missed.
+
+    Успешные запуски пишутся в job_runs. При старте планировщик читает
+    журнал, и джобы, чей слот прошел, пока бот не работал, запускаются сразу.
+    """
+    
+    def __init__(self, clock=None, supervisor=None):
+        self.clock = clock or SchedulerClock()
+        self.supervisor = supervisor or job_supervisor
+        self.jobs = {}
+        self._heap = []
+        self._seq = 0  # разводит джобы с одинаковым deadline в куче
+    
+    def add_job(self, job):
+        self.jobs[job.name] = job
+    
+    async def restore(self):
+        """Поставить джобы в расписание с учетом журнала запусков"""
+        try:
+            last_success = await load_job_runs()
+        except Exception as e:
+            logging.error(f"Error loading job_runs, scheduling without catch-up: {e}")
+            last_success = {}
+        
+        now = self.clock.now()
+        self._heap = []
+        for job in self.jobs.values():
+            job.covered_until = last_success.get(job.name)
+            if job.covered_until is not None and job.next_slot(job.covered_until) <= now:
+                # Слот прошел, пока бот не работал - запускаем сразу
+                logging.info(f"Job {job.name} is overdue since {job.next_slot(job.covered_until)}, catching up")
+                job.next_run = job.next_slot(job.covered_until)
+                job.due_at = now
+                job.deadline = self.clock.monotonic()
+                self._push(job)
+            else:
+                self._schedule(job, now)
+    
+    def _push(self, job):
+        self._seq += 1
+        heapq.heappush(self._heap, (job.deadline, self._seq, job))
+    
+    def _schedule(self, job, after):
+        now = self.clock.now()
+        job.next_run = job.next_slot(after)
+        delay = (job.next_run - now).total_seconds()
+        job.due_at = now + timedelta(seconds=delay)
+        job.deadline = self.clock.monotonic() + delay
+        self._push(job)
+    
+    def _is_due(self, job):
+        return self.clock.monotonic() >= job.deadline or self.clock.now() >= job.due_at
+    
+    def _fire(self, job):
+        now = self.clock.now()
+        late = now - job.next_run
+        missed = int(late / job.every)
+        if missed:
+            job.missed += missed
+            logging.warning(f"Job {job.name} is {late} late, {missed} missed run(s)")
+        
+        # Перекрытия запусков и общий лимит джоб - забота JobSupervisor
+        self.supervisor.submit(job.name, lambda: self._run(job, now))
+        
+        self._schedule(job, now)
+    
+    async def _run(self, job, until):
+        started_at = self.clock.now()
+        started = self.clock.monotonic()
+        error = None
+        try:
+            if job.catch_up:
+                await job.func(catch_up=until - job.covered_until if job.covered_until else None)
+            else:
+                await job.func()
+            job.covered_until = until
+        except asyncio.CancelledError:
+            error = 'cancelled'
+            raise
         except Exception as e:
-            logging.error(f"Error in run_scheduled_reminders: {e}")
-            await asyncio.sleep(60)
+            error = str(e)
+            raise
+        finally:
+            try:
+                await save_job_run(job, started_at, self.clock.monotonic() - started, error)
+            except Exception as e:
+                logging.error(f"Error saving job run {job.name}: {e}")
+    
+    async def run(self):
+        """Фоновая задача планировщика"""
+        await self.restore()
+        while True:
+            try:
+                while self._heap and self._is_due(self._heap[0][2]):
+                    _, _, job = heapq.heappop(self._heap)
+                    self._fire(job)
+                
+                wait = SCHEDULER_MAX_SLEEP_SECONDS
+                if self._heap:
+                    wait = min(wait, max(self._heap[0][0] - self.clock.monotonic(), 0))
+                await self.clock.sleep(wait)
+            except Exception as e:
+                logging.error(f"Error in scheduler: {e}")
+                await self.clock.sleep(SCHEDULER_MAX_SLEEP_SECONDS)
+    
+    def get_jobs(self):
+        """Джобы в порядке ближайшего запуска - для /jobs"""
+        return sorted(self.jobs.values(), key=lambda job: job.due_at or datetime.max)
+
+scheduler = Scheduler()
+
+class LeaderElection:
+    """Выбор ведущей реплики по advisory-блокировке Postgres
+
+    Ведущая реплика держит сессионную блокировку pg_try_advisory_lock на
+    отдельном соединении, взятом из пула на все время лидерства, и
+    раз в LEADER_HEARTBEAT_SECONDS проверяет это соединение. Если процесс
+    ведущей умрет, Postgres закроет его сессию и снимет блокировку (при
+    пропаже сети - по keepalive-настройкам сессии, за ~10 секунд), и одна
+    из остальных реплик захватит ее не позже чем через LEADER_RETRY_SECONDS.
+
+    on_elected/on_demoted вызываются, когда эта реплика стала ведущей или
+    перестала ею быть. Кто ведущий и с какого момента, пишется в
+    scheduler_leader - для /stats.
+    """
+    
+    def __init__(self, name, on_elected, on_demoted):
+        self.name = name
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.conn = None
+        self.is_leader = False
+        self.elected_at = None
+        self.elections = 0  # сколько раз эта реплика становилась ведущей
+    
+    async def run(self):
+        """Фоновая задача выборов; при отмене блокировка отпускается сразу"""
+        try:
+            while True:
+                try:
+                    if self.is_leader:
+                        await self._heartbeat()
+                        await asyncio.sleep(LEADER_HEARTBEAT_SECONDS)
+                        continue
+                    
+                    await self._try_acquire()
+                    if not self.is_leader:
+                        await asyncio.sleep(LEADER_RETRY_SECONDS)
+                except Exception as e:
+                    logging.error(f"Error in {self.name} leader election: {e}")
+                    await self._release(lost=True)
+                    await asyncio.sleep(LEADER_RETRY_SECONDS)
+        finally:
+            await self._release()
+    
+    async def _try_acquire(self):
+        conn = await db_pool.getconn()
+        try:
+            await conn.set_autocommit(True)
+            cur = await conn.execute('SELECT pg_try_advisory_lock(hashtext(%s)) AS locked', (self.name,))
+            locked = (await cur.fetchone())['locked']
+            if locked:
+                # Если хост ведущей пропадет из сети, Postgres заметит это
+                # по keepalive и снимет блокировку, не дожидаясь таймаутов TCP
+                await conn.execute('SET tcp_keepalives_idle = 5; SET tcp_keepalives_interval = 2; '
+                                   'SET tcp_keepalives_count = 3')
+                await conn.execute('''INSERT INTO scheduler_leader (name, holder, acquired_at, heartbeat_at)
+                                      VALUES (%s, %s, NOW(), NOW())
+                                      ON CONFLICT (name) DO UPDATE
+                                      SET holder = EXCLUDED.holder, acquired_at = EXCLUDED.acquired_at,
+                                          heartbeat_at = EXCLUDED.heartbeat_at''',
+                                   (self.name, REPLICA_ID))
+        except Exception:
+            await conn.close()
+            await db_pool.putconn(conn)
+            raise
+        
+        if not locked:
+            await conn.set_autocommit(False)
+            await db_pool.putconn(conn)
+            return
+        
+        self.conn = conn
+        self.is_leader = True
+        self.elected_at = datetime.now()
+        self.elections += 1
+        logging.info(f"Replica {REPLICA_ID} is now the {self.name} leader")
+        self.on_elected()
+    
+    async def _heartbeat(self):
+        await self.conn.execute('''UPDATE scheduler_leader SET heartbeat_at = NOW()
+                                   WHERE name = %s AND holder = %s''',
+                                (self.name, REPLICA_ID))
+    
+    async def _release(self, lost=False):
+        """Перестать быть ведущей: отпустить блокировку и вернуть соединение в пул
+
+        lost=True - соединение могло сломаться: закрываем его, вместе с
+        сессией Postgres снимет и блокировку.
+        """
+        if self.is_leader:
+            self.is_leader = False
+            self.elected_at = None
+            logging.warning(f"Replica {REPLICA_ID} is no longer the {self.name} leader")
+            self.on_demoted()
+        
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        
+        if not lost:
+            try:
+                await conn.execute('SELECT pg_advisory_unlock(hashtext(%s))', (self.name,))
+                await conn.execute('RESET ALL')
+                await conn.set_autocommit(False)
+            except Exception as e:
+                logging.error(f"Error releasing {self.name} leader lock: {e}")
+                lost = True
+        if lost:
+            await conn.close()
+        await db_pool.putconn(conn)
+    
+    async def get_info(self):
+        """Текущий ведущий для /stats: holder, возраст лидерства и пульса в секундах"""
+        async with get_db_connection() as conn:
+            cur = await conn.execute('''SELECT holder,
+                                               EXTRACT(EPOCH FROM NOW()::timestamp - acquired_at) AS lease_age,
+                                               EXTRACT(EPOCH FROM NOW()::timestamp - heartbeat_at) AS heartbeat_age
+                                        FROM scheduler_leader WHERE name = %s''',
+                                     (self.name,))
+            return await cur.fetchone()
+
+def on_scheduler_elected():
+    """Реплика стала ведущей: запустить планировщик и воркер outbox"""
+    job_supervisor.start_service('scheduler', scheduler.run())
+    job_supervisor.start_service('outbox_worker', run_outbox_worker())
+
+def on_scheduler_demoted():
+    """Реплика перестала быть ведущей: остановить планировщик, его идущие джобы и воркер outbox
+
+    Иначе запуск, начатый до потери блокировки, продолжал бы проход правил
+    одновременно с новой ведущей. Проход коммитит каждую пачку участников
+    отдельно: отмена откатывает только текущую, ее заберет новая ведущая.
+    Задачи outbox, взятые остановленным воркером, новая ведущая заберет
+    по истечении аренды; журнал reminders не даст отправить их дважды.
+    """
+    job_supervisor.stop_service('scheduler')
+    job_supervisor.cancel_jobs(scheduler.jobs)
+    job_supervisor.stop_service('outbox_worker')
+
+# Джобы по расписанию и рассылку из outbox выполняет только ведущая реплика
+scheduler_leader = LeaderElection(
+    'scheduler',
+    on_elected=on_scheduler_elected,
+    on_demoted=on_scheduler_demoted
+)
+
+def register_reminder_jobs(target=None):
+    """Расписание напоминаний (в scheduler или в переданный планировщик)
+
+    Все напоминания - утро и вечер дней челленджа и воронка продаж - идут
+    по next_action_at участников: джоба часто проверяет правила для тех,
+    у кого подошло время. Что просрочено за время простоя, догоняется
+    первым запуском после рестарта: окно догона - с last_success_at из
+    job_runs (но не меньше REMINDER_MAX_CATCH_UP_HOURS/FUNNEL_MAX_CATCH_UP_HOURS).
+    """
+    (target or scheduler).add_job(ScheduledJob('reminder_rules', run_reminder_rules,
+                                               every=timedelta(seconds=REMINDER_SWEEP_SECONDS),
+                                               catch_up=True))
 
 # ========================================
 # ЗАПУСК БОТА
 # ========================================
 
+async def set_telegram_webhook(bot):
+    """Хук старта диспетчера в режиме вебхука: сообщить Telegram адрес бота
+
+    Все реплики ставят один и тот же адрес, поэтому повторный вызов ничего
+    не меняет. Апдейты - только тех типов, на которые есть обработчики.
+    """
+    allowed_updates = dp.resolve_used_update_types()
+    await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                          allowed_updates=allowed_updates, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    logging.info(f"Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}, updates: {', '.join(allowed_updates)}")
+
+async def on_webhook_shutdown():
+    """Хук остановки диспетчера в режиме вебхука
+
+    Вебхук не снимаем: остальные реплики продолжают принимать апдейты, а
+    пока их нет, Telegram копит апдейты и доставит после перезапуска.
+    """
+    logging.info(f"Replica {REPLICA_ID} stops accepting webhook updates")
+
+async def run_webhook():
+    """Принимать апдейты через вебхук, пока не придет SIGINT/SIGTERM
+
+    Апдейт обрабатывается в самом запросе: ответ Telegram уходит после
+    коммита единицы работы, и при ошибке обработчика Telegram повторит
+    апдейт. При остановке сервер перестает принимать соединения и ждет
+    идущие запросы не дольше SHUTDOWN_DRAIN_SECONDS.
+    """
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
+    
+    app = web.Application()
+    handler = SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET,
+                                   handle_in_background=False)
+    app.router.add_post(WEBHOOK_PATH, handler)
+    dp.startup.register(set_telegram_webhook)
+    dp.shutdown.register(on_webhook_shutdown)
+    setup_application(app, dp, bot=bot)
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    runner = web.AppRunner(app, shutdown_timeout=SHUTDOWN_DRAIN_SECONDS)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logging.info(f"Listening for webhook updates on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await stop.wait()
+        logging.info("Stopping webhook server...")
+    finally:
+        await runner.cleanup()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+
+async def run_polling():
+    """Long polling с перезапуском после падения - для локальной разработки"""
+    while True:
+        try:
+            logging.info("Starting polling...")
+            # allowed_updates по умолчанию - типы апдейтов, на которые есть обработчики.
+            # Сессию бота закрывает main после остановки джоб - они еще шлют сообщения
+            await dp.start_polling(bot, polling_timeout=30, close_bot_session=False)
+            # Polling остановлен сигналом - выходим
+            break
+        except Exception as e:
+            logging.error(f"Polling crashed: {e}")
+            logging.info("Restarting in 5 seconds...")
+            await asyncio.sleep(5)
+
 async def main():
     """Главная функция"""
-    init_db()
+    await init_db_pool()
+    await init_db()
+    await materials_catalog.load()
+    await yookassa.start()
+    
+    dp.update.outer_middleware(DbUnitOfWorkMiddleware())
+    bot.session.middleware(CommitBeforeOutboundMiddleware())
+    bot.session.middleware(telegram_rate_limiter)
 
     # Создаем промокод CHALLENGE50 если его нет
-    create_promo_code("CHALLENGE50", 50, 48, "Скидка 50% для участников челленджа")
+    await create_promo_code("CHALLENGE50", 50, 48, "Скидка 50% для участников челленджа")
     
     logging.info("Bot started successfully!")
     
-    # Запускаем планировщик
-    asyncio.create_task(run_scheduled_reminders())
+    # Запускаем выборы ведущей реплики: она ведет планировщик с правилами
+    # напоминаний и воркер очереди отправки
+    register_reminder_jobs()
+    job_supervisor.start_service('leader_election', scheduler_leader.run())
     
-    # Polling
-    while True:
-        try:
-            logging.info("Starting polling...")
-            await dp.start_polling(bot, timeout=30, request_timeout=20)
-        except Exception as e:
-            logging.error(f"Polling crashed: {e}")
-            logging.info("Restarting in 5 seconds...")
-            await asyncio.sleep(5)
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        # Джобы пишут в БД и отправляют сообщения - пул и сессию бота
+        # закрываем после них
+        await job_supervisor.shutdown(SHUTDOWN_DRAIN_SECONDS)
+        await close_db_pool()
+        await yookassa.close()
+        await bot.session.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,109 @@
+-- Базовая схема бота (то, что раньше создавал init_db при каждом старте).
+-- Все операторы идемпотентны, поэтому миграция безопасно применяется
+-- и к пустой базе, и к уже работающей.
+
+-- Таблица пользователей
+CREATE TABLE IF NOT EXISTS users
+    (user_id BIGINT PRIMARY KEY,
+     username TEXT,
+     started_at TIMESTAMP,
+     day1_completed BOOLEAN DEFAULT FALSE,
+     day2_completed BOOLEAN DEFAULT FALSE,
+     day3_completed BOOLEAN DEFAULT FALSE,
+     subscription_until TIMESTAMP,
+     tariff TEXT,
+     bot_blocked BOOLEAN DEFAULT FALSE,
+     created_at TIMESTAMP DEFAULT NOW());
+
+-- Таблица платежей
+CREATE TABLE IF NOT EXISTS payments
+    (payment_id TEXT PRIMARY KEY,
+     user_id BIGINT,
+     amount REAL,
+     tariff TEXT,
+     status TEXT,
+     yookassa_id TEXT,
+     created_at TIMESTAMP DEFAULT NOW());
+
+-- Таблица напоминаний
+CREATE TABLE IF NOT EXISTS reminders
+    (id SERIAL PRIMARY KEY,
+     user_id BIGINT,
+     day INTEGER,
+     reminder_type TEXT,
+     sent_at TIMESTAMP,
+     UNIQUE(user_id, day, reminder_type));
+
+-- Таблица прогресса челленджа
+CREATE TABLE IF NOT EXISTS challenge_progress (
+    user_id BIGINT PRIMARY KEY,
+    age INT,
+    age_category VARCHAR(10),
+    current_day INT DEFAULT 1,
+    is_active BOOLEAN DEFAULT TRUE,
+    started_at TIMESTAMP DEFAULT NOW(),
+    day1_completed BOOLEAN DEFAULT FALSE,
+    day1_time VARCHAR(20),
+    day1_difficulty VARCHAR(20),
+    day1_completed_at TIMESTAMP,
+    day2_completed BOOLEAN DEFAULT FALSE,
+    day2_time VARCHAR(20),
+    day2_completed_at TIMESTAMP,
+    day3_completed BOOLEAN DEFAULT FALSE,
+    day3_time VARCHAR(20),
+    day3_completed_at TIMESTAMP,
+    last_reminder_sent TIMESTAMP,
+    reminder_count INT DEFAULT 0,
+    day1_reminder_sent BOOLEAN DEFAULT FALSE,
+    day2_reminder_sent BOOLEAN DEFAULT FALSE,
+    day3_reminder_sent BOOLEAN DEFAULT FALSE,
+    category_changed BOOLEAN DEFAULT FALSE,
+    original_category VARCHAR(10),
+    completed_at TIMESTAMP,
+    purchased BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Таблица материалов челленджа
+CREATE TABLE IF NOT EXISTS challenge_materials (
+    id SERIAL PRIMARY KEY,
+    age_category VARCHAR(10) NOT NULL,
+    day INT NOT NULL,
+    variant INT NOT NULL,
+    title TEXT NOT NULL,
+    description TEXT,
+    file_id TEXT NOT NULL,
+    file_type VARCHAR(20),
+    created_at TIMESTAMP DEFAULT NOW(),
+    UNIQUE(age_category, day, variant)
+);
+
+-- Колонки для воронки продаж
+ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS first_offer_sent BOOLEAN DEFAULT FALSE;
+ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS reminder_12h_sent BOOLEAN DEFAULT FALSE;
+ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS reminder_24h_sent BOOLEAN DEFAULT FALSE;
+ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS promo_code_sent BOOLEAN DEFAULT FALSE;
+
+-- Колонки для вечерних напоминаний
+ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS day1_evening_reminder_sent BOOLEAN DEFAULT FALSE;
+ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS day2_evening_reminder_sent BOOLEAN DEFAULT FALSE;
+ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS day3_evening_reminder_sent BOOLEAN DEFAULT FALSE;
+
+-- Таблица для промокодов
+CREATE TABLE IF NOT EXISTS promo_codes (
+    code VARCHAR(50) PRIMARY KEY,
+    discount_percent INT,
+    valid_hours INT,
+    description TEXT,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Таблица использования промокодов
+CREATE TABLE IF NOT EXISTS promo_usage (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT,
+    promo_code VARCHAR(50),
+    used_at TIMESTAMP DEFAULT NOW(),
+    UNIQUE(user_id, promo_code)
+);
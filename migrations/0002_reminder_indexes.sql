@@ -0,0 +1,42 @@
+-- migrate: no-transaction
+-- Частичные индексы под запросы напоминаний и воронки продаж.
+-- Каждый индекс содержит только тех, кому напоминание еще предстоит,
+-- поэтому он остается маленьким, сколько бы участников ни накопилось.
+-- Строятся CONCURRENTLY, чтобы не блокировать запись в challenge_progress.
+
+-- send_day2_reminders
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_progress_day2_reminder
+    ON challenge_progress (day1_completed_at)
+    WHERE day1_completed AND NOT day2_completed AND NOT day2_reminder_sent AND is_active;
+
+-- send_day3_reminders
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_progress_day3_reminder
+    ON challenge_progress (day2_completed_at)
+    WHERE day2_completed AND NOT day3_completed AND NOT day3_reminder_sent AND is_active;
+
+-- send_day1_evening_reminder
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_progress_day1_evening
+    ON challenge_progress (started_at)
+    WHERE is_active AND current_day = 1 AND NOT day1_completed AND NOT day1_evening_reminder_sent;
+
+-- send_day2_evening_reminder
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_progress_day2_evening
+    ON challenge_progress (day1_completed_at)
+    WHERE is_active AND current_day = 2 AND NOT day2_completed
+      AND NOT day2_evening_reminder_sent AND day2_reminder_sent;
+
+-- send_day3_evening_reminder
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_progress_day3_evening
+    ON challenge_progress (day2_completed_at)
+    WHERE is_active AND current_day = 3 AND NOT day3_completed
+      AND NOT day3_evening_reminder_sent AND day3_reminder_sent;
+
+-- send_12h_reminder
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_progress_12h_offer
+    ON challenge_progress (day3_completed_at)
+    WHERE day3_completed AND first_offer_sent AND NOT reminder_12h_sent AND NOT purchased;
+
+-- send_24h_final_offer
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_progress_24h_offer
+    ON challenge_progress (day3_completed_at)
+    WHERE day3_completed AND reminder_12h_sent AND NOT reminder_24h_sent AND NOT purchased;
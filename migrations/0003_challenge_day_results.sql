@@ -0,0 +1,114 @@
+-- Результаты по дням челленджа - отдельной строкой на (пользователь, день)
+-- вместо колонок day1_/day2_/day3_ в challenge_progress.
+--
+-- Строка дня создается, когда день открывается участнику: День 1 - при
+-- старте челленджа, следующий день - при завершении предыдущего
+-- (unlocked_at). В ней же хранятся отметки об утреннем и вечернем
+-- напоминании этого дня.
+
+CREATE TABLE IF NOT EXISTS challenge_day_results (
+    user_id BIGINT NOT NULL,
+    day INT NOT NULL,
+    unlocked_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    completed BOOLEAN NOT NULL DEFAULT FALSE,
+    completed_at TIMESTAMP,
+    time_spent VARCHAR(20),
+    difficulty VARCHAR(20),
+    reminder_sent BOOLEAN NOT NULL DEFAULT FALSE,
+    evening_reminder_sent BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (user_id, day)
+);
+
+-- Перенос данных из широкой таблицы
+INSERT INTO challenge_day_results
+    (user_id, day, unlocked_at, completed, completed_at, time_spent, difficulty,
+     reminder_sent, evening_reminder_sent)
+SELECT user_id, 1, COALESCE(started_at, created_at, NOW()),
+       COALESCE(day1_completed, FALSE), day1_completed_at, day1_time, day1_difficulty,
+       COALESCE(day1_reminder_sent, FALSE), COALESCE(day1_evening_reminder_sent, FALSE)
+FROM challenge_progress
+ON CONFLICT (user_id, day) DO NOTHING;
+
+INSERT INTO challenge_day_results
+    (user_id, day, unlocked_at, completed, completed_at, time_spent,
+     reminder_sent, evening_reminder_sent)
+SELECT user_id, 2, COALESCE(day1_completed_at, started_at, NOW()),
+       COALESCE(day2_completed, FALSE), day2_completed_at, day2_time,
+       COALESCE(day2_reminder_sent, FALSE), COALESCE(day2_evening_reminder_sent, FALSE)
+FROM challenge_progress
+WHERE day1_completed
+ON CONFLICT (user_id, day) DO NOTHING;
+
+INSERT INTO challenge_day_results
+    (user_id, day, unlocked_at, completed, completed_at, time_spent,
+     reminder_sent, evening_reminder_sent)
+SELECT user_id, 3, COALESCE(day2_completed_at, started_at, NOW()),
+       COALESCE(day3_completed, FALSE), day3_completed_at, day3_time,
+       COALESCE(day3_reminder_sent, FALSE), COALESCE(day3_evening_reminder_sent, FALSE)
+FROM challenge_progress
+WHERE day2_completed
+ON CONFLICT (user_id, day) DO NOTHING;
+
+-- Дата завершения челленджа теперь единственный признак прохождения
+-- для воронки продаж
+UPDATE challenge_progress
+SET completed_at = day3_completed_at
+WHERE day3_completed AND completed_at IS NULL;
+
+-- Индексы для утренних и вечерних напоминаний по дням: незавершенные
+-- дни нужного номера по времени открытия. Предикат по флагу отправки
+-- оставляет в индексе только тех, кому напоминание еще предстоит,
+-- а не всех бросивших челлендж.
+CREATE INDEX IF NOT EXISTS ix_day_results_reminder
+    ON challenge_day_results (day, unlocked_at)
+    WHERE NOT completed AND NOT reminder_sent;
+
+CREATE INDEX IF NOT EXISTS ix_day_results_evening
+    ON challenge_day_results (day, unlocked_at)
+    WHERE NOT completed AND NOT evening_reminder_sent;
+
+-- Флаги сильно коррелируют (давно брошенные дни уже с отправленными
+-- напоминаниями); без совместной статистики планировщик ошибается
+-- в оценке на два порядка и выбирает Seq Scan по challenge_progress.
+CREATE STATISTICS IF NOT EXISTS st_day_results_flags (mcv)
+    ON day, completed, reminder_sent, evening_reminder_sent
+    FROM challenge_day_results;
+
+-- Индексы из 0002 на удаляемые колонки
+DROP INDEX IF EXISTS ix_progress_day2_reminder;
+DROP INDEX IF EXISTS ix_progress_day3_reminder;
+DROP INDEX IF EXISTS ix_progress_day1_evening;
+DROP INDEX IF EXISTS ix_progress_day2_evening;
+DROP INDEX IF EXISTS ix_progress_day3_evening;
+DROP INDEX IF EXISTS ix_progress_12h_offer;
+DROP INDEX IF EXISTS ix_progress_24h_offer;
+
+ALTER TABLE challenge_progress
+    DROP COLUMN IF EXISTS day1_completed,
+    DROP COLUMN IF EXISTS day1_time,
+    DROP COLUMN IF EXISTS day1_difficulty,
+    DROP COLUMN IF EXISTS day1_completed_at,
+    DROP COLUMN IF EXISTS day2_completed,
+    DROP COLUMN IF EXISTS day2_time,
+    DROP COLUMN IF EXISTS day2_completed_at,
+    DROP COLUMN IF EXISTS day3_completed,
+    DROP COLUMN IF EXISTS day3_time,
+    DROP COLUMN IF EXISTS day3_completed_at,
+    DROP COLUMN IF EXISTS day1_reminder_sent,
+    DROP COLUMN IF EXISTS day2_reminder_sent,
+    DROP COLUMN IF EXISTS day3_reminder_sent,
+    DROP COLUMN IF EXISTS day1_evening_reminder_sent,
+    DROP COLUMN IF EXISTS day2_evening_reminder_sent,
+    DROP COLUMN IF EXISTS day3_evening_reminder_sent;
+
+-- Воронка продаж: те же частичные индексы, но по completed_at
+CREATE INDEX IF NOT EXISTS ix_progress_12h_offer
+    ON challenge_progress (completed_at)
+    WHERE first_offer_sent AND NOT reminder_12h_sent AND NOT purchased;
+
+CREATE INDEX IF NOT EXISTS ix_progress_24h_offer
+    ON challenge_progress (completed_at)
+    WHERE reminder_12h_sent AND NOT reminder_24h_sent AND NOT purchased;
+
+ANALYZE challenge_day_results;
+ANALYZE challenge_progress;
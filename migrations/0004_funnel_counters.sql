@@ -0,0 +1,139 @@
+-- Счетчики воронки для /stats, которые поддерживаются триггерами при
+-- каждой записи, вместо полных COUNT/SUM по таблицам при каждом вызове.
+--
+-- Каждый счетчик разбит на 16 шардов по user_id: параллельные транзакции
+-- разных пользователей обновляют разные строки и не ждут друг друга на
+-- блокировке одной "горячей" строки. Значение счетчика - SUM по шардам.
+
+CREATE TABLE IF NOT EXISTS funnel_counters (
+    name TEXT NOT NULL,
+    shard INT NOT NULL,
+    value NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, shard)
+);
+
+CREATE OR REPLACE FUNCTION funnel_counter_add(counter_name TEXT, key BIGINT, delta NUMERIC)
+RETURNS VOID AS $$
+BEGIN
+    IF delta = 0 THEN
+        RETURN;
+    END IF;
+    INSERT INTO funnel_counters (name, shard, value)
+    VALUES (counter_name, (key % 16)::INT, delta)
+    ON CONFLICT (name, shard) DO UPDATE SET value = funnel_counters.value + EXCLUDED.value;
+END;
+$$ LANGUAGE plpgsql;
+
+-- users: всего пользователей
+CREATE OR REPLACE FUNCTION funnel_users_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM funnel_counter_add('users_total', NEW.user_id, 1);
+    ELSE
+        PERFORM funnel_counter_add('users_total', OLD.user_id, -1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS funnel_users ON users;
+CREATE TRIGGER funnel_users AFTER INSERT OR DELETE ON users
+    FOR EACH ROW EXECUTE FUNCTION funnel_users_trigger();
+
+-- challenge_progress: начали челлендж, купили после челленджа
+CREATE OR REPLACE FUNCTION funnel_progress_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM funnel_counter_add('challenge_started', NEW.user_id, 1);
+        PERFORM funnel_counter_add('challenge_purchased', NEW.user_id, COALESCE(NEW.purchased, FALSE)::INT);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM funnel_counter_add('challenge_started', OLD.user_id, -1);
+        PERFORM funnel_counter_add('challenge_purchased', OLD.user_id, -COALESCE(OLD.purchased, FALSE)::INT);
+    ELSE
+        PERFORM funnel_counter_add('challenge_purchased', NEW.user_id,
+                                   COALESCE(NEW.purchased, FALSE)::INT - COALESCE(OLD.purchased, FALSE)::INT);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS funnel_progress ON challenge_progress;
+CREATE TRIGGER funnel_progress AFTER INSERT OR DELETE OR UPDATE OF purchased ON challenge_progress
+    FOR EACH ROW EXECUTE FUNCTION funnel_progress_trigger();
+
+-- challenge_day_results: завершили день N (счетчик dayN_completed)
+CREATE OR REPLACE FUNCTION funnel_day_results_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM funnel_counter_add('day' || NEW.day || '_completed', NEW.user_id, NEW.completed::INT);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM funnel_counter_add('day' || OLD.day || '_completed', OLD.user_id, -OLD.completed::INT);
+    ELSE
+        PERFORM funnel_counter_add('day' || NEW.day || '_completed', NEW.user_id,
+                                   NEW.completed::INT - OLD.completed::INT);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS funnel_day_results ON challenge_day_results;
+CREATE TRIGGER funnel_day_results AFTER INSERT OR DELETE OR UPDATE OF completed ON challenge_day_results
+    FOR EACH ROW EXECUTE FUNCTION funnel_day_results_trigger();
+
+-- payments: общий доход по завершенным платежам
+CREATE OR REPLACE FUNCTION funnel_payments_trigger() RETURNS TRIGGER AS $$
+DECLARE
+    old_revenue NUMERIC := 0;
+    new_revenue NUMERIC := 0;
+    key BIGINT;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'completed' THEN
+        old_revenue := COALESCE(OLD.amount, 0);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'completed' THEN
+        new_revenue := COALESCE(NEW.amount, 0);
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        key := COALESCE(OLD.user_id, 0);
+    ELSE
+        key := COALESCE(NEW.user_id, 0);
+    END IF;
+    PERFORM funnel_counter_add('revenue', key, new_revenue - old_revenue);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS funnel_payments ON payments;
+CREATE TRIGGER funnel_payments AFTER INSERT OR DELETE OR UPDATE OF status, amount ON payments
+    FOR EACH ROW EXECUTE FUNCTION funnel_payments_trigger();
+
+-- Полный пересчет счетчиков по исходным таблицам (для миграции и /reconcile_stats).
+-- EXCLUSIVE-блокировка funnel_counters дожидается уже идущих транзакций,
+-- которые успели изменить счетчики, и не дает триггерам новых транзакций
+-- писать до конца пересчета - так пересчет не теряет и не задваивает записи.
+CREATE OR REPLACE FUNCTION funnel_counters_rebuild() RETURNS VOID AS $$
+BEGIN
+    LOCK TABLE funnel_counters IN EXCLUSIVE MODE;
+    DELETE FROM funnel_counters;
+
+    INSERT INTO funnel_counters (name, shard, value)
+    SELECT 'users_total', 0, COUNT(*) FROM users;
+
+    INSERT INTO funnel_counters (name, shard, value)
+    SELECT 'challenge_started', 0, COUNT(*) FROM challenge_progress;
+
+    INSERT INTO funnel_counters (name, shard, value)
+    SELECT 'challenge_purchased', 0, COUNT(*) FROM challenge_progress WHERE purchased;
+
+    INSERT INTO funnel_counters (name, shard, value)
+    SELECT 'day' || day || '_completed', 0, COUNT(*)
+    FROM challenge_day_results
+    WHERE completed
+    GROUP BY day;
+
+    INSERT INTO funnel_counters (name, shard, value)
+    SELECT 'revenue', 0, COALESCE(SUM(amount), 0) FROM payments WHERE status = 'completed';
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT funnel_counters_rebuild();
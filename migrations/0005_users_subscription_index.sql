@@ -0,0 +1,8 @@
+-- migrate: no-transaction
+-- Число активных подписок зависит от текущего времени (subscription_until > NOW()),
+-- поэтому его нельзя держать счетчиком в funnel_counters. Частичный индекс
+-- содержит только пользователей с подпиской, и /stats считает их по индексу,
+-- не читая всю таблицу users.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_subscription_until
+    ON users (subscription_until)
+    WHERE subscription_until IS NOT NULL;
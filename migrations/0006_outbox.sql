@@ -0,0 +1,41 @@
+-- Очередь исходящих сообщений (outbox).
+--
+-- Джобы напоминаний не отправляют сообщения сами, а одним оператором
+-- ставят флаг напоминания и кладут строку в outbox. Строки разбирают
+-- воркеры всех запущенных процессов (FOR UPDATE SKIP LOCKED), поэтому
+-- рестарт посреди рассылки не теряет получателей, а вторая реплика
+-- не отправляет то же самое повторно.
+--
+-- available_at - когда строку можно взять в работу. Воркер, забирая
+-- строку, сдвигает available_at на время аренды: если процесс умрет,
+-- строка снова станет доступной, когда аренда истечет. После ошибки
+-- available_at сдвигается на время повторной попытки.
+
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    user_id BIGINT NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    attempts INT NOT NULL DEFAULT 0,
+    available_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS ix_outbox_available_at ON outbox (available_at);
+
+-- Обработанные строки: отправленные, заблокировавшие бота и
+-- исчерпавшие попытки
+CREATE TABLE IF NOT EXISTS outbox_archive (
+    id BIGINT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    user_id BIGINT NOT NULL,
+    payload JSONB NOT NULL,
+    attempts INT NOT NULL,
+    status TEXT NOT NULL,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS ix_outbox_archive_finished_at ON outbox_archive (finished_at);
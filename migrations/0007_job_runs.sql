@@ -0,0 +1,17 @@
+-- Журнал запусков джоб планировщика.
+--
+-- last_success_at - до какого момента джоба отработала успешно. После
+-- рестарта планировщик сравнивает его с расписанием: если слот джобы
+-- прошел, пока бот не работал, джоба запускается сразу, а джоба
+-- напоминаний получает окно догона от last_success_at до текущего
+-- момента: пропущенные за простой шаги воронки все равно отправляются.
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    job_name TEXT PRIMARY KEY,
+    last_success_at TIMESTAMP,
+    last_started_at TIMESTAMP,
+    last_duration_seconds DOUBLE PRECISION,
+    last_error TEXT,
+    runs BIGINT NOT NULL DEFAULT 0,
+    failures BIGINT NOT NULL DEFAULT 0
+);
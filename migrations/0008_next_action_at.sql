@@ -0,0 +1,51 @@
+-- Время напоминаний по каждому участнику вместо общих 6:00/17:00 UTC.
+--
+-- challenge_progress.next_action_at - когда участнику пора проверить
+-- утреннее или вечернее напоминание (next_action = 'morning'/'evening').
+-- Время считается по часовому поясу пользователя (users.timezone, по
+-- умолчанию московское) и сдвигается на offset, чтобы участники одного
+-- пояса не получали напоминания в одну и ту же секунду. У неактивных
+-- участников next_action_at = NULL.
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone TEXT;
+
+ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS next_action_at TIMESTAMP;
+ALTER TABLE challenge_progress ADD COLUMN IF NOT EXISTS next_action TEXT;
+
+CREATE INDEX IF NOT EXISTS ix_progress_next_action_at
+    ON challenge_progress (next_action_at)
+    WHERE next_action_at IS NOT NULL;
+
+-- Ближайший после after слот напоминания в поясе tz: утро или вечер
+-- сегодня или завтра по местному времени, плюс offset
+CREATE OR REPLACE FUNCTION next_reminder_slot(tz TEXT, after TIMESTAMPTZ, morning TIME, evening TIME, "offset" INTERVAL)
+RETURNS TABLE (at TIMESTAMPTZ, action TEXT) AS $$
+    SELECT slot, kind
+    FROM (
+        SELECT ((after AT TIME ZONE tz)::date + days.n + times.t) AT TIME ZONE tz + "offset" AS slot, times.kind
+        FROM (VALUES (0), (1)) AS days (n),
+             (VALUES (morning, 'morning'), (evening, 'evening')) AS times (t, kind)
+    ) slots
+    WHERE slot > after
+    ORDER BY slot
+    LIMIT 1
+$$ LANGUAGE sql STABLE;
+
+-- Заполняем для текущих участников: timezone еще ни у кого не задан,
+-- значения совпадают с настройками по умолчанию в challenge_bot.py
+UPDATE challenge_progress cp
+SET (next_action_at, next_action) = (
+    SELECT slot.at, slot.action
+    FROM next_reminder_slot('Europe/Moscow', NOW(), '09:00', '20:00',
+                            make_interval(secs => cp.user_id % 1800)) slot
+)
+WHERE cp.is_active;
+
+-- Общие утренние и вечерние выборки по номеру дня больше не нужны:
+-- строки дней читаются по первичному ключу для участников, у которых
+-- подошло время
+DROP INDEX IF EXISTS ix_day_results_reminder;
+DROP INDEX IF EXISTS ix_day_results_evening;
+DROP STATISTICS IF EXISTS st_day_results_flags;
+
+ANALYZE challenge_progress;
@@ -0,0 +1,32 @@
+-- Правила напоминаний: воронка продаж тоже идет через next_action_at.
+--
+-- После завершения челленджа участнику назначается next_action = 'offer_12h'
+-- через 12 часов, затем 'offer_24h' через 24 часа после завершения. Все
+-- правила напоминаний проверяются одним проходом по next_action_at, и
+-- отдельные выборки воронки по completed_at больше не нужны.
+
+-- Минуты занятия по ответу на вопрос о времени (для прогресса в офере 12ч)
+CREATE OR REPLACE FUNCTION time_spent_minutes(time_spent TEXT) RETURNS INT AS $$
+    SELECT CASE
+        WHEN time_spent LIKE '%less5%' THEN 4
+        WHEN time_spent LIKE '%5-10%' THEN 7
+        WHEN time_spent LIKE '%10-15%' THEN 12
+        WHEN time_spent LIKE '%more15%' THEN 18
+        ELSE 0
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Участники, которые уже в воронке
+UPDATE challenge_progress
+SET next_action_at = completed_at + INTERVAL '12 hours', next_action = 'offer_12h'
+WHERE NOT is_active
+AND completed_at > NOW() - INTERVAL '12 hours';
+
+UPDATE challenge_progress
+SET next_action_at = completed_at + INTERVAL '24 hours', next_action = 'offer_24h'
+WHERE NOT is_active
+AND completed_at <= NOW() - INTERVAL '12 hours'
+AND completed_at > NOW() - INTERVAL '24 hours';
+
+DROP INDEX IF EXISTS ix_progress_12h_offer;
+DROP INDEX IF EXISTS ix_progress_24h_offer;
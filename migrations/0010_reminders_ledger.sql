@@ -0,0 +1,17 @@
+-- Таблица reminders - журнал отправленных напоминаний.
+--
+-- Перед отправкой задачи outbox занимает строку (user_id, day,
+-- reminder_type) через INSERT ... ON CONFLICT DO NOTHING и отправляет
+-- только если строка занята этим вызовом. Повторная доставка той же
+-- задачи (истекла аренда, задача поставлена дважды) натыкается на
+-- занятую строку и ничего не отправляет.
+--
+-- claimed_at - когда строку заняли; sent_at - когда Telegram принял
+-- сообщение. Строку, занятую, но не отправленную дольше аренды outbox
+-- (процесс упал посреди отправки), можно занять заново.
+
+ALTER TABLE reminders ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP;
+
+-- История отправок по типу напоминания
+CREATE INDEX IF NOT EXISTS ix_reminders_type_sent_at
+    ON reminders (reminder_type, sent_at);
@@ -0,0 +1,30 @@
+-- Задачи outbox, которые не удалось отправить.
+--
+-- Сюда попадают задачи с ошибкой, которую повтор не исправит (неверный
+-- запрос, чат не найден), и задачи, исчерпавшие OUTBOX_MAX_ATTEMPTS.
+-- error_class - класс последней ошибки, чтобы видеть, что именно
+-- сломалось. Команда /requeue_dead возвращает задачи в очередь.
+
+CREATE TABLE IF NOT EXISTS outbox_dead_letter (
+    id BIGINT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    user_id BIGINT NOT NULL,
+    payload JSONB NOT NULL,
+    attempts INT NOT NULL,
+    error_class TEXT NOT NULL,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL,
+    failed_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS ix_outbox_dead_letter_failed_at ON outbox_dead_letter (failed_at);
+
+-- Раньше такие задачи архивировались со статусом 'failed'
+WITH failed AS (
+    DELETE FROM outbox_archive WHERE status = 'failed' RETURNING *
+)
+INSERT INTO outbox_dead_letter (id, kind, user_id, payload, attempts, error_class, last_error, created_at, failed_at)
+SELECT id, kind, user_id, payload, attempts, COALESCE(split_part(last_error, ':', 1), 'Exception'),
+       last_error, created_at, finished_at
+FROM failed
+ON CONFLICT (id) DO NOTHING;
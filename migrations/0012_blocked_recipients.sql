@@ -0,0 +1,8 @@
+-- Подавление отправок пользователям, заблокировавшим бота.
+--
+-- users.bot_blocked ставится, когда Telegram ответил Forbidden, и
+-- снимается повторным /start. Правила напоминаний и воркер outbox
+-- пропускают таких получателей (по первичному ключу users), индекс
+-- нужен для подсчета заблокировавших в /stats.
+
+CREATE INDEX IF NOT EXISTS ix_users_bot_blocked ON users (user_id) WHERE bot_blocked;
@@ -0,0 +1,13 @@
+-- Ведущая реплика планировщика.
+--
+-- Кто ведущий, решает сессионная advisory-блокировка: ее держит одна
+-- реплика на отдельном соединении. Таблица только показывает в /stats,
+-- какая реплика держит блокировку, с какого момента и когда она
+-- последний раз подавала признаки жизни.
+
+CREATE TABLE IF NOT EXISTS scheduler_leader (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    acquired_at TIMESTAMP NOT NULL,
+    heartbeat_at TIMESTAMP NOT NULL
+);
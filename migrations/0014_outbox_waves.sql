@@ -0,0 +1,29 @@
+-- Итоги волн рассылки.
+--
+-- Волна - задачи одного вида (kind), поставленные одним запуском джобы
+-- правил напоминаний (sweep_run). total растет, пока запуск ставит
+-- задачи, в конце запуска волна запечатывается (sealed). Воркеры outbox,
+-- архивируя задачи или перенося их в outbox_dead_letter, увеличивают
+-- sent/blocked/suppressed/dead; когда запечатанная волна обработана
+-- целиком, ставится finished_at и итог пишется в лог.
+
+CREATE SEQUENCE IF NOT EXISTS reminder_sweep_runs;
+
+CREATE TABLE IF NOT EXISTS outbox_waves (
+    kind TEXT NOT NULL,
+    sweep_run BIGINT NOT NULL,
+    total INT NOT NULL DEFAULT 0,
+    sent INT NOT NULL DEFAULT 0,
+    blocked INT NOT NULL DEFAULT 0,
+    suppressed INT NOT NULL DEFAULT 0,
+    dead INT NOT NULL DEFAULT 0,
+    sealed BOOLEAN NOT NULL DEFAULT FALSE,
+    started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    finished_at TIMESTAMP,
+    PRIMARY KEY (kind, sweep_run)
+);
+
+-- Задачи, поставленные до этой миграции, ни к какой волне не относятся
+ALTER TABLE outbox ADD COLUMN IF NOT EXISTS sweep_run BIGINT;
+ALTER TABLE outbox_archive ADD COLUMN IF NOT EXISTS sweep_run BIGINT;
+ALTER TABLE outbox_dead_letter ADD COLUMN IF NOT EXISTS sweep_run BIGINT;
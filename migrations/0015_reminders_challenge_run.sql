@@ -0,0 +1,24 @@
+-- Журнал reminders по запускам челленджа.
+--
+-- Повторный старт челленджа (start_challenge) заново открывает дни, и
+-- напоминания нового запуска должны уйти снова. Поэтому в ключ журнала
+-- входит run_started_at - challenge_progress.started_at того запуска,
+-- в котором напоминание занято.
+--
+-- Старым строкам достается started_at текущего запуска, если их заняли
+-- уже после него, иначе 'epoch' (строка прошлого запуска).
+
+ALTER TABLE reminders ADD COLUMN IF NOT EXISTS run_started_at TIMESTAMP;
+
+UPDATE reminders r
+SET run_started_at = COALESCE(
+    (SELECT cp.started_at FROM challenge_progress cp
+     WHERE cp.user_id = r.user_id AND COALESCE(r.sent_at, r.claimed_at) >= cp.started_at),
+    'epoch')
+WHERE run_started_at IS NULL;
+
+ALTER TABLE reminders ALTER COLUMN run_started_at SET NOT NULL;
+
+ALTER TABLE reminders DROP CONSTRAINT IF EXISTS reminders_user_id_day_reminder_type_key;
+CREATE UNIQUE INDEX IF NOT EXISTS ux_reminders_run
+    ON reminders (user_id, run_started_at, day, reminder_type);
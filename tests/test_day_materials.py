@@ -0,0 +1,107 @@
+"""send_day_materials: альбомы по типам и отправка по одному, если альбом отклонен"""
+import asyncio
+import os
+import sys
+
+import pytest
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import SendDocument, SendMediaGroup, SendPhoto
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import challenge_bot as cb  # noqa: E402
+
+USER_ID = 42
+
+
+class StubSession(BaseSession):
+    """Сессия бота без Telegram: запоминает запросы, альбомы может отклонять"""
+
+    def __init__(self, reject_albums=False):
+        super().__init__()
+        self.reject_albums = reject_albums
+        self.requests = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append(method)
+        if self.reject_albums and isinstance(method, SendMediaGroup):
+            raise TelegramBadRequest(method, 'Bad Request: wrong file identifier/HTTP URL specified')
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def install(**kwargs):
+        session = StubSession(**kwargs)
+        monkeypatch.setattr(cb.bot, 'session', session)
+        return session
+    return install
+
+
+def material(file_id, file_type):
+    return {'file_id': file_id, 'file_type': file_type, 'title': file_id, 'description': None}
+
+
+def sent(session):
+    """(метод, file_id) по порядку отправки"""
+    result = []
+    for method in session.requests:
+        if isinstance(method, SendMediaGroup):
+            result.append(('album', [item.media for item in method.media]))
+        elif isinstance(method, SendPhoto):
+            result.append(('photo', method.photo))
+        elif isinstance(method, SendDocument):
+            result.append(('document', method.document))
+    return result
+
+
+def test_photos_and_documents_go_in_separate_albums(session):
+    stub = session()
+    materials = [material('photo-1', 'photo'), material('doc-1', 'document'),
+                 material('photo-2', 'photo'), material('doc-2', 'document')]
+
+    asyncio.run(cb.send_day_materials(USER_ID, materials))
+
+    assert sent(stub) == [('album', ['photo-1', 'photo-2']), ('album', ['doc-1', 'doc-2'])]
+    photos, documents = stub.requests
+    assert all(item.type == 'photo' for item in photos.media)
+    assert all(item.type == 'document' for item in documents.media)
+    assert photos.chat_id == USER_ID
+
+
+def test_single_material_of_a_type_is_sent_on_its_own(session):
+    stub = session()
+    materials = [material('photo-1', 'photo'), material('photo-2', 'photo'), material('doc-1', 'document')]
+
+    asyncio.run(cb.send_day_materials(USER_ID, materials))
+
+    assert sent(stub) == [('album', ['photo-1', 'photo-2']), ('document', 'doc-1')]
+
+
+def test_albums_are_split_by_ten(session):
+    stub = session()
+    materials = [material(f'photo-{i}', 'photo') for i in range(12)]
+
+    asyncio.run(cb.send_day_materials(USER_ID, materials))
+
+    assert [len(items) for kind, items in sent(stub)] == [10, 2]
+
+
+def test_rejected_album_falls_back_to_one_by_one(session):
+    stub = session(reject_albums=True)
+    materials = [material('photo-1', 'photo'), material('photo-2', 'photo'),
+                 material('doc-1', 'document'), material('doc-2', 'document')]
+
+    asyncio.run(cb.send_day_materials(USER_ID, materials))
+
+    assert sent(stub) == [
+        ('album', ['photo-1', 'photo-2']), ('photo', 'photo-1'), ('photo', 'photo-2'),
+        ('album', ['doc-1', 'doc-2']), ('document', 'doc-1'), ('document', 'doc-2'),
+    ]
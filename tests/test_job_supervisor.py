@@ -0,0 +1,149 @@
+"""JobSupervisor: перекрытия, лимит одновременных джоб и остановка"""
+import asyncio
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import challenge_bot as cb  # noqa: E402
+
+
+class FakeClock:
+    """Часы, которые идут только по advance"""
+
+    def __init__(self):
+        self.wall = datetime(2026, 1, 1, 12, 0)
+        self.mono = 1000.0
+
+    def now(self):
+        return self.wall
+
+    def monotonic(self):
+        return self.mono
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(0)
+
+
+async def settle():
+    """Дать созданным задачам дойти до ближайшего await"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_overlapping_run_is_skipped():
+    async def scenario():
+        supervisor = cb.JobSupervisor(4, FakeClock())
+        release = asyncio.Event()
+        started = []
+
+        async def job():
+            started.append(1)
+            await release.wait()
+
+        assert supervisor.submit('sweep', job)
+        await settle()
+        assert not supervisor.submit('sweep', job)
+
+        release.set()
+        await settle()
+        assert not supervisor.is_running('sweep')
+        record = supervisor.record('sweep')
+        assert (len(started), record['runs'], record['skipped']) == (1, 1, 1)
+
+        # После окончания запуска джобу снова можно запустить
+        assert supervisor.submit('sweep', job)
+        await settle()
+        assert len(started) == 2
+
+    asyncio.run(scenario())
+
+
+def test_max_concurrent_jobs():
+    async def scenario():
+        supervisor = cb.JobSupervisor(2, FakeClock())
+        release = asyncio.Event()
+        running = []
+        peak = []
+
+        def job():
+            async def run():
+                running.append(1)
+                peak.append(len(running))
+                await release.wait()
+                running.pop()
+            return run
+
+        for name in ('a', 'b', 'c', 'd'):
+            assert supervisor.submit(name, job())
+        await settle()
+        assert len(running) == 2
+        assert supervisor.running_count() == 4  # остальные ждут слота
+        assert sum(supervisor.record(name)['waited'] for name in 'abcd') == 2
+
+        release.set()
+        await settle()
+        assert max(peak) == 2
+        assert sum(supervisor.record(name)['runs'] for name in 'abcd') == 4
+
+    asyncio.run(scenario())
+
+
+def test_shutdown_waits_for_jobs_then_cancels_the_rest():
+    async def scenario():
+        supervisor = cb.JobSupervisor(4, FakeClock())
+        events = []
+
+        async def quick():
+            await asyncio.sleep(0.01)
+            events.append('quick done')
+
+        async def stuck():
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                events.append('stuck cancelled')
+                raise
+
+        async def service():
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                events.append('service stopped')
+                raise
+
+        supervisor.start_service('worker', service())
+        supervisor.submit('quick', quick)
+        supervisor.submit('stuck', stuck)
+        await settle()
+
+        await supervisor.shutdown(0.1)
+
+        # Сервисы останавливаются только после джоб
+        assert events == ['quick done', 'stuck cancelled', 'service stopped']
+        assert supervisor.record('quick')['last_error'] is None
+        assert supervisor.record('stuck')['last_error'] == 'cancelled'
+        assert not supervisor.submit('quick', quick)
+
+    asyncio.run(scenario())
+
+
+def test_cancel_jobs_cancels_only_named_jobs():
+    async def scenario():
+        supervisor = cb.JobSupervisor(4, FakeClock())
+
+        async def forever():
+            await asyncio.Event().wait()
+
+        supervisor.submit('sweep', forever)
+        supervisor.submit('other', forever)
+        await settle()
+
+        supervisor.cancel_jobs(['sweep'])
+        await settle()
+        assert not supervisor.is_running('sweep')
+        assert supervisor.is_running('other')
+        await supervisor.shutdown(0)
+
+    asyncio.run(scenario())
@@ -0,0 +1,105 @@
+"""ProgressCache: вытеснение, срок жизни и защита от устаревшей записи"""
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import challenge_bot as cb  # noqa: E402
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(cb, 'time', SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = cb.ProgressCache(max_size=2, ttl=60)
+    cache.put(1, {'current_day': 1})
+    cache.put(2, {'current_day': 2})
+    assert cache.get(1) == (True, {'current_day': 1})  # 1 снова свежий
+
+    cache.put(3, {'current_day': 3})
+
+    assert cache.get(2) == (False, None)
+    assert cache.get(1)[0] and cache.get(3)[0]
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = cb.ProgressCache(max_size=10, ttl=60)
+    cache.put(1, {'current_day': 1})
+    cache.put(2, None)  # отсутствие прогресса тоже кэшируется
+
+    clock.now += 60
+    assert cache.get(1) == (True, {'current_day': 1})
+    assert cache.get(2) == (True, None)
+
+    clock.now += 1
+    assert cache.get(1) == (False, None)
+    assert cache.get(2) == (False, None)
+
+
+def test_disabled_cache_keeps_nothing(clock):
+    cache = cb.ProgressCache(max_size=10, ttl=0)
+    cache.put(1, {'current_day': 1})
+    assert cache.get(1) == (False, None)
+
+
+def test_returned_progress_is_a_copy(clock):
+    cache = cb.ProgressCache(max_size=10, ttl=60)
+    cache.put(1, {'current_day': 1})
+    cache.get(1)[1]['current_day'] = 5
+    assert cache.get(1)[1] == {'current_day': 1}
+
+
+def test_stale_put_after_concurrent_write_is_dropped(clock):
+    cache = cb.ProgressCache(max_size=10, ttl=60)
+    cache.put(1, {'current_day': 1})
+
+    version = cache.version  # начали читать из БД
+    cache.update(1, {'current_day': 2})  # тем временем хелпер записал прогресс
+    cache.put(1, {'current_day': 1}, version)  # прочитанное устарело
+
+    assert cache.get(1) == (True, {'current_day': 2})
+
+    # Без параллельных записей прочитанное кладется
+    version = cache.version
+    cache.put(1, {'current_day': 3}, version)
+    assert cache.get(1) == (True, {'current_day': 3})
+
+
+def test_get_challenge_progress_does_not_cache_a_read_raced_by_a_write(clock, monkeypatch):
+    cache = cb.ProgressCache(max_size=10, ttl=60)
+    monkeypatch.setattr(cb, 'progress_cache', cache)
+    reads = []
+
+    @asynccontextmanager
+    async def get_db_connection():
+        yield None
+
+    async def fetch_challenge_progress(conn, user_id):
+        reads.append(user_id)
+        if len(reads) == 1:
+            # Пока шло чтение, другой обработчик сбросил запись
+            cache.evict(user_id)
+        return {'current_day': len(reads)}
+
+    monkeypatch.setattr(cb, 'get_db_connection', get_db_connection)
+    monkeypatch.setattr(cb, 'fetch_challenge_progress', fetch_challenge_progress)
+
+    assert asyncio.run(cb.get_challenge_progress(7)) == {'current_day': 1}
+    assert cache.get(7) == (False, None)
+
+    assert asyncio.run(cb.get_challenge_progress(7)) == {'current_day': 2}
+    assert asyncio.run(cb.get_challenge_progress(7)) == {'current_day': 2}
+    assert len(reads) == 2
+
+    # fresh=True читает из БД даже при записи в кэше
+    assert asyncio.run(cb.get_challenge_progress(7, fresh=True)) == {'current_day': 3}
@@ -0,0 +1,113 @@
+"""TelegramRateLimiter: стоимость методов и обработка retry_after"""
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetMe, SendChatAction, SendMediaGroup, SendMessage
+from aiogram.types import InputMediaPhoto
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import challenge_bot as cb  # noqa: E402
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Монотонные часы ограничителя; sleep не ждет, а двигает часы"""
+    clock = SimpleNamespace(now=1000.0, sleeps=[])
+
+    async def sleep(seconds):
+        clock.sleeps.append(seconds)
+        clock.now += seconds
+
+    monkeypatch.setattr(cb, 'time', SimpleNamespace(monotonic=lambda: clock.now))
+    monkeypatch.setattr(cb, 'asyncio', SimpleNamespace(sleep=sleep))
+    return clock
+
+
+def make_limiter(max_retries=2):
+    return cb.TelegramRateLimiter(global_rate=20, chat_rate=1, chat_burst=3, max_retries=max_retries)
+
+
+def retry_after(method, seconds):
+    return TelegramRetryAfter(method, 'Flood control exceeded', seconds)
+
+
+def test_method_cost():
+    limiter = make_limiter()
+    album = [InputMediaPhoto(media='photo-1'), InputMediaPhoto(media='photo-2')]
+
+    assert limiter.method_cost(SendMessage(chat_id=1, text='hi')) == 1
+    assert limiter.method_cost(SendMediaGroup(chat_id=1, media=album)) == 2
+    # «Печатает...» - не сообщение, его лимит не ограничивает
+    assert limiter.method_cost(SendChatAction(chat_id=1, action='typing')) == 0
+    assert limiter.method_cost(GetMe()) == 0
+
+
+def test_retry_after_pauses_halves_rate_and_retries(clock):
+    limiter = make_limiter()
+    method = SendMessage(chat_id=1, text='hi')
+    calls = []
+
+    async def make_request(bot, method):
+        calls.append(clock.now)
+        if len(calls) == 1:
+            raise retry_after(method, 5)
+        return 'ok'
+
+    assert asyncio.run(limiter(make_request, None, method)) == 'ok'
+
+    assert limiter.global_bucket.rate == 10
+    assert limiter.paused_until == 1005.0
+    assert limiter.stats['retry_after'] == 1
+    # Повтор - не раньше, чем кончится пауза
+    assert len(calls) == 2 and calls[1] >= 1005.0
+
+
+def test_retry_after_leaves_token_debt_for_new_sends(clock):
+    limiter = make_limiter()
+    limiter.on_retry_after(5)
+
+    # Долг в 5 секунд по сниженному лимиту
+    assert limiter.global_bucket.tokens == -5 * 10
+    # Новая отправка встает после паузы и своего маркера
+    assert limiter.global_bucket.reserve() == pytest.approx(5.1)
+
+    # Через минуту без новых retry_after лимит начинает возвращаться
+    clock.now += limiter.RATE_RECOVERY_SECONDS
+    limiter.recover_rate()
+    assert limiter.global_bucket.rate == 12.5
+
+
+def test_retry_after_is_raised_after_max_retries(clock):
+    limiter = make_limiter(max_retries=2)
+    method = SendMessage(chat_id=1, text='hi')
+    calls = []
+
+    async def make_request(bot, method):
+        calls.append(clock.now)
+        raise retry_after(method, 1)
+
+    with pytest.raises(TelegramRetryAfter):
+        asyncio.run(limiter(make_request, None, method))
+
+    assert len(calls) == 3
+    assert limiter.stats['retry_after'] == 3
+    assert limiter.global_bucket.rate == 2.5
+
+
+def test_unlimited_methods_skip_the_buckets(clock):
+    limiter = make_limiter()
+    method = SendChatAction(chat_id=1, action='typing')
+
+    async def make_request(bot, method):
+        return True
+
+    for _ in range(50):
+        assert asyncio.run(limiter(make_request, None, method)) is True
+    assert limiter.stats['requests'] == 0
+    assert limiter.chat_buckets == {}
+    assert clock.sleeps == []
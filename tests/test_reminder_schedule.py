@@ -0,0 +1,114 @@
+"""Расписание напоминаний: next_action_at обнуляется, когда напоминать больше нечего
+
+Нужна тестовая база PostgreSQL: TEST_DATABASE_URL (миграции применяются
+сами). Без нее тесты пропускаются.
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+if not TEST_DATABASE_URL:
+    pytest.skip('TEST_DATABASE_URL is not set', allow_module_level=True)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import challenge_bot as cb  # noqa: E402
+
+# Модуль мог импортировать другой тест, когда DATABASE_URL еще не был задан
+cb.DATABASE_URL = TEST_DATABASE_URL
+
+USERS = range(9100000000001, 9100000000006)
+
+
+async def query(sql, params=None):
+    async with cb.get_db_connection() as conn:
+        cur = await conn.execute(sql, params)
+        return await cur.fetchall()
+
+
+async def cleanup():
+    async with cb.get_db_connection() as conn:
+        for table in ('outbox', 'challenge_day_results', 'challenge_progress', 'users'):
+            await conn.execute(f'DELETE FROM {table} WHERE user_id BETWEEN %s AND %s', (USERS[0], USERS[-1]))
+
+
+async def add_participant(user_id, day, next_action, days, is_active=True):
+    """Участник с подошедшим next_action и строками дней (day, unlocked_at, reminder_sent, evening_reminder_sent)"""
+    async with cb.get_db_connection() as conn:
+        await conn.execute("INSERT INTO users (user_id, username) VALUES (%s, 'test')", (user_id,))
+        await conn.execute('''INSERT INTO challenge_progress
+                              (user_id, age_category, current_day, is_active, completed_at, next_action_at, next_action)
+                              VALUES (%s, '4-6', %s, %s, CASE WHEN %s THEN NULL ELSE NOW() - INTERVAL '25 hours' END,
+                                      NOW() - INTERVAL '1 minute', %s)''',
+                           (user_id, day, is_active, is_active, next_action))
+        for day_number, unlocked_ago, reminder_sent, evening_sent in days:
+            await conn.execute('''INSERT INTO challenge_day_results
+                                  (user_id, day, unlocked_at, completed, reminder_sent, evening_reminder_sent)
+                                  VALUES (%s, %s, NOW() - %s * INTERVAL '1 hour', %s, %s, %s)''',
+                               (user_id, day_number, unlocked_ago, day_number < day, reminder_sent, evening_sent))
+
+
+async def schedule_of(user_id):
+    rows = await query('SELECT next_action_at, next_action FROM challenge_progress WHERE user_id = %s', (user_id,))
+    return rows[0]
+
+
+def run(scenario):
+    async def wrapper():
+        await cb.init_db_pool()
+        try:
+            await cb.init_db()
+            await cleanup()
+            await scenario()
+        finally:
+            await cleanup()
+            await cb.close_db_pool()
+    asyncio.run(wrapper())
+
+
+def test_schedule_stops_after_last_day_reminder():
+    last, sent_already, funnel_done = USERS[0], USERS[1], USERS[2]
+
+    async def scenario():
+        # Последнее напоминание уходит этим же проходом
+        await add_participant(last, 3, 'evening', [(1, 72, False, True), (2, 48, True, True), (3, 24, True, False)])
+        # Все напоминания отправлены раньше, день 3 не пройден
+        await add_participant(sent_already, 3, 'morning', [(1, 72, False, True), (2, 48, True, True), (3, 24, True, True)])
+        # Последний шаг воронки
+        await add_participant(funnel_done, 3, 'offer_24h', [], is_active=False)
+
+        _, _, queued, _ = await cb.sweep_due_reminders(1000)
+
+        assert {'user_id': last, 'kind': 'day3_evening'} in queued
+        for user_id in (last, sent_already, funnel_done):
+            assert (await schedule_of(user_id))['next_action_at'] is None
+
+        # Обнуленных участников проход больше не выбирает
+        _, _, queued, _ = await cb.sweep_due_reminders(1000)
+        assert not [job for job in queued if job['user_id'] in USERS]
+
+    run(scenario)
+
+
+def test_schedule_continues_while_reminders_are_left_and_restarts_on_next_day():
+    morning, waiting = USERS[3], USERS[4]
+
+    async def scenario():
+        # Утром уходит напоминание дня 2, вечернее еще впереди
+        await add_participant(morning, 2, 'morning', [(1, 48, False, True), (2, 24, False, False)])
+        # День 1 открыт сейчас, вечернее уже отправлено - до прохождения дня напоминать нечего
+        await add_participant(waiting, 1, 'evening', [(1, 0, False, True)])
+
+        await cb.sweep_due_reminders(1000)
+
+        assert (await schedule_of(morning))['next_action_at'] is not None
+        assert (await schedule_of(waiting))['next_action_at'] is None
+
+        # Открытие следующего дня снова назначает напоминание
+        await cb.update_challenge_day(waiting, 1, 300)
+        assert (await schedule_of(waiting))['next_action_at'] is not None
+
+    run(scenario)
@@ -0,0 +1,163 @@
+"""Scheduler: слоты, пропущенные запуски и догон после рестарта"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import challenge_bot as cb  # noqa: E402
+
+EVERY = timedelta(seconds=10)
+
+
+class FakeClock:
+    """Часы, которые идут только по advance; sleep ждет, пока тест не отпустит"""
+
+    def __init__(self):
+        self.wall = datetime(2026, 1, 1, 12, 0, 3)
+        self.mono = 1000.0
+        self.sleeps = []
+        self.wake = asyncio.Event()
+
+    def now(self):
+        return self.wall
+
+    def monotonic(self):
+        return self.mono
+
+    def advance(self, seconds, wall=True, mono=True):
+        if wall:
+            self.wall += timedelta(seconds=seconds)
+        if mono:
+            self.mono += seconds
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        await self.wake.wait()
+        self.wake.clear()
+
+
+@pytest.fixture
+def job_runs(monkeypatch):
+    """Журнал job_runs в памяти: {имя: last_success_at}"""
+    runs = {}
+
+    async def load_job_runs():
+        return dict(runs)
+
+    async def save_job_run(job, started_at, duration, error=None):
+        if error is None:
+            runs[job.name] = job.covered_until
+
+    monkeypatch.setattr(cb, 'load_job_runs', load_job_runs)
+    monkeypatch.setattr(cb, 'save_job_run', save_job_run)
+    return runs
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def make_scheduler(clock, func):
+    scheduler = cb.Scheduler(clock=clock, supervisor=cb.JobSupervisor(4, clock))
+    job = cb.ScheduledJob('sweep', func, every=EVERY, catch_up=True)
+    scheduler.add_job(job)
+    return scheduler, job
+
+
+def test_restore_fires_overdue_job_once(job_runs):
+    async def scenario():
+        clock = FakeClock()
+        job_runs['sweep'] = clock.now() - timedelta(hours=1)
+        calls = []
+
+        async def sweep(catch_up):
+            calls.append(catch_up)
+
+        scheduler, job = make_scheduler(clock, sweep)
+        task = asyncio.create_task(scheduler.run())
+        await settle()
+
+        # Один запуск сразу, с окном догона на весь простой
+        assert calls == [timedelta(hours=1)]
+        assert job.missed == 359
+        assert job_runs['sweep'] == clock.now()
+        # Дальше - ждать следующего слота, а не догонять каждый пропущенный
+        assert job.next_run == datetime(2026, 1, 1, 12, 0, 10)
+        assert clock.sleeps[-1] == pytest.approx(7)
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+
+def test_job_without_history_waits_for_its_slot(job_runs):
+    async def scenario():
+        clock = FakeClock()
+        calls = []
+
+        async def sweep(catch_up):
+            calls.append(catch_up)
+
+        scheduler, job = make_scheduler(clock, sweep)
+        task = asyncio.create_task(scheduler.run())
+        await settle()
+        assert calls == []
+        assert clock.sleeps[-1] == pytest.approx(7)
+
+        clock.advance(7)
+        clock.wake.set()
+        await settle()
+        # Первый запуск без прошлых успешных - окно по умолчанию
+        assert calls == [None]
+        assert job.missed == 0
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+
+def test_late_fire_counts_missed_slots(job_runs):
+    async def scenario():
+        clock = FakeClock()
+
+        async def sweep(catch_up):
+            pass
+
+        scheduler, job = make_scheduler(clock, sweep)
+        scheduler._schedule(job, clock.now())
+        # Процесс стоял (например, машина спала) 35 секунд после слота 12:00:10
+        clock.advance(42)
+        scheduler._fire(job)
+        await settle()
+
+        assert job.missed == 3
+        assert job.next_run == datetime(2026, 1, 1, 12, 0, 50)
+
+    asyncio.run(scenario())
+
+
+def test_job_is_due_by_wall_clock_or_monotonic_clock(job_runs):
+    async def scenario():
+        clock = FakeClock()
+        scheduler, job = make_scheduler(clock, None)
+        scheduler._schedule(job, clock.now())
+        assert not scheduler._is_due(job)
+
+        # Перевели системное время вперед - монотонные часы стоят
+        clock.advance(7, mono=False)
+        assert scheduler._is_due(job)
+
+        # Системное время отвели назад - монотонные часы все равно дойдут
+        clock.advance(-7, mono=False)
+        assert not scheduler._is_due(job)
+        clock.advance(7, wall=False)
+        assert scheduler._is_due(job)
+
+    asyncio.run(scenario())